@@ -2,29 +2,258 @@
 MiWay Route Planner - Flask Web Application
 """
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, g, has_app_context, render_template, request, jsonify
 import sqlite3
-from datetime import datetime
+import os
+import json
 import math
+import queue
+from datetime import datetime, timezone
 import threading
 import time
-from utils.live_updater import update_all_realtime_data
+from utils.broadcast import Broadcaster
+from utils.db import ConnectionManager, WriteQueue
+from utils.live_updater import realtime_version, update_all_realtime_data
+from utils.predictions import get_prediction_index
+from utils.raptor import plan_journeys
+from utils.response_cache import ResponseCache
+from utils.spatial import haversine_distance
+from utils.timetable import get_timetable, parse_gtfs_time, reload_if_changed
+from utils.vehicle_log import VehicleLog
 
 app = Flask(__name__)
 DB_FILE = 'miway.db'
+MAX_TRANSFERS = 3
 
 # Track last update time and background worker
 last_update_time = None
-update_lock = threading.Lock()
 background_worker = None
 worker_running = False
+REFRESH_SECONDS = 30
+
+# When the last update cycle finished and the next one is due (epoch seconds)
+last_cycle_at = None
+next_update_at = None
+
+# HTTP caching. Static data only changes when load_gtfs.py swaps in a new
+# feed; realtime data and health checks change once per update cycle, so
+# clients may reuse them until the next cycle is due. Conditional requests
+# are answered from in-memory validators before any query runs.
+STATIC_MAX_AGE = 300
+CACHE_POLICIES = {
+    'api_stops': 'static',
+    'api_routes': 'static',
+    'api_nearby_stops': 'static',
+    'api_trip_details': 'static',
+    'api_vehicles': 'realtime',
+    'api_alerts': 'realtime',
+    'api_nearby_buses': 'realtime',
+    'api_stop_arrivals': 'realtime',
+    'api_health_history': 'health',
+    'api_health_summary': 'health',
+}
+PAGE_ENDPOINTS = {'index', 'status_page'}
+
+# Live vehicle pushes to /api/stream clients; idle streams send a comment
+# this often so proxies don't close them
+broadcaster = Broadcaster()
+STREAM_KEEPALIVE_SECONDS = 15
+
+# Vehicles as last sent to clients, versioned for since= deltas
+vehicle_log = VehicleLog()
+published_version = None
+
+# Serialized, compressed bodies of the hot read endpoints
+response_cache = ResponseCache()
+
+# Reused connections: pooled readers for requests, one reader per background
+# thread and a single writer. The database runs in WAL mode, and every write
+# goes through the writer queue, so requests never wait on realtime ingest.
+db = ConnectionManager(DB_FILE)
+writes = WriteQueue(db.writer)
+
+# Which feed the in-memory state was built from. load_gtfs.py copies a new
+# feed into the live file and then touches GENERATION_FILE (a first load
+# renames the file into place), so either stamp changing means a new feed.
+GENERATION_FILE = DB_FILE + '.generation'
+db_generation = None
+generation_lock = threading.Lock()
+reload_running = False
+
+
+def get_db_generation():
+    """Identity of the feed currently at DB_FILE (None if missing)"""
+    try:
+        st = os.stat(DB_FILE)
+    except FileNotFoundError:
+        return None
+    try:
+        stamp = os.stat(GENERATION_FILE).st_mtime_ns
+    except FileNotFoundError:
+        stamp = None
+    return (st.st_dev, st.st_ino, stamp)
+
+
+def reload_static_data():
+    """Rebuild in-memory state from a newly swapped-in database"""
+    global reload_running
+    try:
+        if reload_if_changed(DB_FILE):
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] 🔄 Static feed changed, timetable reloaded: {get_timetable().stats()}")
+            get_prediction_index().rebuild()
+    except Exception as e:
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Timetable reload error: {e}")
+    finally:
+        reload_running = False
+
+
+def check_db_generation():
+    """
+    Notice a database swapped in by load_gtfs.py
+    Costs one stat() per call; the reload itself runs in the background and
+    the old timetable keeps serving until the new one is complete
+    """
+    global db_generation, reload_running
+    generation = get_db_generation()
+    if generation is None or generation == db_generation:
+        return False
+
+    with generation_lock:
+        if generation == db_generation or reload_running:
+            return False
+        db_generation = generation
+        reload_running = True
+
+    db.invalidate()
+    threading.Thread(target=reload_static_data, daemon=True).start()
+    return True
+
+
+@app.before_request
+def watch_database():
+    """Pick up a new static feed without restarting the app"""
+    check_db_generation()
+
+
+def cache_validator(policy):
+    """
+    (etag, last_modified, max_age) for a cache policy, from in-memory state
+    only; etag and last_modified are None while there is nothing to validate
+    """
+    if policy == 'static':
+        tt = get_timetable()
+        if tt.version is None:
+            return None, None, STATIC_MAX_AGE
+        loaded = ''.join(c for c in tt.version if c.isdigit())
+        feed_version = ''.join(c for c in tt.feed_version or '' if c.isalnum() or c in '._-') or 'unversioned'
+        last_modified = datetime.fromisoformat(tt.version).astimezone(timezone.utc)
+        return f'static-{feed_version}-{loaded}', last_modified, STATIC_MAX_AGE
+    
+    # Realtime data is good until the next update cycle is due
+    max_age = max(0, int(next_update_at - time.time())) if next_update_at else 0
+    if policy == 'realtime':
+        version = realtime_version()
+        if version is None:
+            return None, None, max_age
+        digest, published = version
+        return f'rt-{digest}', datetime.fromtimestamp(published, timezone.utc) if published else None, max_age
+    if last_cycle_at is None:
+        return None, None, max_age
+    return f'cycle-{int(last_cycle_at * 1000)}', datetime.fromtimestamp(last_cycle_at, timezone.utc), max_age
+
+
+@app.before_request
+def answer_conditional_request():
+    """
+    Reply 304 to a revalidation whose validator is still current, before the
+    endpoint runs any query; the validator is kept for add_cache_headers so
+    a response is never labelled newer than its data
+    """
+    policy = CACHE_POLICIES.get(request.endpoint)
+    if request.method != 'GET' or policy is None:
+        return None
+    
+    g.cache_validator = cache_validator(policy)
+    etag, last_modified = g.cache_validator[:2]
+    if request.if_none_match:
+        fresh = etag is not None and request.if_none_match.contains_weak(etag)
+    else:
+        fresh = (last_modified is not None and request.if_modified_since is not None
+                 and last_modified.replace(microsecond=0) <= request.if_modified_since)
+    return Response(status=304) if fresh else None
+
+
+@app.after_request
+def add_cache_headers(response):
+    """ETag, Last-Modified and Cache-Control for every endpoint"""
+    if request.endpoint == 'static' or 'Cache-Control' in response.headers:
+        return response  # Flask's static files, and streams, set their own
+    
+    policy = CACHE_POLICIES.get(request.endpoint) if request.method == 'GET' else None
+    if policy is None or response.status_code not in (200, 304):
+        response.headers['Cache-Control'] = 'no-cache' if request.endpoint in PAGE_ENDPOINTS else 'no-store'
+        return response
+    
+    etag, last_modified, max_age = g.get('cache_validator') or cache_validator(policy)
+    if etag is not None and 'ETag' not in response.headers:
+        response.set_etag(etag)  # Cached bodies keep their own content ETag
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
 
 
 def get_db():
-    """Get database connection"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row  # Return rows as dictionaries
-    return conn
+    """
+    Read-only database connection (rows as dictionaries)
+    Requests borrow one from the pool until teardown; background threads
+    keep their own. Either way it is reused, so don't close it.
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = db.acquire()
+        return g.db
+    return db.thread_reader()
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    """Return the request's connection to the pool"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        db.release(conn)
+
+
+def cached_json(generation, build, generation_of=None):
+    """
+    JSON response for the current request, served from response_cache
+    build() only runs the first time the endpoint is asked for these query
+    args in this data generation; the body is sent in the best encoding the
+    client accepts, and a matching If-None-Match gets a 304
+    Data that can move on between the lookup and build() passes
+    generation_of, which reads the generation the built result belongs to;
+    the body is cached under that one rather than the one looked up
+    """
+    args = tuple(sorted(request.args.items(multi=True)))
+    entry = response_cache.get(request.endpoint, args, generation)
+    if entry is None:
+        data = build()
+        if generation_of is not None:
+            generation = generation_of(data)
+        body = app.json.dumps(data, separators=(',', ':')) + '\n'
+        entry = response_cache.put(request.endpoint, args, generation, body.encode())
+    
+    encoding, body, etag = entry.select(request.headers.get('Accept-Encoding'))
+    if entry.matches(request.headers.get('If-None-Match')):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = etag
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
 
 
 def get_all_stops():
@@ -41,164 +270,35 @@ def get_all_stops():
     """)
     
     stops = [{'id': row['stop_id'], 'name': row['stop_name'], 'lat': row['stop_lat'], 'lon': row['stop_lon']} for row in cursor.fetchall()]
-    conn.close()
     return stops
 
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    """
-    Calculate the great circle distance between two points 
-    on the earth (specified in decimal degrees)
-    Returns distance in kilometers
-    """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-    
-    # Haversine formula
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    
-    # Radius of earth in kilometers
-    r = 6371
-    
-    return c * r
+def invalid_location(lat, lon, radius_km=None):
+    """Error message for coordinates (and search radius) the stop grid can't use, or None"""
+    if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+        return 'Invalid coordinates'
+    if radius_km is not None and not (math.isfinite(radius_km) and radius_km > 0):
+        return 'Invalid radius'
+    return None
 
 
-def get_nearby_stops(user_lat, user_lon, limit=10):
+def get_nearby_stops(user_lat, user_lon, limit=10, max_km=None):
     """Get stops near user's location"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Get all stops with coordinates
-    cursor.execute("""
-        SELECT stop_id, stop_name, stop_lat, stop_lon
-        FROM stops 
-        WHERE location_type = 0
-          AND stop_lat IS NOT NULL 
-          AND stop_lon IS NOT NULL
-    """)
-    
-    stops = []
-    for row in cursor.fetchall():
-        # Calculate distance from user
-        distance = haversine_distance(user_lat, user_lon, row['stop_lat'], row['stop_lon'])
-        stops.append({
-            'id': row['stop_id'],
-            'name': row['stop_name'],
-            'lat': row['stop_lat'],
-            'lon': row['stop_lon'],
-            'distance': round(distance, 2)  # Distance in km
-        })
-    
-    conn.close()
-    
-    # Sort by distance and return top N
-    stops.sort(key=lambda x: x['distance'])
-    return stops[:limit]
+    return get_timetable().nearby_stops(user_lat, user_lon, limit, max_km)
 
 
-def find_routes(source_stop_id, dest_stop_id, departure_time=None):
-    """Find routes between two stops"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Build query with optional time filter
-    time_filter = ""
-    if departure_time:
-        time_filter = f"AND source.departure_time >= '{departure_time}'"
-    
-    query = f"""
-        SELECT 
-            t.trip_id,
-            r.route_short_name,
-            r.route_long_name,
-            r.route_color,
-            source.stop_id as source_stop_id,
-            s1.stop_name as source_stop_name,
-            source.departure_time,
-            dest.stop_id as dest_stop_id,
-            s2.stop_name as dest_stop_name,
-            dest.arrival_time,
-            source.stop_sequence as source_sequence,
-            dest.stop_sequence as dest_sequence,
-            t.trip_headsign,
-            CAST((julianday('2024-01-01 ' || dest.arrival_time) - 
-                  julianday('2024-01-01 ' || source.departure_time)) * 24 * 60 
-                  AS INTEGER) as duration_minutes
-        FROM stop_times source
-        JOIN stop_times dest 
-            ON source.trip_id = dest.trip_id
-        JOIN trips t 
-            ON source.trip_id = t.trip_id
-        JOIN routes r 
-            ON t.route_id = r.route_id
-        JOIN stops s1 
-            ON source.stop_id = s1.stop_id
-        JOIN stops s2 
-            ON dest.stop_id = s2.stop_id
-        WHERE source.stop_id = ?
-          AND dest.stop_id = ?
-          AND source.stop_sequence < dest.stop_sequence
-          {time_filter}
-        ORDER BY source.departure_time
-        LIMIT 10
-    """
-    
-    cursor.execute(query, (source_stop_id, dest_stop_id))
-    results = cursor.fetchall()
-    
-    routes = []
-    for row in results:
-        routes.append({
-            'trip_id': row['trip_id'],
-            'route_number': row['route_short_name'],
-            'route_name': row['route_long_name'],
-            'route_color': row['route_color'],
-            'source_stop': row['source_stop_name'],
-            'dest_stop': row['dest_stop_name'],
-            'departure_time': row['departure_time'],
-            'arrival_time': row['arrival_time'],
-            'duration_minutes': row['duration_minutes'],
-            'trip_headsign': row['trip_headsign'],
-            'stops_count': row['dest_sequence'] - row['source_sequence'] + 1
-        })
-    
-    conn.close()
-    return routes
+def find_routes(source_stop_id, dest_stop_id, departure_time=None, service_date=None):
+    """Find routes between two stops, using only trips running on service_date (default today)"""
+    after_secs = parse_gtfs_time(departure_time) if departure_time else None
+    return get_timetable().find_direct_trips(
+        source_stop_id, dest_stop_id, after_secs, limit=10,
+        service_date=service_date or datetime.now().date()
+    )
 
 
 def get_trip_stops(trip_id, start_sequence, end_sequence):
     """Get all stops for a specific trip between start and end sequences"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT 
-            st.stop_sequence,
-            s.stop_name,
-            st.arrival_time,
-            st.departure_time
-        FROM stop_times st
-        JOIN stops s ON st.stop_id = s.stop_id
-        WHERE st.trip_id = ?
-          AND st.stop_sequence >= ?
-          AND st.stop_sequence <= ?
-        ORDER BY st.stop_sequence
-    """, (trip_id, start_sequence, end_sequence))
-    
-    stops = []
-    for row in cursor.fetchall():
-        stops.append({
-            'sequence': row['stop_sequence'],
-            'name': row['stop_name'],
-            'arrival': row['arrival_time'],
-            'departure': row['departure_time']
-        })
-    
-    conn.close()
-    return stops
+    return get_timetable().trip_stops(trip_id, start_sequence, end_sequence)
 
 
 @app.route('/')
@@ -216,8 +316,7 @@ def status_page():
 @app.route('/api/stops')
 def api_stops():
     """API endpoint to get all stops"""
-    stops = get_all_stops()
-    return jsonify(stops)
+    return cached_json(db_generation, get_all_stops)
 
 
 @app.route('/api/nearby-stops', methods=['GET'])
@@ -230,11 +329,9 @@ def api_nearby_stops():
     if user_lat is None or user_lon is None:
         return jsonify({'error': 'Latitude and longitude required'}), 400
     
-    try:
-        user_lat = float(user_lat)
-        user_lon = float(user_lon)
-    except (ValueError, TypeError):
-        return jsonify({'error': 'Invalid coordinates'}), 400
+    error = invalid_location(user_lat, user_lon)
+    if error:
+        return jsonify({'error': error}), 400
     
     nearby_stops = get_nearby_stops(user_lat, user_lon, limit)
     
@@ -278,6 +375,44 @@ def api_search():
     })
 
 
+@app.route('/api/plan', methods=['POST'])
+def api_plan():
+    """API endpoint to plan multi-leg journeys with transfers"""
+    data = request.get_json()
+    
+    source_stop_id = data.get('source')
+    dest_stop_id = data.get('destination')
+    max_transfers = data.get('max_transfers', 2)
+    include_walking = data.get('include_walking', True)
+    departure_time = data.get('departure_time') or datetime.now().strftime('%H:%M:%S')
+    
+    if not source_stop_id or not dest_stop_id:
+        return jsonify({'error': 'Source and destination required'}), 400
+    
+    if source_stop_id == dest_stop_id:
+        return jsonify({'error': 'Source and destination cannot be the same'}), 400
+    
+    try:
+        max_transfers = min(max(int(max_transfers), 0), MAX_TRANSFERS)
+        depart_secs = parse_gtfs_time(departure_time)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid max_transfers or departure_time'}), 400
+    
+    started = time.time()
+    journeys = plan_journeys(
+        get_timetable(), source_stop_id, dest_stop_id, depart_secs,
+        max_transfers=max_transfers, walking=bool(include_walking),
+        service_date=datetime.now().date()
+    )
+    
+    return jsonify({
+        'journeys': journeys,
+        'count': len(journeys),
+        'departure_time': departure_time,
+        'search_ms': round((time.time() - started) * 1000, 1)
+    })
+
+
 @app.route('/api/trip/<trip_id>/<int:start_seq>/<int:end_seq>')
 def api_trip_details(trip_id, start_seq, end_seq):
     """API endpoint to get trip details"""
@@ -285,9 +420,8 @@ def api_trip_details(trip_id, start_seq, end_seq):
     return jsonify({'stops': stops})
 
 
-@app.route('/api/routes')
-def api_routes():
-    """API endpoint to get all routes"""
+def get_all_routes():
+    """Get all routes, in route number order"""
     conn = get_db()
     cursor = conn.cursor()
     
@@ -306,15 +440,17 @@ def api_routes():
             'color': row['route_color']
         })
     
-    conn.close()
-    return jsonify(routes)
+    return routes
 
 
-@app.route('/api/vehicles')
-def api_vehicles():
-    """API endpoint to get all vehicle positions"""
-    route_id = request.args.get('route_id')
-    
+@app.route('/api/routes')
+def api_routes():
+    """API endpoint to get all routes"""
+    return cached_json(db_generation, get_all_routes)
+
+
+def load_vehicles(route_id=None):
+    """Vehicle positions with route, stop and headsign details"""
     conn = get_db()
     cursor = conn.cursor()
     
@@ -360,8 +496,40 @@ def api_vehicles():
             'timestamp': row['timestamp']
         })
     
-    conn.close()
-    return jsonify({'vehicles': vehicles, 'count': len(vehicles)})
+    return vehicles
+
+
+def sync_vehicle_log():
+    """Fold the current vehicle_positions snapshot into vehicle_log if it is new"""
+    try:
+        row = get_db().execute("SELECT generation FROM realtime_snapshots WHERE feed = 'vehicle_positions'").fetchone()
+        generation = row['generation'] if row else None
+    except sqlite3.OperationalError:
+        generation = None  # No realtime data ingested yet
+    
+    if generation is not None and generation == vehicle_log.source:
+        return
+    vehicle_log.update(load_vehicles(), generation)
+
+
+@app.route('/api/vehicles')
+def api_vehicles():
+    """
+    API endpoint to get all vehicle positions
+    With since=<version>, only vehicles added, moved or changed since that
+    version are returned, plus the ids of removed ones
+    """
+    route_id = request.args.get('route_id')
+    since = request.args.get('since', type=int)
+    if vehicle_log.source is None:
+        sync_vehicle_log()  # The background worker keeps it current after that
+    
+    # snapshot() and delta() read their version under the log's lock, together
+    # with the vehicles, so the body is cached under the version it shows
+    version_of = lambda data: data['version']
+    if since is None:
+        return cached_json(vehicle_log.version, lambda: vehicle_log.snapshot(route_id), version_of)
+    return cached_json(vehicle_log.version, lambda: vehicle_log.delta(since, route_id), version_of)
 
 
 @app.route('/api/alerts')
@@ -372,45 +540,37 @@ def api_alerts():
     conn = get_db()
     cursor = conn.cursor()
     
+    # One statement, so the alert list and its routes come from the same snapshot
+    query = """
+        SELECT a.*,
+            (SELECT group_concat(DISTINCT aae.route_id)
+             FROM alert_affected_entities aae
+             WHERE aae.alert_id = a.alert_id AND aae.route_id IS NOT NULL) as route_ids
+        FROM alerts a
+    """
     if route_id:
-        cursor.execute("""
-            SELECT DISTINCT a.*
-            FROM alerts a
-            JOIN alert_affected_entities aae ON a.alert_id = aae.alert_id
-            WHERE aae.route_id = ?
+        query += """
+            WHERE a.alert_id IN (SELECT alert_id FROM alert_affected_entities WHERE route_id = ?)
             ORDER BY a.timestamp DESC
-        """, (route_id,))
+        """
+        cursor.execute(query, (route_id,))
     else:
-        cursor.execute("""
-            SELECT * FROM alerts
-            ORDER BY timestamp DESC
-            LIMIT 20
-        """)
+        query += " ORDER BY a.timestamp DESC LIMIT 20"
+        cursor.execute(query)
     
     alerts = []
     for row in cursor.fetchall():
-        alert_id = row['alert_id']
-        
-        # Get affected routes for this alert
-        cursor.execute("""
-            SELECT DISTINCT route_id 
-            FROM alert_affected_entities 
-            WHERE alert_id = ? AND route_id IS NOT NULL
-        """, (alert_id,))
-        route_ids = [r['route_id'] for r in cursor.fetchall()]
-        
         alerts.append({
-            'id': alert_id,
+            'id': row['alert_id'],
             'cause': row['cause'],
             'effect': row['effect'],
             'header': row['header_text'],
             'description': row['description_text'],
             'url': row['url'],
             'timestamp': row['timestamp'],
-            'route_ids': route_ids
+            'route_ids': row['route_ids'].split(',') if row['route_ids'] else []
         })
     
-    conn.close()
     return jsonify({'alerts': alerts, 'count': len(alerts)})
 
 
@@ -420,43 +580,44 @@ def api_refresh_realtime():
     Force refresh of real-time data from MiWay servers
     Downloads fresh VehiclePositions, TripUpdates, and Alerts
     """
-    global last_update_time
+    global last_update_time, last_cycle_at
     
-    with update_lock:
-        try:
-            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Manual refresh triggered...")
-            results = update_all_realtime_data()
-            
-            if results['success']:
-                last_update_time = datetime.now()
-                return jsonify({
-                    'success': True,
-                    'message': 'Real-time data updated successfully',
-                    'timestamp': results['timestamp'],
-                    'vehicles': results['vehicles'],
-                    'trip_updates': results['trip_updates'],
-                    'alerts': results['alerts'],
-                    'errors': results['errors'] if results['errors'] else None,
-                    'error_details': results.get('error_details', None)
-                })
-            else:
-                return jsonify({
-                    'success': False,
-                    'message': 'Update failed',
-                    'errors': results['errors'],
-                    'error_details': results.get('error_details', [])
-                }), 500
+    try:
+        print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Manual refresh triggered...")
+        results = update_all_realtime_data(write_queue=writes)
+        last_cycle_at = time.time()
         
-        except Exception as e:
+        if results['success']:
+            last_update_time = datetime.now()
+            publish_live_update()
+            return jsonify({
+                'success': True,
+                'message': 'Real-time data updated successfully',
+                'timestamp': results['timestamp'],
+                'vehicles': results['vehicles'],
+                'trip_updates': results['trip_updates'],
+                'alerts': results['alerts'],
+                'unchanged': results['unchanged'],
+                'errors': results['errors'] if results['errors'] else None,
+                'error_details': results.get('error_details', None)
+            })
+        else:
             return jsonify({
                 'success': False,
-                'message': str(e)
+                'message': 'Update failed',
+                'errors': results['errors'],
+                'error_details': results.get('error_details', [])
             }), 500
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
 
 
-@app.route('/api/data-freshness')
-def api_data_freshness():
-    """Get information about when data was last updated"""
+def get_data_freshness():
+    """When the realtime data was last updated, and how old it is"""
     conn = get_db()
     cursor = conn.cursor()
     
@@ -472,21 +633,78 @@ def api_data_freshness():
     cursor.execute("SELECT MAX(timestamp) as latest FROM alerts")
     alert_ts = cursor.fetchone()['latest']
     
-    conn.close()
     
     # Convert timestamps to datetime
     data_age_seconds = None
     if vehicle_ts:
         data_age_seconds = int(datetime.now().timestamp()) - vehicle_ts
     
-    return jsonify({
+    return {
         'last_update': last_update_time.isoformat() if last_update_time else None,
         'vehicle_timestamp': vehicle_ts,
         'trip_update_timestamp': trip_ts,
         'alert_timestamp': alert_ts,
         'data_age_seconds': data_age_seconds,
         'is_stale': data_age_seconds > 300 if data_age_seconds else True  # Stale if > 5 minutes
-    })
+    }
+
+
+@app.route('/api/data-freshness')
+def api_data_freshness():
+    """Get information about when data was last updated"""
+    return jsonify(get_data_freshness())
+
+
+def sse_message(event, payload):
+    """Serialize one Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+
+def publish_live_update():
+    """
+    Push vehicle changes and data freshness to every stream subscriber
+    Runs once per update cycle: the delta since the last push is serialized
+    once per topic ('all' and 'route:<route_id>') however many clients are
+    listening; clients that missed a push catch up with /api/vehicles?since=
+    """
+    global published_version
+    sync_vehicle_log()
+    freshness = get_data_freshness()
+    since = published_version
+    published_version = vehicle_log.version
+    
+    messages = {}
+    for topic in broadcaster.topics() | {'all'}:
+        route_id = topic.split(':', 1)[1] if topic != 'all' else None
+        payload = vehicle_log.delta(since, route_id)
+        payload['freshness'] = freshness
+        messages[topic] = sse_message('vehicles', payload)
+    broadcaster.publish(messages)
+
+
+@app.route('/api/stream')
+def api_stream():
+    """
+    Server-Sent Events stream of live vehicles, pushed after every update cycle
+    Optional route_id subscribes to a single route's topic
+    """
+    route_id = request.args.get('route_id')
+    topic = f'route:{route_id}' if route_id else 'all'
+    
+    def generate():
+        q = broadcaster.subscribe(topic)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    yield q.get(timeout=STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            broadcaster.unsubscribe(topic, q)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/health-history')
@@ -516,7 +734,6 @@ def api_health_history():
         columns = [description[0] for description in cursor.description]
         results = [dict(zip(columns, row)) for row in cursor.fetchall()]
         
-        conn.close()
         return jsonify(results)
     
     except Exception as e:
@@ -566,7 +783,6 @@ def api_health_summary():
         columns = [description[0] for description in cursor.description]
         stats = [dict(zip(columns, row)) for row in cursor.fetchall()]
         
-        conn.close()
         
         return jsonify({
             'latest': latest,
@@ -577,6 +793,51 @@ def api_health_summary():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/api/stops/<stop_id>/arrivals')
+def api_stop_arrivals(stop_id):
+    """Upcoming predicted arrivals at a stop, from the in-memory prediction index"""
+    limit = request.args.get('limit', 10, type=int)
+    timetable = get_timetable()
+    stop = timetable.stop_index.get(stop_id)
+    if stop is None:
+        return jsonify({'error': 'Stop not found'}), 404
+    
+    now = time.time()
+    arrivals = []
+    for arrival, trip_id, sequence, delay in get_prediction_index().arrivals(stop_id, now, limit):
+        info = timetable.trip_info(trip_id) or {}
+        arrivals.append({
+            'trip_id': trip_id,
+            'route_number': info.get('route_number'),
+            'route_name': info.get('route_name'),
+            'route_color': info.get('route_color'),
+            'headsign': info.get('headsign'),
+            'stop_sequence': sequence,
+            'predicted_arrival': datetime.fromtimestamp(arrival).strftime('%H:%M:%S'),
+            'minutes': max(0, int((arrival - now) // 60)),
+            'delay_seconds': delay
+        })
+    
+    return jsonify({
+        'stop_id': stop_id,
+        'stop_name': timetable.stop_names[stop],
+        'arrivals': arrivals,
+        'count': len(arrivals)
+    })
+
+
+@app.route('/api/server-stats')
+def api_server_stats():
+    """Connection reuse, writer queue and in-memory cache counters"""
+    return jsonify({
+        'connections': db.stats(),
+        'writes': writes.stats(),
+        'response_cache': response_cache.stats(),
+        'streams': broadcaster.stats(),
+        'predictions': get_prediction_index().stats()
+    })
+
+
 @app.route('/api/nearby-buses', methods=['GET'])
 def api_nearby_buses():
     """Find buses near user's location"""
@@ -588,18 +849,12 @@ def api_nearby_buses():
     if user_lat is None or user_lon is None:
         return jsonify({'error': 'Latitude and longitude required'}), 400
     
-    # Get nearby stops
-    nearby_stops = get_nearby_stops(user_lat, user_lon, limit=10)
+    error = invalid_location(user_lat, user_lon, radius_km)
+    if error:
+        return jsonify({'error': error}), 400
     
-    if not nearby_stops:
-        return jsonify({
-            'buses': [],
-            'nearby_stops': [],
-            'message': 'No stops found nearby'
-        })
-    
-    # Get nearby stops within radius
-    nearby_stops = [s for s in nearby_stops if s['distance'] <= radius_km]
+    # Get the closest stops within radius
+    nearby_stops = get_nearby_stops(user_lat, user_lon, limit=10, max_km=radius_km)
     
     if not nearby_stops:
         return jsonify({
@@ -608,20 +863,20 @@ def api_nearby_buses():
             'message': f'No stops within {radius_km} km'
         })
     
+    # Every trip that visits one of the nearby stops, from the timetable
+    nearby_by_id = {stop['id']: stop for stop in nearby_stops}
+    timetable = get_timetable()
+    predictions = get_prediction_index()
+    visits = timetable.visits_by_trip(nearby_by_id)
+    now = time.time()
+    
     conn = get_db()
     cursor = conn.cursor()
     
-    # Get all vehicles
+    # Route details come from the timetable, so this is a plain scan
     cursor.execute("""
-        SELECT 
-            vp.*,
-            r.route_short_name,
-            r.route_long_name,
-            r.route_color,
-            t.trip_headsign
-        FROM vehicle_positions vp
-        LEFT JOIN routes r ON vp.route_id = r.route_id
-        LEFT JOIN trips t ON vp.trip_id = t.trip_id
+        SELECT vehicle_id, trip_id, latitude, longitude, current_stop_sequence, occupancy_status
+        FROM vehicle_positions
     """)
     
     vehicles = cursor.fetchall()
@@ -633,52 +888,53 @@ def api_nearby_buses():
         if not vehicle['trip_id'] or not vehicle['latitude']:
             continue
         
-        # Get the route for this vehicle
-        cursor.execute("""
-            SELECT st.stop_id, st.stop_sequence, s.stop_name, s.stop_lat, s.stop_lon
-            FROM stop_times st
-            JOIN stops s ON st.stop_id = s.stop_id
-            WHERE st.trip_id = ?
-            AND st.stop_sequence >= ?
-            ORDER BY st.stop_sequence
-            LIMIT 20
-        """, (vehicle['trip_id'], vehicle['current_stop_sequence'] or 0))
+        trip_visits = visits.get(timetable.trip_index.get(vehicle['trip_id']))
+        if not trip_visits:
+            continue
+        info = timetable.trip_info(vehicle['trip_id'])
         
-        upcoming_stops = cursor.fetchall()
+        # Only the next 20 stops of the trip count as "heading towards"
+        current = timetable.trip_index_at(vehicle['trip_id'], vehicle['current_stop_sequence'] or 0)
         
-        # Check if any upcoming stops match our nearby stops
-        for stop in upcoming_stops:
-            for nearby in nearby_stops:
-                if stop['stop_id'] == nearby['id']:
-                    # Calculate distance from vehicle to stop
-                    bus_to_stop_dist = haversine_distance(
-                        vehicle['latitude'], vehicle['longitude'],
-                        stop['stop_lat'], stop['stop_lon']
-                    )
-                    
-                    # Rough ETA calculation (assuming average speed)
-                    avg_speed_kmh = 25  # Average bus speed
-                    eta_minutes = int((bus_to_stop_dist / avg_speed_kmh) * 60)
-                    
-                    if eta_minutes <= 30:  # Only show buses within 30 min
-                        nearby_buses.append({
-                            'vehicle_id': vehicle['vehicle_id'],
-                            'route_number': vehicle['route_short_name'],
-                            'route_name': vehicle['route_long_name'],
-                            'route_color': vehicle['route_color'],
-                            'headsign': vehicle['trip_headsign'],
-                            'stop_id': stop['stop_id'],
-                            'stop_name': stop['stop_name'],
-                            'stop_distance_from_user': nearby['distance'],
-                            'bus_distance_from_stop': round(bus_to_stop_dist, 2),
-                            'eta_minutes': eta_minutes,
-                            'vehicle_lat': vehicle['latitude'],
-                            'vehicle_lon': vehicle['longitude'],
-                            'occupancy': vehicle['occupancy_status']
-                        })
-                    break
-    
-    conn.close()
+        for index, stop_id in sorted(trip_visits):
+            if not current <= index < current + 20:
+                continue
+            nearby = nearby_by_id[stop_id]
+            
+            # Calculate distance from vehicle to stop
+            bus_to_stop_dist = haversine_distance(
+                vehicle['latitude'], vehicle['longitude'],
+                nearby['lat'], nearby['lon']
+            )
+            
+            # Predicted arrival from trip updates; rough estimate at an
+            # average bus speed of 25 km/h when the trip has none
+            predicted = predictions.eta(vehicle['trip_id'], stop_id)
+            if predicted is not None:
+                if predicted < now - 60:
+                    continue  # Already passed this stop
+                eta_minutes = max(0, int((predicted - now) // 60))
+            else:
+                eta_minutes = int((bus_to_stop_dist / 25) * 60)
+            
+            if eta_minutes <= 30:  # Only show buses within 30 min
+                nearby_buses.append({
+                    'vehicle_id': vehicle['vehicle_id'],
+                    'route_number': info['route_number'],
+                    'route_name': info['route_name'],
+                    'route_color': info['route_color'],
+                    'headsign': info['headsign'],
+                    'stop_id': stop_id,
+                    'stop_name': nearby['name'],
+                    'stop_distance_from_user': nearby['distance'],
+                    'bus_distance_from_stop': round(bus_to_stop_dist, 2),
+                    'eta_minutes': eta_minutes,
+                    'eta_source': 'realtime' if predicted is not None else 'estimate',
+                    'predicted_arrival': datetime.fromtimestamp(predicted).strftime('%H:%M:%S') if predicted else None,
+                    'vehicle_lat': vehicle['latitude'],
+                    'vehicle_lon': vehicle['longitude'],
+                    'occupancy': vehicle['occupancy_status']
+                })
     
     # Sort by ETA
     nearby_buses.sort(key=lambda x: x['eta_minutes'])
@@ -696,30 +952,42 @@ def api_nearby_buses():
 
 def background_update_worker():
     """
-    Background worker that fetches fresh real-time data every 30 seconds
+    Background worker that fetches fresh real-time data every REFRESH_SECONDS
     """
-    global last_update_time, worker_running
+    global last_update_time, worker_running, last_cycle_at, next_update_at
     
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] Background worker started (updates every 30 seconds)")
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Background worker started (updates every {REFRESH_SECONDS} seconds)")
     
     while worker_running:
         try:
-            with update_lock:
-                print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Background update starting...")
-                results = update_all_realtime_data()
-                
-                if results['success']:
-                    last_update_time = datetime.now()
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Background update complete")
-                    print(f"   Vehicles: {results['vehicles']}, Trips: {results['trip_updates']}, Alerts: {results['alerts']}")
-                else:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Background update had errors: {results['errors']}")
+            print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Background update starting...")
+            results = update_all_realtime_data(write_queue=writes)
+            last_cycle_at = time.time()
+            
+            if results['success']:
+                last_update_time = datetime.now()
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ✅ Background update complete")
+                print(f"   Vehicles: {results['vehicles']}, Trips: {results['trip_updates']}, Alerts: {results['alerts']}")
+                if results['unchanged']:
+                    print(f"   Unchanged (skipped): {', '.join(results['unchanged'])}")
+            else:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] ⚠️  Background update had errors: {results['errors']}")
         
         except Exception as e:
             print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Background update error: {e}")
         
-        # Wait 30 seconds before next update
-        time.sleep(30)
+        # Push even after a failed cycle, so clients see the data ageing
+        try:
+            publish_live_update()
+        except Exception as e:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] ❌ Live push error: {e}")
+        
+        # Pick up a fresh static feed from load_gtfs.py even when idle
+        check_db_generation()
+        
+        # Wait before next update; realtime responses may be cached until then
+        next_update_at = time.time() + REFRESH_SECONDS
+        time.sleep(REFRESH_SECONDS)
 
 
 def start_background_worker():
@@ -732,15 +1000,15 @@ def start_background_worker():
 
 
 def stop_background_worker():
-    """Stop the background update worker"""
+    """Stop the background update worker, then the database writer"""
     global worker_running
     worker_running = False
     if background_worker:
         background_worker.join(timeout=5)
+    writes.stop()
 
 
 if __name__ == '__main__':
-    import os
     import atexit
     
     # Check if database exists
@@ -762,9 +1030,16 @@ if __name__ == '__main__':
     print("   Press Ctrl+C to stop")
     print()
     
+    # Load the static timetable into memory
+    print("🗓️  Loading timetable...")
+    db_generation = get_db_generation()
+    print(f"✅ Timetable ready: {get_timetable(DB_FILE).stats()}")
+    print()
+    
     # Initial data update
     print("📥 Performing initial real-time data update...")
-    initial_results = update_all_realtime_data()
+    initial_results = update_all_realtime_data(write_queue=writes)
+    last_cycle_at = time.time()
     if initial_results['success']:
         last_update_time = datetime.now()
         print(f"✅ Initial update complete: {initial_results['vehicles']} vehicles loaded")
@@ -1,7 +1,10 @@
 // Global variables
 let map;
-let busMarkers = [];
+let busMarkers = new Map(); // vehicle_id -> { marker, vehicle }
+let vehiclesVersion = null;  // Version of the vehicles on the map
+let vehiclesRoute = '';      // Route filter they were loaded with
 let autoRefreshInterval;
+let vehicleStream = null;
 let currentTab = 'live';
 let highlightedBuses = new Set();
 let userLocation = null;
@@ -256,7 +259,7 @@ document.getElementById('routeForm').addEventListener('submit', async (e) => {
     resultsDiv.innerHTML = '<div class="loading"><div class="spinner"></div>Searching routes...</div>';
 
     try {
-        const response = await fetch('/api/find-route', {
+        const response = await fetch('/api/plan', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -270,7 +273,7 @@ document.getElementById('routeForm').addEventListener('submit', async (e) => {
         });
 
         const data = await response.json();
-        displayResults(data);
+        displayJourneys(data);
 
     } catch (error) {
         console.error('Error:', error);
@@ -309,6 +312,45 @@ function displayResults(data) {
     }
 }
 
+// Display planned journeys (one card per journey, one line per leg)
+function displayJourneys(data) {
+    const resultsDiv = document.getElementById('results');
+
+    if (!data.journeys || data.journeys.length === 0) {
+        displayResults(data);
+        return;
+    }
+
+    let html = '<div class="result-section"><h3>Journeys</h3>';
+
+    data.journeys.forEach(journey => {
+        const transfers = journey.transfers === 1 ? '1 transfer' : `${journey.transfers} transfers`;
+        const legs = journey.legs.map(leg => {
+            if (leg.type === 'walk') {
+                return `🚶 Walk ${leg.duration_minutes} min to ${leg.dest_stop}`;
+            }
+            return `🚌 Route ${leg.route_number} ${leg.departure_time} → ${leg.arrival_time}<br>
+                    <small>${leg.source_stop} → ${leg.dest_stop} (${leg.stops_count} stops)</small>`;
+        }).join('<br>');
+
+        html += `
+            <div class="route-option">
+                <div class="route-header">
+                    <span class="route-number">${journey.departure_time} → ${journey.arrival_time}</span>
+                    <span class="route-time">${journey.duration_minutes} min</span>
+                </div>
+                <div class="route-details">
+                    ${transfers}<br>
+                    ${legs}
+                </div>
+            </div>
+        `;
+    });
+
+    html += '</div>';
+    resultsDiv.innerHTML = html;
+}
+
 // Load routes into memory
 async function loadRoutes() {
     try {
@@ -338,6 +380,7 @@ function setupRouteAutocomplete() {
             clearBtn.classList.remove('show');
             hiddenInput.value = '';
             loadVehicles(); // Load all vehicles
+            startAutoRefresh();
             return;
         }
 
@@ -347,6 +390,7 @@ function setupRouteAutocomplete() {
         if (query === 'all') {
             hiddenInput.value = '';
             loadVehicles();
+            startAutoRefresh();
             resultsDiv.classList.remove('show');
             return;
         }
@@ -420,6 +464,7 @@ function selectRoute(routeId, routeNumber, routeName) {
     document.getElementById('routeFilterSearch').nextElementSibling.classList.add('show');
     loadVehicles(); // Reload vehicles with filter
     loadAlerts(); // Reload alerts with filter
+    startAutoRefresh(); // Follow the route's live topic
 }
 
 function clearRouteFilter() {
@@ -429,6 +474,7 @@ function clearRouteFilter() {
     document.getElementById('routeFilterSearch').nextElementSibling.classList.remove('show');
     loadVehicles(); // Reload all vehicles
     loadAlerts(); // Reload all alerts
+    startAutoRefresh();
 }
 
 // Select route from alert click
@@ -451,40 +497,102 @@ async function selectRouteFromAlert(routeId) {
     }
 }
 
-// Load vehicles (buses)
+// Load vehicles (buses); only the changes when the map is already populated
 async function loadVehicles() {
     const routeId = document.getElementById('routeFilter').value;
-    const url = routeId ? `/api/vehicles?route_id=${routeId}` : '/api/vehicles';
+    const params = new URLSearchParams();
+    if (routeId) {
+        params.set('route_id', routeId);
+    }
+    if (vehiclesVersion !== null && routeId === vehiclesRoute) {
+        params.set('since', vehiclesVersion);
+    }
+    const query = params.toString();
 
     try {
-        const response = await fetch(url);
+        const response = await fetch(query ? `/api/vehicles?${query}` : '/api/vehicles');
         const data = await response.json();
-        const vehicles = data.vehicles || data; // Handle both formats
+        applyVehicles(data, routeId);
 
-        clearBusMarkers();
+    } catch (error) {
+        console.error('Error loading vehicles:', error);
+        document.getElementById('apiStatusAlert').style.display = 'block';
+    }
+}
 
-        if (vehicles.length === 0) {
-            document.getElementById('apiStatusAlert').style.display = 'block';
-        } else {
-            document.getElementById('apiStatusAlert').style.display = 'none';
+// Apply a full or delta vehicles response to the markers on the map
+// Returns false for a delta that doesn't start from the version shown
+function applyVehicles(data, routeId) {
+    if (data.full === false) {
+        if (routeId !== vehiclesRoute) {
+            return false;
         }
-
-        vehicles.forEach(vehicle => {
-            if (vehicle.latitude && vehicle.longitude) {
-                createBusMarker(vehicle);
+        if (data.version === vehiclesVersion) {
+            return true; // Already up to date
+        }
+        if (data.since !== vehiclesVersion) {
+            return false;
+        }
+        data.removed.forEach(vehicleId => {
+            const bus = busMarkers.get(vehicleId);
+            if (bus) {
+                bus.marker.remove();
+                busMarkers.delete(vehicleId);
             }
         });
+    } else {
+        clearBusMarkers();
+    }
 
-        console.log(`Loaded ${vehicles.length} vehicles`);
+    const vehicles = data.vehicles || data; // Handle both formats
+    vehicles.forEach(vehicle => updateBusMarker(vehicle));
+    vehiclesVersion = data.version ?? null;
+    vehiclesRoute = routeId;
 
-    } catch (error) {
-        console.error('Error loading vehicles:', error);
+    if (busMarkers.size === 0) {
         document.getElementById('apiStatusAlert').style.display = 'block';
+    } else {
+        document.getElementById('apiStatusAlert').style.display = 'none';
+    }
+
+    console.log(`Applied ${vehicles.length} vehicles (${busMarkers.size} on map)`);
+    return true;
+}
+
+// Move or redraw a vehicle's marker, creating it if needed
+function updateBusMarker(vehicle) {
+    const bus = busMarkers.get(vehicle.vehicle_id);
+
+    if (!vehicle.latitude || !vehicle.longitude) {
+        if (bus) {
+            bus.marker.remove();
+            busMarkers.delete(vehicle.vehicle_id);
+        }
+        return;
+    }
+
+    if (bus) {
+        bus.marker.setLatLng([vehicle.latitude, vehicle.longitude]);
+        bus.marker.setIcon(busIcon(vehicle));
+        bus.marker.setPopupContent(busPopup(vehicle));
+        bus.vehicle = vehicle;
+    } else {
+        createBusMarker(vehicle);
     }
 }
 
 // Create bus marker
 function createBusMarker(vehicle) {
+    const marker = L.marker([vehicle.latitude, vehicle.longitude], { icon: busIcon(vehicle) })
+        .addTo(map);
+
+    marker.bindPopup(busPopup(vehicle));
+
+    busMarkers.set(vehicle.vehicle_id, { marker, vehicle });
+}
+
+// Bus icon: direction arrow, bus and route badge
+function busIcon(vehicle) {
     const isHighlighted = highlightedBuses.has(vehicle.vehicle_id);
 
     // Determine direction from headsign
@@ -535,7 +643,7 @@ function createBusMarker(vehicle) {
         }
     }
 
-    const busIcon = L.divIcon({
+    return L.divIcon({
         className: 'bus-marker',
         html: `<div style="
             display: flex;
@@ -567,10 +675,10 @@ function createBusMarker(vehicle) {
         iconSize: [55, 20],
         iconAnchor: [27, 10]
     });
+}
 
-    const marker = L.marker([vehicle.latitude, vehicle.longitude], { icon: busIcon })
-        .addTo(map);
-
+// Bus popup: route, headsign, speed and occupancy
+function busPopup(vehicle) {
     let popupContent = `
         <strong>Bus ${vehicle.vehicle_id}</strong><br>
         Route: ${vehicle.route_number || vehicle.route_id} - ${vehicle.route_name || 'N/A'}<br>
@@ -591,15 +699,14 @@ function createBusMarker(vehicle) {
         popupContent += `<br>${occupancyMap[vehicle.occupancy] || vehicle.occupancy}`;
     }
 
-    marker.bindPopup(popupContent);
-
-    busMarkers.push({ marker, vehicle });
+    return popupContent;
 }
 
 // Clear bus markers
 function clearBusMarkers() {
     busMarkers.forEach(({ marker }) => marker.remove());
-    busMarkers = [];
+    busMarkers = new Map();
+    vehiclesVersion = null;
 }
 
 // Load service alerts
@@ -757,12 +864,13 @@ function highlightNearbyBuses(buses) {
     buses.forEach(bus => {
         highlightedBuses.add(bus.vehicle_id);
     });
-    loadVehicles(); // Reload to apply highlighting
+    // Redraw icons to apply highlighting
+    busMarkers.forEach(({ marker, vehicle }) => marker.setIcon(busIcon(vehicle)));
 }
 
 // Focus on a specific bus
 function focusBusOnMap(vehicleId) {
-    const busData = busMarkers.find(b => b.vehicle.vehicle_id === vehicleId);
+    const busData = busMarkers.get(vehicleId);
     if (busData) {
         map.setView([busData.vehicle.latitude, busData.vehicle.longitude], 16);
         busData.marker.openPopup();
@@ -871,43 +979,67 @@ function showMyLocation() {
 async function updateDataFreshness() {
     try {
         const response = await fetch('/api/data-freshness');
-        const data = await response.json();
+        renderDataFreshness(await response.json());
 
-        const freshnessDiv = document.getElementById('dataFreshness');
-        const freshnessText = document.getElementById('freshnessText');
+    } catch (error) {
+        console.error('Error updating freshness:', error);
+        document.getElementById('freshnessText').textContent = '❌ Error';
+    }
+}
 
-        // Convert seconds to minutes
-        const ageSeconds = data.data_age_seconds;
+function renderDataFreshness(data) {
+    const freshnessDiv = document.getElementById('dataFreshness');
+    const freshnessText = document.getElementById('freshnessText');
 
-        if (!ageSeconds && ageSeconds !== 0) {
-            freshnessText.textContent = '⚠️ No data';
-            freshnessDiv.className = 'data-freshness very-stale';
-            return;
-        }
+    // Convert seconds to minutes
+    const ageSeconds = data.data_age_seconds;
 
-        const ageMinutes = ageSeconds / 60;
+    if (!ageSeconds && ageSeconds !== 0) {
+        freshnessText.textContent = '⚠️ No data';
+        freshnessDiv.className = 'data-freshness very-stale';
+        return;
+    }
 
-        if (ageMinutes < 2) {
-            freshnessDiv.className = 'data-freshness fresh';
-            freshnessText.textContent = `🟢 Live (${Math.round(ageMinutes)}m ago)`;
-        } else if (ageMinutes < 5) {
-            freshnessDiv.className = 'data-freshness stale';
-            freshnessText.textContent = `🟡 ${Math.round(ageMinutes)}m ago`;
-        } else {
-            freshnessDiv.className = 'data-freshness very-stale';
-            freshnessText.textContent = `🔴 ${Math.round(ageMinutes)}m ago`;
-        }
+    const ageMinutes = ageSeconds / 60;
 
-    } catch (error) {
-        console.error('Error updating freshness:', error);
-        document.getElementById('freshnessText').textContent = '❌ Error';
+    if (ageMinutes < 2) {
+        freshnessDiv.className = 'data-freshness fresh';
+        freshnessText.textContent = `🟢 Live (${Math.round(ageMinutes)}m ago)`;
+    } else if (ageMinutes < 5) {
+        freshnessDiv.className = 'data-freshness stale';
+        freshnessText.textContent = `🟡 ${Math.round(ageMinutes)}m ago`;
+    } else {
+        freshnessDiv.className = 'data-freshness very-stale';
+        freshnessText.textContent = `🔴 ${Math.round(ageMinutes)}m ago`;
     }
 }
 
-// Auto-refresh
+// Auto-refresh: the server pushes vehicles after every update cycle;
+// browsers without EventSource fall back to polling
 function startAutoRefresh() {
     if (autoRefreshInterval) {
         clearInterval(autoRefreshInterval);
+        autoRefreshInterval = null;
+    }
+    if (vehicleStream) {
+        vehicleStream.close();
+        vehicleStream = null;
+    }
+
+    if (window.EventSource) {
+        const routeId = document.getElementById('routeFilter').value;
+        const url = routeId ? `/api/stream?route_id=${encodeURIComponent(routeId)}` : '/api/stream';
+        vehicleStream = new EventSource(url);
+        vehicleStream.addEventListener('vehicles', (event) => {
+            if (currentTab === 'live') {
+                const data = JSON.parse(event.data);
+                if (!applyVehicles(data, document.getElementById('routeFilter').value)) {
+                    loadVehicles(); // Missed a push: catch up from our version
+                }
+                renderDataFreshness(data.freshness);
+            }
+        });
+        return;
     }
 
     autoRefreshInterval = setInterval(() => {
@@ -924,8 +1056,12 @@ document.addEventListener('DOMContentLoaded', () => {
     loadStops();
     updateDataFreshness();
 
-    // Update freshness every 30 seconds
-    setInterval(updateDataFreshness, 30000);
+    // Update freshness every 30 seconds, unless the live stream delivers it
+    setInterval(() => {
+        if (!vehicleStream) {
+            updateDataFreshness();
+        }
+    }, 30000);
 });
 
 
@@ -0,0 +1,76 @@
+"""
+Live Update Broadcaster
+Fans serialized updates from the background worker out to streaming clients
+"""
+
+import queue
+import threading
+
+# Messages a slow client may fall behind by before old ones are dropped
+SUBSCRIBER_BACKLOG = 4
+
+
+class Broadcaster:
+    """
+    Topic-based publish/subscribe for Server-Sent Events
+    publish() is given an already serialized message, so the cost of a cycle
+    depends on the number of topics, not the number of subscribers; the last
+    message per topic is kept so new subscribers start with current data
+    """
+
+    def __init__(self):
+        self.subscribers = {}  # topic -> set of queues
+        self.latest = {}       # topic -> last message
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic):
+        """Register a subscriber queue, primed with the topic's latest message"""
+        q = queue.Queue(maxsize=SUBSCRIBER_BACKLOG)
+        with self._lock:
+            self.subscribers.setdefault(topic, set()).add(q)
+            if topic in self.latest:
+                q.put_nowait(self.latest[topic])
+        return q
+
+    def unsubscribe(self, topic, q):
+        """Forget a subscriber queue"""
+        with self._lock:
+            subscribers = self.subscribers.get(topic)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self.subscribers[topic]
+
+    def publish(self, messages):
+        """Deliver {topic: message}; these become the retained messages"""
+        with self._lock:
+            self.latest = dict(messages)
+            targets = [(q, messages[topic]) for topic, subscribers in self.subscribers.items()
+                       if topic in messages for q in subscribers]
+
+        for q, message in targets:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # Slow client: drop its oldest message rather than block the worker
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(message)
+                except queue.Full:
+                    pass
+
+    def topics(self):
+        """Topics that currently have subscribers"""
+        with self._lock:
+            return set(self.subscribers)
+
+    def stats(self):
+        """Subscriber counts for status pages"""
+        with self._lock:
+            return {
+                'topics': len(self.subscribers),
+                'subscribers': sum(len(s) for s in self.subscribers.values())
+            }
@@ -0,0 +1,317 @@
+"""
+SQLite Connection Manager
+Reusable read-only connections for request handlers and background threads,
+plus one dedicated writer connection and the queue that feeds it
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+DB_FILE = 'miway.db'
+
+# Prepared statements kept per connection; handlers run the same few queries
+STATEMENT_CACHE_SIZE = 256
+
+# Readers can never write, map the file instead of copying pages through
+# read() calls, and keep a larger page cache since connections live long
+READ_PRAGMAS = [
+    "PRAGMA query_only = ON",
+    "PRAGMA mmap_size = 268435456",  # 256 MB
+    "PRAGMA cache_size = -16384",    # 16 MB
+    "PRAGMA temp_store = MEMORY",
+]
+# The writer puts the database in WAL mode (persistent), so readers never wait
+# for a write and a write never waits for readers. synchronous = NORMAL is
+# still crash-safe in WAL mode. Automatic checkpoints are off: WriteQueue runs
+# them between batches instead of inside a commit.
+WRITE_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA wal_autocheckpoint = 0",
+    "PRAGMA journal_size_limit = 67108864",  # 64 MB left on disk after a truncate
+    "PRAGMA cache_size = -16384",
+    "PRAGMA temp_store = MEMORY",
+]
+
+# Idle pooled readers kept for the next request
+POOL_SIZE = 8
+
+# How long a connection waits on a locked database before failing; shared by
+# the app and the scripts that write while it runs (ingest, health checks)
+BUSY_TIMEOUT_SECONDS = 10
+
+# Jobs committed together at most; whatever is queued when the writer wakes up
+MAX_BATCH_JOBS = 64
+
+# WAL checkpoints: truncate the log if readers kept a passive checkpoint from
+# catching up by this many pages, and at least this often anyway
+CHECKPOINT_BACKLOG_PAGES = 4096
+TRUNCATE_SECONDS = 300
+
+
+class ConnectionManager:
+    """
+    Hands out long-lived connections to one database file
+    - acquire()/release(): pooled readers, one per in-flight request
+    - thread_reader(): a reader owned by a long-lived background thread
+    - writer(): the single writer connection; only WriteQueue's thread uses it
+    invalidate() retires every connection after load_gtfs.py swaps in a new
+    feed, so no connection keeps statements or pages from the old one.
+    Every connection counts how often it is handed out, for stats().
+    """
+
+    def __init__(self, db_file=DB_FILE, pool_size=POOL_SIZE, row_factory=sqlite3.Row):
+        self.db_file = db_file
+        self.pool_size = pool_size
+        self.row_factory = row_factory
+        self.epoch = 0
+        self.pool = []
+        self.metrics = {}  # id(conn) -> {'role', 'epoch', 'opened_at', 'uses'}
+        self.opened = 0
+        self.closed = 0
+        self._writer = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _open(self, role, pragmas):
+        # The writer manages its transactions explicitly (see WriteQueue)
+        conn = sqlite3.connect(self.db_file, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE,
+                               isolation_level=None if role == 'writer' else '')
+        if role != 'writer':
+            conn.row_factory = self.row_factory
+        for pragma in pragmas:
+            conn.execute(pragma)
+        with self._lock:
+            self.opened += 1
+            self.metrics[id(conn)] = {'role': role, 'epoch': self.epoch, 'opened_at': time.time(), 'uses': 0}
+        return conn
+
+    def _close(self, conn):
+        with self._lock:
+            self.metrics.pop(id(conn), None)
+            self.closed += 1
+        conn.close()
+
+    def _use(self, conn):
+        """Count a hand-out; returns False if the connection predates invalidate()"""
+        with self._lock:
+            metrics = self.metrics.get(id(conn))
+            if metrics is None or metrics['epoch'] != self.epoch:
+                return False
+            metrics['uses'] += 1
+            return True
+
+    def acquire(self):
+        """A pooled read-only connection; give it back with release()"""
+        while True:
+            with self._lock:
+                conn = self.pool.pop() if self.pool else None
+            if conn is None:
+                conn = self._open('reader', READ_PRAGMAS)
+            if self._use(conn):
+                return conn
+            self._close(conn)
+
+    def release(self, conn):
+        """Return a reader to the pool (or close it if the pool is full or stale)"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            metrics = self.metrics.get(id(conn))
+            if metrics is not None and metrics['epoch'] == self.epoch and len(self.pool) < self.pool_size:
+                self.pool.append(conn)
+                return
+        self._close(conn)
+
+    def thread_reader(self):
+        """The calling thread's own read-only connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._use(conn):
+            return conn
+        if conn is not None:
+            self._close(conn)
+        conn = self._local.conn = self._open('thread', READ_PRAGMAS)
+        self._use(conn)
+        return conn
+
+    def writer(self):
+        """The dedicated writer connection, for WriteQueue's thread"""
+        conn = self._writer
+        if conn is not None and self._use(conn):
+            return conn
+        if conn is not None:
+            self._close(conn)
+        conn = self._writer = self._open('writer', WRITE_PRAGMAS)
+        self._use(conn)
+        return conn
+
+    def invalidate(self):
+        """The database file was replaced: retire all connections to the old one"""
+        with self._lock:
+            self.epoch += 1
+            idle, self.pool = self.pool, []
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        """Connection counts and reuse, for status pages and logs"""
+        with self._lock:
+            live = list(self.metrics.values())
+            opened, closed, pooled = self.opened, self.closed, len(self.pool)
+        now = time.time()
+        uses = sum(m['uses'] for m in live)
+        return {
+            'opened': opened,
+            'closed': closed,
+            'pooled': pooled,
+            'reuse_ratio': round(uses / len(live), 1) if live else 0,
+            'connections': [
+                {'role': m['role'], 'uses': m['uses'], 'age_seconds': int(now - m['opened_at'])}
+                for m in live
+            ]
+        }
+
+
+class WriteQueue:
+    """
+    The app's single database writer
+    submit(job) queues job(conn) for the writer thread and returns a Future.
+    Jobs queued together run in one transaction, each inside a savepoint so a
+    failing job is rolled back alone, and the batch commits once; futures
+    resolve only after the commit. Between batches the WAL is checkpointed
+    (PASSIVE, which never waits for readers) and truncated when readers held
+    it back for CHECKPOINT_BACKLOG_PAGES or TRUNCATE_SECONDS have passed.
+    """
+
+    def __init__(self, connect, max_batch=MAX_BATCH_JOBS):
+        self.connect = connect  # Returns the writer connection, e.g. ConnectionManager.writer
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.batches = 0
+        self.committed = 0
+        self.failed = 0
+        self.checkpoints = 0
+        self.truncates = 0
+        self.wal_pages = 0
+        self.last_batch_seconds = None
+        self.last_truncate_at = time.time()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue job(conn); the writer thread starts on first use"""
+        future = Future()
+        self.jobs.put((job, future))
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+        return future
+
+    def run(self, job, timeout=None):
+        """Queue job(conn) and wait for it to commit; returns its result or raises its error"""
+        return self.submit(job).result(timeout)
+
+    def stop(self, timeout=5):
+        """Let queued jobs finish, then end the writer thread"""
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self.jobs.put(None)
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                conn = self.connect()
+            except Exception as e:
+                for _, future in batch:
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(e)
+                continue
+            self._run_batch(conn, batch)
+            self._checkpoint(conn)
+            if stopping:
+                return
+
+    def _run_batch(self, conn, batch):
+        started = time.time()
+        batch = [(job, future) for job, future in batch if future.set_running_or_notify_cancel()]
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = job(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    future.set_exception(e)
+                    self.failed += 1
+                else:
+                    conn.execute("RELEASE job")
+                    results.append((future, result))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+                    self.failed += 1
+            return
+
+        for future, result in results:
+            future.set_result(result)
+        self.batches += 1
+        self.committed += len(results)
+        self.last_batch_seconds = round(time.time() - started, 3)
+
+    def _checkpoint(self, conn):
+        try:
+            busy, log_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            self.checkpoints += 1
+            self.wal_pages = max(log_pages - checkpointed, 0)
+            if self.wal_pages >= CHECKPOINT_BACKLOG_PAGES or time.time() - self.last_truncate_at >= TRUNCATE_SECONDS:
+                # Waits (busy timeout) for readers on old snapshots; requests keep reading meanwhile
+                busy, log_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+                if not busy:
+                    self.truncates += 1
+                    self.wal_pages = 0
+                    self.last_truncate_at = time.time()
+        except sqlite3.Error as e:
+            print(f"  Warning: WAL checkpoint failed: {e}")
+
+    def stats(self):
+        """Queue depth, batching and checkpoint counters, for status pages"""
+        return {
+            'queued': self.jobs.qsize(),
+            'batches': self.batches,
+            'committed': self.committed,
+            'failed': self.failed,
+            'jobs_per_batch': round(self.committed / self.batches, 2) if self.batches else 0,
+            'last_batch_seconds': self.last_batch_seconds,
+            'checkpoints': self.checkpoints,
+            'truncates': self.truncates,
+            'wal_pages': self.wal_pages,
+        }
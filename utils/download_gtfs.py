@@ -5,6 +5,7 @@ Fetches both static and real-time data
 
 import requests
 import zipfile
+import hashlib
 import os
 import shutil
 from datetime import datetime
@@ -52,11 +53,45 @@ def download_file(url, filename, description):
         return None
 
 
+def file_sha256(f):
+    """SHA-256 of an open binary file"""
+    digest = hashlib.sha256()
+    for block in iter(lambda: f.read(1024 * 1024), b''):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def changed_static_files(zip_ref):
+    """Files in the zip that differ from (or are missing in) the extracted copy"""
+    changed = []
+    for name in zip_ref.namelist():
+        path = os.path.join(STATIC_DIR, name)
+        if not os.path.exists(path):
+            changed.append(name)
+            continue
+        with zip_ref.open(name) as new, open(path, 'rb') as old:
+            if file_sha256(new) != file_sha256(old):
+                changed.append(name)
+    return changed
+
+
 def extract_static_gtfs(zip_path):
     """Extract google_transit.zip to google_transit folder"""
     print(f"📦 Extracting GTFS static data...")
     
     try:
+        # Compare per-file checksums; an identical feed is left alone so
+        # load_gtfs.py sees nothing to do
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            changed = changed_static_files(zip_ref)
+            stale = set(os.listdir(STATIC_DIR)) - set(zip_ref.namelist()) if os.path.exists(STATIC_DIR) else set()
+        
+        if not changed and not stale:
+            print("✅ Static GTFS unchanged, keeping current files\n")
+            return True
+        
+        print(f"   Changed files: {', '.join(sorted(changed + list(stale)))}")
+        
         # Backup old data if exists
         if os.path.exists(STATIC_DIR) and os.listdir(STATIC_DIR):
             backup_dir = f"{STATIC_DIR}_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
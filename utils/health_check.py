@@ -9,6 +9,14 @@ from datetime import datetime
 import json
 import os
 import sqlite3
+import sys
+
+try:
+    from utils.db import BUSY_TIMEOUT_SECONDS
+except ImportError:
+    # Run as `python3 utils/health_check.py`: the package lives one level up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.db import BUSY_TIMEOUT_SECONDS
 
 # MiWay Endpoints
 ENDPOINTS = {
@@ -167,9 +175,9 @@ def print_result(result):
 
 
 def save_to_database(results):
-    """Save results to database"""
+    """Save results to database, all rows in one transaction"""
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT_SECONDS)
         cursor = conn.cursor()
         
         timestamp = datetime.now().isoformat()
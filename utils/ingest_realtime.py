@@ -7,52 +7,70 @@ import sqlite3
 from google.transit import gtfs_realtime_pb2
 from datetime import datetime
 import os
+import time
+import sys
+
+try:
+    from utils.db import BUSY_TIMEOUT_SECONDS
+except ImportError:
+    # Run as `python3 utils/ingest_realtime.py`: the package lives one level up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.db import BUSY_TIMEOUT_SECONDS
 
 DB_FILE = 'miway.db'
 
+
 # GTFS-Realtime file paths
 ALERTS_FILE = 'Alerts.pb'
 TRIP_UPDATES_FILE = 'TripUpdates.pb'
 VEHICLE_POSITIONS_FILE = 'VehiclePositions.pb'
 
 
-def create_realtime_tables(conn):
-    """Create tables for storing real-time data"""
-    cursor = conn.cursor()
-    
-    print("Creating real-time data tables...")
-    
+# Realtime data is stored as snapshots. Every table of a feed lives in a fixed
+# "<table>_data" table with a generation column, and the public table name is a
+# view showing only the generation realtime_snapshots points at. A cycle writes
+# the next generation, moves the pointer and deletes the older rows, all in one
+# transaction, so readers always see one complete feed and the schema (and the
+# connections' prepared statements) never changes from cycle to cycle.
+SNAPSHOT_FEEDS = {
+    'alerts': ['alerts', 'alert_affected_entities'],
+    'trip_updates': ['trip_updates', 'stop_time_updates'],
+    'vehicle_positions': ['vehicle_positions'],
+}
+
+SNAPSHOT_SCHEMA = {
     # Service Alerts table
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS alerts (
-            alert_id TEXT PRIMARY KEY,
+    'alerts': """
+        CREATE TABLE {name} (
+            generation INTEGER NOT NULL,
+            alert_id TEXT NOT NULL,
             cause TEXT,
             effect TEXT,
             header_text TEXT,
             description_text TEXT,
             url TEXT,
             timestamp INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (generation, alert_id)
         )
-    """)
-    
+    """,
     # Affected entities for alerts (which routes/stops/trips are affected)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS alert_affected_entities (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+    'alert_affected_entities': """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY,
+            generation INTEGER NOT NULL,
             alert_id TEXT,
             entity_type TEXT,
             route_id TEXT,
             trip_id TEXT,
-            stop_id TEXT,
-            FOREIGN KEY (alert_id) REFERENCES alerts(alert_id)
+            stop_id TEXT
         )
-    """)
-    
+    """,
     # Trip Updates table (real-time arrival/departure predictions)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS trip_updates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+    'trip_updates': """
+        CREATE TABLE {name} (
+            generation INTEGER NOT NULL,
+            id INTEGER NOT NULL,
             trip_id TEXT,
             route_id TEXT,
             start_date TEXT,
@@ -60,14 +78,15 @@ def create_realtime_tables(conn):
             schedule_relationship TEXT,
             timestamp INTEGER,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (generation, id),
             FOREIGN KEY (trip_id) REFERENCES trips(trip_id)
         )
-    """)
-    
+    """,
     # Stop Time Updates (predictions for specific stops)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS stop_time_updates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+    'stop_time_updates': """
+        CREATE TABLE {name} (
+            id INTEGER PRIMARY KEY,
+            generation INTEGER NOT NULL,
             trip_update_id INTEGER,
             stop_sequence INTEGER,
             stop_id TEXT,
@@ -76,15 +95,14 @@ def create_realtime_tables(conn):
             departure_delay INTEGER,
             departure_time INTEGER,
             schedule_relationship TEXT,
-            FOREIGN KEY (trip_update_id) REFERENCES trip_updates(id),
             FOREIGN KEY (stop_id) REFERENCES stops(stop_id)
         )
-    """)
-    
+    """,
     # Vehicle Positions table (live bus locations)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS vehicle_positions (
-            vehicle_id TEXT PRIMARY KEY,
+    'vehicle_positions': """
+        CREATE TABLE {name} (
+            generation INTEGER NOT NULL,
+            vehicle_id TEXT NOT NULL,
             trip_id TEXT,
             route_id TEXT,
             latitude REAL,
@@ -97,19 +115,137 @@ def create_realtime_tables(conn):
             occupancy_status TEXT,
             timestamp INTEGER,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (generation, vehicle_id),
             FOREIGN KEY (trip_id) REFERENCES trips(trip_id),
             FOREIGN KEY (current_stop_id) REFERENCES stops(stop_id)
         )
+    """,
+}
+
+# Indexed columns per snapshot table, each behind the generation column
+SNAPSHOT_INDEXES = {
+    'alerts': ['timestamp'],
+    'alert_affected_entities': ['alert_id', 'route_id'],
+    'trip_updates': ['trip_id', 'route_id'],
+    'stop_time_updates': ['trip_update_id', 'stop_id'],
+    'vehicle_positions': ['trip_id', 'route_id'],
+}
+
+
+# Trip update retention. The hot trip_updates snapshot keeps one (the latest)
+# update per trip: trips missing from a new feed are carried over for
+# hot_trip_seconds after their last update, then dropped with the generation.
+# Optionally a compact delay history (one row per trip per new prediction,
+# next stop only) is kept for history_seconds and pruned in indexed batches.
+RETENTION = {
+    'hot_trip_seconds': 2 * 3600,
+    'history': False,
+    'history_seconds': 24 * 3600,
+    'delete_batch_rows': 5000,
+    'max_delete_batches': 20,
+}
+
+
+def ensure_realtime_schema(conn):
+    """
+    Make sure the snapshot pointer table, the data tables and the public
+    views exist. Databases from before fixed data tables are migrated: the
+    rows the public name shows become the current generation, and the old
+    per-generation tables are dropped. The caller commits, together with the
+    cycle's writes
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS realtime_snapshots (
+            feed TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL,
+            published_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
     """)
     
-    # Create indexes
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_alerts_timestamp ON alerts(timestamp)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trip_updates_trip ON trip_updates(trip_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trip_updates_route ON trip_updates(route_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vehicle_positions_trip ON vehicle_positions(trip_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_vehicle_positions_route ON vehicle_positions(route_id)")
+    for feed, tables in SNAPSHOT_FEEDS.items():
+        row = cursor.execute("SELECT generation FROM realtime_snapshots WHERE feed = ?", (feed,)).fetchone()
+        if row is None:
+            cursor.execute("INSERT INTO realtime_snapshots (feed, generation) VALUES (?, 0)", (feed,))
+        generation = row[0] if row else 0
+        
+        for table in tables:
+            data = f"{table}_data"
+            if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (data,)).fetchone():
+                continue
+            
+            cursor.execute(SNAPSHOT_SCHEMA[table].format(name=data))
+            for column in SNAPSHOT_INDEXES[table]:
+                cursor.execute(f"CREATE INDEX idx_{data}_{column} ON {data}(generation, {column})")
+            columns = [info[1] for info in cursor.execute(f"PRAGMA table_info({data})") if info[1] != 'generation']
+            column_list = ', '.join(columns)
+            
+            # A table from before snapshots, or a view over a generation table
+            existing = cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+            if existing:
+                cursor.execute(f"INSERT INTO {data} (generation, {column_list}) SELECT ?, {column_list} FROM {table}",
+                               (generation,))
+                cursor.execute(f"DROP {existing[0].upper()} {table}")
+            for (old,) in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB ?",
+                                         (f"{table}_g[0-9]*",)).fetchall():
+                cursor.execute(f"DROP TABLE {old}")
+            
+            cursor.execute(f"""
+                CREATE VIEW {table} AS SELECT {column_list} FROM {data}
+                WHERE generation = (SELECT generation FROM realtime_snapshots WHERE feed = '{feed}')
+            """)
+    
+    # Compact trip delay history (only written when RETENTION['history'] is on)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS trip_delay_history (
+            trip_id TEXT NOT NULL,
+            route_id TEXT,
+            start_date TEXT,
+            observed_at INTEGER NOT NULL,
+            stop_sequence INTEGER,
+            stop_id TEXT,
+            arrival_delay INTEGER,
+            departure_delay INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trip_delay_history_observed ON trip_delay_history(observed_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_trip_delay_history_trip ON trip_delay_history(trip_id, observed_at)")
+
+
+def begin_snapshot(conn, feed):
+    """
+    Start the next generation of a feed
+    Returns (generation, {table: data table name}); the caller inserts its
+    rows with that generation and calls publish_snapshot in the same
+    transaction
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN")
     
-    conn.commit()
+    cursor = conn.cursor()
+    cursor.execute("SELECT generation FROM realtime_snapshots WHERE feed = ?", (feed,))
+    generation = cursor.fetchone()[0] + 1
+    return generation, {table: f"{table}_data" for table in SNAPSHOT_FEEDS[feed]}
+
+
+def publish_snapshot(conn, feed, generation):
+    """
+    Point the public views at a filled generation and delete older rows
+    Nothing is visible to readers until the caller commits
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE realtime_snapshots SET generation = ?, published_at = CURRENT_TIMESTAMP
+        WHERE feed = ?
+    """, (generation, feed))
+    for table in SNAPSHOT_FEEDS[feed]:
+        cursor.execute(f"DELETE FROM {table}_data WHERE generation < ?", (generation,))
+
+
+def create_realtime_tables(conn):
+    """Create tables for storing real-time data"""
+    print("Creating real-time data tables...")
+    ensure_realtime_schema(conn)
     print("✅ Real-time tables created\n")
 
 
@@ -274,63 +410,56 @@ def parse_vehicle_positions(file_path):
     return vehicles
 
 
-def load_alerts_to_db(conn, alerts):
-    """Load parsed alerts into database"""
+def write_alerts(conn, alerts):
+    """Write alerts as a new snapshot (the caller commits); returns the count"""
+    generation, names = begin_snapshot(conn, 'alerts')
     cursor = conn.cursor()
     
-    # Clear old alerts
-    cursor.execute("DELETE FROM alert_affected_entities")
-    cursor.execute("DELETE FROM alerts")
-    
-    for alert in alerts:
-        cursor.execute("""
-            INSERT OR REPLACE INTO alerts 
-            (alert_id, cause, effect, header_text, description_text, url, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            alert['alert_id'],
-            alert['cause'],
-            alert['effect'],
-            alert['header_text'],
-            alert['description_text'],
-            alert['url'],
-            alert['timestamp']
-        ))
-        
-        # Insert affected entities
-        for entity in alert['affected_entities']:
-            entity_type = 'route' if entity['route_id'] else 'trip' if entity['trip_id'] else 'stop'
-            cursor.execute("""
-                INSERT INTO alert_affected_entities 
-                (alert_id, entity_type, route_id, trip_id, stop_id)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                alert['alert_id'],
-                entity_type,
-                entity['route_id'],
-                entity['trip_id'],
-                entity['stop_id']
-            ))
-    
-    conn.commit()
-    print(f"✅ Loaded {len(alerts)} alerts to database\n")
+    cursor.executemany(f"""
+        INSERT OR REPLACE INTO {names['alerts']}
+        (generation, alert_id, cause, effect, header_text, description_text, url, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(
+        generation,
+        alert['alert_id'],
+        alert['cause'],
+        alert['effect'],
+        alert['header_text'],
+        alert['description_text'],
+        alert['url'],
+        alert['timestamp']
+    ) for alert in alerts])
+    
+    # Insert affected entities
+    cursor.executemany(f"""
+        INSERT INTO {names['alert_affected_entities']}
+        (generation, alert_id, entity_type, route_id, trip_id, stop_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(
+        generation,
+        alert['alert_id'],
+        'route' if entity['route_id'] else 'trip' if entity['trip_id'] else 'stop',
+        entity['route_id'],
+        entity['trip_id'],
+        entity['stop_id']
+    ) for alert in alerts for entity in alert['affected_entities']])
+    
+    publish_snapshot(conn, 'alerts', generation)
+    return len(alerts)
 
 
-def load_trip_updates_to_db(conn, trip_updates):
-    """Load parsed trip updates into database"""
+def write_trip_updates(conn, trip_updates):
+    """Write trip updates as a new snapshot (the caller commits); returns the count"""
+    generation, names = begin_snapshot(conn, 'trip_updates')
     cursor = conn.cursor()
     
-    # Clear old updates (keep last hour for reference)
-    one_hour_ago = int(datetime.now().timestamp()) - 3600
-    cursor.execute("DELETE FROM stop_time_updates WHERE trip_update_id IN (SELECT id FROM trip_updates WHERE timestamp < ?)", (one_hour_ago,))
-    cursor.execute("DELETE FROM trip_updates WHERE timestamp < ?", (one_hour_ago,))
-    
-    for update in trip_updates:
-        cursor.execute("""
-            INSERT INTO trip_updates 
-            (trip_id, route_id, start_date, start_time, schedule_relationship, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
+    # Ids are assigned here so both tables go in with executemany
+    update_rows = []
+    stop_rows = []
+    for trip_update_id, update in enumerate(trip_updates, 1):
+        update_rows.append((
+            generation,
+            trip_update_id,
             update['trip_id'],
             update['route_id'],
             update['start_date'],
@@ -338,17 +467,9 @@ def load_trip_updates_to_db(conn, trip_updates):
             update['schedule_relationship'],
             update['timestamp']
         ))
-        
-        trip_update_id = cursor.lastrowid
-        
-        # Insert stop time updates
         for stu in update['stop_time_updates']:
-            cursor.execute("""
-                INSERT INTO stop_time_updates 
-                (trip_update_id, stop_sequence, stop_id, arrival_delay, arrival_time, 
-                 departure_delay, departure_time, schedule_relationship)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+            stop_rows.append((
+                generation,
                 trip_update_id,
                 stu['stop_sequence'],
                 stu['stop_id'],
@@ -359,36 +480,164 @@ def load_trip_updates_to_db(conn, trip_updates):
                 stu['schedule_relationship']
             ))
     
-    conn.commit()
-    print(f"✅ Loaded {len(trip_updates)} trip updates to database\n")
+    cursor.executemany(f"""
+        INSERT INTO {names['trip_updates']}
+        (generation, id, trip_id, route_id, start_date, start_time, schedule_relationship, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, update_rows)
+    
+    # Insert stop time updates
+    cursor.executemany(f"""
+        INSERT INTO {names['stop_time_updates']}
+        (generation, trip_update_id, stop_sequence, stop_id, arrival_delay, arrival_time,
+         departure_delay, departure_time, schedule_relationship)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, stop_rows)
+    
+    carried = carry_over_trip_updates(conn, names, generation, len(update_rows))
+    if RETENTION['history']:
+        record_delay_history(conn, trip_updates)
+        prune_delay_history(conn)
+    
+    publish_snapshot(conn, 'trip_updates', generation)
+    if carried:
+        print(f"  ↪️  Kept latest update for {carried} trips no longer in the feed")
+    return len(trip_updates)
 
 
-def load_vehicle_positions_to_db(conn, vehicles):
-    """Load parsed vehicle positions into database"""
+def carry_over_trip_updates(conn, names, generation, offset):
+    """
+    Copy the latest update of trips that dropped out of the new feed (and are
+    still within hot_trip_seconds) from the current generation into the new
+    one; ids are shifted past the new feed's ids. Returns the trips carried.
+    """
+    cutoff = int(datetime.now().timestamp()) - RETENTION['hot_trip_seconds']
     cursor = conn.cursor()
     
-    for vehicle in vehicles:
-        cursor.execute("""
-            INSERT OR REPLACE INTO vehicle_positions 
-            (vehicle_id, trip_id, route_id, latitude, longitude, bearing, speed,
-             current_stop_sequence, current_stop_id, congestion_level, occupancy_status, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            vehicle['vehicle_id'],
-            vehicle['trip_id'],
-            vehicle['route_id'],
-            vehicle['latitude'],
-            vehicle['longitude'],
-            vehicle['bearing'],
-            vehicle['speed'],
-            vehicle['current_stop_sequence'],
-            vehicle['current_stop_id'],
-            vehicle['congestion_level'],
-            vehicle['occupancy_status'],
-            vehicle['timestamp']
+    cursor.execute(f"""
+        INSERT INTO {names['trip_updates']}
+        (generation, id, trip_id, route_id, start_date, start_time, schedule_relationship, timestamp, created_at)
+        SELECT ?, id + ?, trip_id, route_id, start_date, start_time, schedule_relationship, timestamp, created_at
+        FROM trip_updates
+        WHERE timestamp >= ?
+          AND trip_id NOT IN (
+              SELECT trip_id FROM {names['trip_updates']} WHERE generation = ? AND trip_id IS NOT NULL)
+    """, (generation, offset, cutoff, generation))
+    carried = cursor.rowcount
+    if not carried:
+        return 0
+    
+    # Uses the (generation, trip_update_id) index
+    cursor.execute(f"""
+        INSERT INTO {names['stop_time_updates']}
+        (generation, trip_update_id, stop_sequence, stop_id, arrival_delay, arrival_time,
+         departure_delay, departure_time, schedule_relationship)
+        SELECT ?, trip_update_id + ?, stop_sequence, stop_id, arrival_delay, arrival_time,
+               departure_delay, departure_time, schedule_relationship
+        FROM stop_time_updates
+        WHERE trip_update_id IN (SELECT id - ? FROM {names['trip_updates']} WHERE generation = ? AND id > ?)
+    """, (generation, offset, offset, generation, offset))
+    return carried
+
+
+def record_delay_history(conn, trip_updates):
+    """Append one compact history row per trip whose prediction is new this cycle"""
+    cursor = conn.cursor()
+    previous = dict(cursor.execute("SELECT trip_id, timestamp FROM trip_updates"))
+    
+    rows = []
+    for update in trip_updates:
+        if not update['trip_id'] or previous.get(update['trip_id']) == update['timestamp']:
+            continue
+        next_stop = update['stop_time_updates'][0] if update['stop_time_updates'] else {}
+        rows.append((
+            update['trip_id'],
+            update['route_id'],
+            update['start_date'],
+            update['timestamp'],
+            next_stop.get('stop_sequence'),
+            next_stop.get('stop_id'),
+            next_stop.get('arrival_delay'),
+            next_stop.get('departure_delay')
         ))
     
-    conn.commit()
+    cursor.executemany("""
+        INSERT INTO trip_delay_history
+        (trip_id, route_id, start_date, observed_at, stop_sequence, stop_id, arrival_delay, departure_delay)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    return len(rows)
+
+
+def prune_delay_history(conn):
+    """
+    Delete history older than history_seconds in index-ordered batches
+    At most max_delete_batches per call so one cycle's write stays short;
+    a backlog is worked off over the next cycles. Returns rows deleted.
+    """
+    cutoff = int(datetime.now().timestamp()) - RETENTION['history_seconds']
+    batch = RETENTION['delete_batch_rows']
+    deleted = 0
+    for _ in range(RETENTION['max_delete_batches']):
+        cursor = conn.execute("""
+            DELETE FROM trip_delay_history WHERE rowid IN (
+                SELECT rowid FROM trip_delay_history
+                WHERE observed_at < ?
+                ORDER BY observed_at
+                LIMIT ?
+            )
+        """, (cutoff, batch))
+        deleted += cursor.rowcount
+        if cursor.rowcount < batch:
+            break
+    return deleted
+
+
+def write_vehicle_positions(conn, vehicles):
+    """Write vehicle positions as a new snapshot (the caller commits); returns the count"""
+    generation, names = begin_snapshot(conn, 'vehicle_positions')
+    cursor = conn.cursor()
+    
+    cursor.executemany(f"""
+        INSERT OR REPLACE INTO {names['vehicle_positions']}
+        (generation, vehicle_id, trip_id, route_id, latitude, longitude, bearing, speed,
+         current_stop_sequence, current_stop_id, congestion_level, occupancy_status, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(
+        generation,
+        vehicle['vehicle_id'],
+        vehicle['trip_id'],
+        vehicle['route_id'],
+        vehicle['latitude'],
+        vehicle['longitude'],
+        vehicle['bearing'],
+        vehicle['speed'],
+        vehicle['current_stop_sequence'],
+        vehicle['current_stop_id'],
+        vehicle['congestion_level'],
+        vehicle['occupancy_status'],
+        vehicle['timestamp']
+    ) for vehicle in vehicles])
+    
+    publish_snapshot(conn, 'vehicle_positions', generation)
+    return len(vehicles)
+
+
+def load_alerts_to_db(conn, alerts):
+    """Load parsed alerts into database (main() commits)"""
+    write_alerts(conn, alerts)
+    print(f"✅ Loaded {len(alerts)} alerts to database\n")
+
+
+def load_trip_updates_to_db(conn, trip_updates):
+    """Load parsed trip updates into database (main() commits)"""
+    write_trip_updates(conn, trip_updates)
+    print(f"✅ Loaded {len(trip_updates)} trip updates to database\n")
+
+
+def load_vehicle_positions_to_db(conn, vehicles):
+    """Load parsed vehicle positions into database (main() commits)"""
+    write_vehicle_positions(conn, vehicles)
     print(f"✅ Loaded {len(vehicles)} vehicle positions to database\n")
 
 
@@ -406,26 +655,26 @@ def main():
         return
     
     # Connect to database
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT_SECONDS)
     
     try:
         # Create real-time tables
         create_realtime_tables(conn)
         
-        # Parse and load alerts
+        # Parse everything first, then write all three feeds in one transaction
         alerts = parse_alerts(ALERTS_FILE)
+        trip_updates = parse_trip_updates(TRIP_UPDATES_FILE)
+        vehicles = parse_vehicle_positions(VEHICLE_POSITIONS_FILE)
+        
+        write_started = time.time()
         if alerts:
             load_alerts_to_db(conn, alerts)
-        
-        # Parse and load trip updates
-        trip_updates = parse_trip_updates(TRIP_UPDATES_FILE)
         if trip_updates:
             load_trip_updates_to_db(conn, trip_updates)
-        
-        # Parse and load vehicle positions
-        vehicles = parse_vehicle_positions(VEHICLE_POSITIONS_FILE)
         if vehicles:
             load_vehicle_positions_to_db(conn, vehicles)
+        conn.commit()
+        write_seconds = time.time() - write_started
         
         # Summary
         cursor = conn.cursor()
@@ -446,10 +695,13 @@ def main():
         print(f"   - Trip Updates:      {trip_update_count}")
         print(f"   - Vehicle Positions: {vehicle_count}")
         print()
+        print(f"⏱️  Write time: {write_seconds:.2f}s")
+        print()
         print(f"💾 Database: {DB_FILE}")
         print()
         
     except Exception as e:
+        conn.rollback()
         print(f"❌ Error: {e}")
         import traceback
         traceback.print_exc()
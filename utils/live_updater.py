@@ -4,11 +4,18 @@ Fetches fresh data from MiWay servers and updates database
 """
 
 import requests
+from requests.adapters import HTTPAdapter
 import sqlite3
+import hashlib
 from google.transit import gtfs_realtime_pb2
+from utils.db import BUSY_TIMEOUT_SECONDS
+from utils.ingest_realtime import (RETENTION, ensure_realtime_schema, write_alerts, write_trip_updates,
+                                   write_vehicle_positions)
+from utils.predictions import get_prediction_index
 from datetime import datetime
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 DB_FILE = 'miway.db'
 
@@ -19,10 +26,23 @@ URLS = {
     'alerts': 'https://www.miapp.ca/gtfs_rt/Alerts/Alerts.pb'
 }
 
+# What was last written to the database for each feed URL: HTTP validators
+# (etag, last_modified) for conditional requests, plus a payload hash, the
+# feed header timestamp and the entity count. An unchanged feed is neither
+# parsed nor written again.
+feed_state = {}
+
+# One keep-alive session shared by all feeds (and fetch threads), so each
+# cycle reuses the TCP/TLS connections to miapp.ca instead of opening new ones
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=len(URLS)))
+
 
 def download_pb_file(url, timeout=10):
     """
     Download a Protocol Buffer file from URL
+    Sends If-None-Match/If-Modified-Since from the last fetch; a 304 comes
+    back as (None, None, response_time, 304, 0)
     Returns tuple: (data, error_dict, response_time, status_code, content_length)
     """
     error_info = None
@@ -33,17 +53,26 @@ def download_pb_file(url, timeout=10):
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36',
         'Accept': '*/*',
         'Accept-Encoding': 'gzip, deflate, br',
-        'Connection': 'keep-alive',
-        'Cache-Control': 'no-cache'
+        'Connection': 'keep-alive'
     }
     
+    state = feed_state.get(url, {})
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    
     try:
-        response = requests.get(url, headers=headers, timeout=timeout)
+        response = session.get(url, headers=headers, timeout=timeout)
         response_time = time.time() - start_time
         
         # Log response details
         print(f"  Status: {response.status_code}, Size: {len(response.content)} bytes")
         
+        # Feed unchanged since the last fetch
+        if response.status_code == 304:
+            return None, None, response_time, 304, 0
+        
         # Check for rate limiting
         if response.status_code == 429:
             retry_after = response.headers.get('Retry-After', 'unknown')
@@ -70,6 +99,11 @@ def download_pb_file(url, timeout=10):
             return None, error_info, response_time, response.status_code, 0
         
         response.raise_for_status()
+        
+        # Remember validators for the next conditional request
+        state = feed_state.setdefault(url, {})
+        state['etag'] = response.headers.get('ETag')
+        state['last_modified'] = response.headers.get('Last-Modified')
         return response.content, None, response_time, response.status_code, len(response.content)
         
     except requests.exceptions.Timeout:
@@ -109,11 +143,15 @@ def download_pb_file(url, timeout=10):
         return None, error_info, response_time, 0, 0
 
 
-def parse_vehicle_positions(pb_data):
-    """Parse VehiclePositions.pb data"""
+def decode_feed(pb_data):
+    """Decode a GTFS-Realtime protobuf payload"""
     feed = gtfs_realtime_pb2.FeedMessage()
     feed.ParseFromString(pb_data)
-    
+    return feed
+
+
+def parse_vehicle_positions(feed):
+    """Parse a decoded VehiclePositions feed"""
     vehicles = []
     for entity in feed.entity:
         if entity.HasField('vehicle'):
@@ -145,11 +183,8 @@ def parse_vehicle_positions(pb_data):
     return vehicles
 
 
-def parse_trip_updates(pb_data):
-    """Parse TripUpdates.pb data"""
-    feed = gtfs_realtime_pb2.FeedMessage()
-    feed.ParseFromString(pb_data)
-    
+def parse_trip_updates(feed):
+    """Parse a decoded TripUpdates feed"""
     trip_updates = []
     for entity in feed.entity:
         if entity.HasField('trip_update'):
@@ -189,11 +224,8 @@ def parse_trip_updates(pb_data):
     return trip_updates
 
 
-def parse_alerts(pb_data):
-    """Parse Alerts.pb data"""
-    feed = gtfs_realtime_pb2.FeedMessage()
-    feed.ParseFromString(pb_data)
-    
+def parse_alerts(feed):
+    """Parse a decoded Alerts feed"""
     alerts = []
     for entity in feed.entity:
         if entity.HasField('alert'):
@@ -238,129 +270,10 @@ def parse_alerts(pb_data):
     return alerts
 
 
-def update_vehicle_positions(conn, vehicles):
-    """Update vehicle positions in database"""
-    cursor = conn.cursor()
-    
-    for vehicle in vehicles:
-        cursor.execute("""
-            INSERT OR REPLACE INTO vehicle_positions 
-            (vehicle_id, trip_id, route_id, latitude, longitude, bearing, speed,
-             current_stop_sequence, current_stop_id, congestion_level, occupancy_status, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            vehicle['vehicle_id'],
-            vehicle['trip_id'],
-            vehicle['route_id'],
-            vehicle['latitude'],
-            vehicle['longitude'],
-            vehicle['bearing'],
-            vehicle['speed'],
-            vehicle['current_stop_sequence'],
-            vehicle['current_stop_id'],
-            vehicle['congestion_level'],
-            vehicle['occupancy_status'],
-            vehicle['timestamp']
-        ))
-    
-    conn.commit()
-    return len(vehicles)
-
-
-def update_trip_updates(conn, trip_updates):
-    """Update trip updates in database"""
-    cursor = conn.cursor()
-    
-    # Clear old updates (keep last hour)
-    one_hour_ago = int(datetime.now().timestamp()) - 3600
-    cursor.execute("DELETE FROM stop_time_updates WHERE trip_update_id IN (SELECT id FROM trip_updates WHERE timestamp < ?)", (one_hour_ago,))
-    cursor.execute("DELETE FROM trip_updates WHERE timestamp < ?", (one_hour_ago,))
-    
-    for update in trip_updates:
-        cursor.execute("""
-            INSERT INTO trip_updates 
-            (trip_id, route_id, start_date, start_time, schedule_relationship, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            update['trip_id'],
-            update['route_id'],
-            update['start_date'],
-            update['start_time'],
-            update['schedule_relationship'],
-            update['timestamp']
-        ))
-        
-        trip_update_id = cursor.lastrowid
-        
-        for stu in update['stop_time_updates']:
-            cursor.execute("""
-                INSERT INTO stop_time_updates 
-                (trip_update_id, stop_sequence, stop_id, arrival_delay, arrival_time, 
-                 departure_delay, departure_time, schedule_relationship)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                trip_update_id,
-                stu['stop_sequence'],
-                stu['stop_id'],
-                stu['arrival_delay'],
-                stu['arrival_time'],
-                stu['departure_delay'],
-                stu['departure_time'],
-                stu['schedule_relationship']
-            ))
-    
-    conn.commit()
-    return len(trip_updates)
-
-
-def update_alerts(conn, alerts):
-    """Update alerts in database"""
-    cursor = conn.cursor()
-    
-    # Clear old alerts
-    cursor.execute("DELETE FROM alert_affected_entities")
-    cursor.execute("DELETE FROM alerts")
-    
-    for alert in alerts:
-        cursor.execute("""
-            INSERT OR REPLACE INTO alerts 
-            (alert_id, cause, effect, header_text, description_text, url, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            alert['alert_id'],
-            alert['cause'],
-            alert['effect'],
-            alert['header_text'],
-            alert['description_text'],
-            alert['url'],
-            alert['timestamp']
-        ))
-        
-        for entity in alert['affected_entities']:
-            entity_type = 'route' if entity['route_id'] else 'trip' if entity['trip_id'] else 'stop'
-            cursor.execute("""
-                INSERT INTO alert_affected_entities 
-                (alert_id, entity_type, route_id, trip_id, stop_id)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                alert['alert_id'],
-                entity_type,
-                entity['route_id'],
-                entity['trip_id'],
-                entity['stop_id']
-            ))
-    
-    conn.commit()
-    return len(alerts)
-
-
-def log_health_check(endpoint_name, url, status, status_code, response_time, content_length, error_message, rate_limited):
-    """Log health check to database"""
+def log_health_check(conn, endpoint_name, url, status, status_code, response_time, content_length, error_message, rate_limited):
+    """Log health check to database (part of the cycle's write transaction)"""
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
+        conn.execute("""
             INSERT INTO health_checks (
                 timestamp, endpoint_name, endpoint_url, status, status_code,
                 response_time, content_length, error_message, rate_limited
@@ -376,17 +289,164 @@ def log_health_check(endpoint_name, url, status, status_code, response_time, con
             error_message,
             1 if rate_limited else 0
         ))
-        
-        conn.commit()
-        conn.close()
-    except Exception as e:
+    except sqlite3.Error as e:
         print(f"  Warning: Failed to log health check: {e}")
 
 
-def update_all_realtime_data():
+# Feed -> (health check name, results key, parser, snapshot writer)
+FEEDS = {
+    'vehicle_positions': ('Vehicle Positions', 'vehicles', parse_vehicle_positions, write_vehicle_positions),
+    'trip_updates': ('Trip Updates', 'trip_updates', parse_trip_updates, write_trip_updates),
+    'alerts': ('Alerts', 'alerts', parse_alerts, write_alerts),
+}
+
+
+def fetch_feed(source):
+    """
+    Download, check and parse one feed; runs on a fetch thread, so it never
+    touches the database. A 304, an identical payload or an unchanged header
+    timestamp mark the feed unchanged and skip parsing.
+    Returns an outcome dict for apply_feed
+    """
+    name, key, parse, write = FEEDS[source]
+    url = URLS[source]
+
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Downloading {name.lower()}...")
+    pb_data, error, response_time, status_code, content_length = download_pb_file(url)
+    outcome = {
+        'source': source,
+        'status': 'changed',
+        'error': error,
+        'response_time': response_time,
+        'status_code': status_code,
+        'content_length': content_length
+    }
+
+    if pb_data is None:
+        outcome['status'] = 'unchanged' if status_code == 304 else 'error'
+        return outcome
+
+    state = feed_state.get(url, {})
+    try:
+        outcome['sha256'] = hashlib.sha256(pb_data).hexdigest()
+        if outcome['sha256'] == state.get('sha256'):
+            outcome['status'] = 'unchanged'
+            return outcome
+
+        feed = decode_feed(pb_data)
+        outcome['header_timestamp'] = feed.header.timestamp if feed.header.HasField('timestamp') else None
+        if outcome['header_timestamp'] is not None and outcome['header_timestamp'] == state.get('header_timestamp'):
+            outcome['status'] = 'unchanged'
+            return outcome
+
+        outcome['records'] = parse(feed)
+    except Exception as e:
+        outcome['status'] = 'error'
+        outcome['error'] = {
+            'status_code': status_code,
+            'error': type(e).__name__,
+            'message': str(e),
+            'url': url,
+            'response_time': response_time
+        }
+    return outcome
+
+
+def apply_feed(conn, outcome, results):
+    """
+    Write one fetched feed to the database (if it changed), log its health
+    check and fill in results; the count from the last write is reported for
+    unchanged feeds. Nothing is committed here.
+    Returns the feed_state update to make once the transaction commits
+    """
+    source = outcome['source']
+    name, key, parse, write = FEEDS[source]
+    url = URLS[source]
+    error = outcome['error']
+    status_code = outcome['status_code']
+
+    if outcome['status'] == 'error':
+        # Nothing new was written, so the next request must not come back 304
+        feed_state.pop(url, None)
+        error_msg = f'Failed to download {name.lower()}'
+        log_health_check(conn, name, url,
+                       'connection_error' if error and error.get('error') == 'Connection Error' else 'error',
+                       status_code, outcome['response_time'], outcome['content_length'],
+                       error.get('message') if error else 'Unknown error',
+                       error.get('status_code') == 429 if error else False)
+        if error:
+            error_msg += f": {error['error']}"
+            results['error_details'].append({
+                'source': source,
+                **error
+            })
+        results['errors'].append(error_msg)
+        return None
+
+    log_health_check(conn, name, url, 'healthy', status_code, outcome['response_time'],
+                     outcome['content_length'], None, False)
+
+    if outcome['status'] == 'unchanged':
+        results[key] = feed_state.get(url, {}).get('count', 0)
+        results['unchanged'].append(source)
+        print(f"  ⏭️  {name} unchanged, keeping {results[key]} {key.replace('_', ' ')}")
+        return {'sha256': outcome['sha256']} if 'sha256' in outcome else None
+
+    results[key] = write(conn, outcome['records'])
+    print(f"  ✅ Updated {results[key]} {key.replace('_', ' ')}")
+    return {'sha256': outcome['sha256'], 'header_timestamp': outcome['header_timestamp'], 'count': results[key]}
+
+
+def realtime_version():
+    """
+    (digest, newest feed header timestamp) identifying the realtime data this
+    process last wrote, or None before its first successful write
+    """
+    states = dict(feed_state)
+    hashes = [states[url]['sha256'] for url in sorted(states) if states[url].get('sha256')]
+    if not hashes:
+        return None
+    digest = hashlib.blake2b(''.join(hashes).encode(), digest_size=8).hexdigest()
+    timestamps = [state['header_timestamp'] for state in states.values() if state.get('header_timestamp')]
+    return digest, max(timestamps) if timestamps else None
+
+
+def update_predictions(outcomes):
+    """Fold committed trip updates into the in-memory arrival predictions"""
+    for outcome in outcomes:
+        if outcome['source'] != 'trip_updates' or outcome['status'] != 'changed':
+            continue
+        try:
+            index = get_prediction_index()
+            changed = index.apply(outcome['records'], keep_seconds=RETENTION['hot_trip_seconds'])
+            print(f"  🔮 Predictions: {changed} trips changed, {index.stats()['predictions']} stop arrivals")
+        except Exception as e:
+            print(f"  Warning: Failed to update predictions: {e}")
+
+
+def write_outcomes(conn, outcomes, results):
+    """
+    Write one cycle's fetched feeds; the caller commits
+    Returns the feed_state updates to make once the commit succeeds
+    """
+    ensure_realtime_schema(conn)
+    state_updates = {}
+    for outcome in outcomes:
+        update = apply_feed(conn, outcome, results)
+        if update:
+            state_updates[URLS[outcome['source']]] = update
+    return state_updates
+
+
+def update_all_realtime_data(write_queue=None):
     """
     Download and update all real-time data
-    Returns dict with counts, timestamp, and detailed errors
+    The feeds are fetched and parsed concurrently, then written in one
+    transaction that publishes a new snapshot of every changed feed. With a
+    write_queue (utils.db.WriteQueue) the write runs on the app's single
+    writer thread; otherwise a connection is opened for this call
+    Returns dict with counts, timestamp, detailed errors, the feeds that were
+    skipped because they hadn't changed, and fetch/write timings
     """
     results = {
         'success': False,
@@ -394,93 +454,44 @@ def update_all_realtime_data():
         'vehicles': 0,
         'trip_updates': 0,
         'alerts': 0,
+        'unchanged': [],
         'errors': [],
         'error_details': []  # Detailed error info
     }
     
-    conn = sqlite3.connect(DB_FILE)
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=len(FEEDS)) as executor:
+        outcomes = list(executor.map(fetch_feed, FEEDS))
+    results['fetch_seconds'] = round(time.time() - started, 3)
     
+    started = time.time()
     try:
-        # Update vehicle positions
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] Downloading vehicle positions...")
-        pb_data, error, response_time, status_code, content_length = download_pb_file(URLS['vehicle_positions'])
-        
-        # Log to health check table
-        if pb_data:
-            log_health_check('Vehicle Positions', URLS['vehicle_positions'], 'healthy', 
-                           status_code, response_time, content_length, None, False)
-            vehicles = parse_vehicle_positions(pb_data)
-            results['vehicles'] = update_vehicle_positions(conn, vehicles)
-            print(f"  ✅ Updated {results['vehicles']} vehicles")
+        if write_queue is not None:
+            state_updates = write_queue.run(lambda conn: write_outcomes(conn, outcomes, results))
         else:
-            error_msg = 'Failed to download vehicle positions'
-            log_health_check('Vehicle Positions', URLS['vehicle_positions'], 
-                           'connection_error' if error and error.get('error') == 'Connection Error' else 'error',
-                           status_code, response_time, content_length, 
-                           error.get('message') if error else 'Unknown error',
-                           error.get('status_code') == 429 if error else False)
-            if error:
-                error_msg += f": {error['error']}"
-                results['error_details'].append({
-                    'source': 'vehicle_positions',
-                    **error
-                })
-            results['errors'].append(error_msg)
+            conn = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT_SECONDS)
+            try:
+                state_updates = write_outcomes(conn, outcomes, results)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
         
-        # Update trip updates
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] Downloading trip updates...")
-        pb_data, error, response_time, status_code, content_length = download_pb_file(URLS['trip_updates'])
+        # Only remember what actually made it into the database
+        for url, update in state_updates.items():
+            feed_state.setdefault(url, {}).update(update)
         
-        if pb_data:
-            log_health_check('Trip Updates', URLS['trip_updates'], 'healthy',
-                           status_code, response_time, content_length, None, False)
-            trip_updates = parse_trip_updates(pb_data)
-            results['trip_updates'] = update_trip_updates(conn, trip_updates)
-            print(f"  ✅ Updated {results['trip_updates']} trip updates")
-        else:
-            error_msg = 'Failed to download trip updates'
-            log_health_check('Trip Updates', URLS['trip_updates'],
-                           'connection_error' if error and error.get('error') == 'Connection Error' else 'error',
-                           status_code, response_time, content_length,
-                           error.get('message') if error else 'Unknown error',
-                           error.get('status_code') == 429 if error else False)
-            if error:
-                error_msg += f": {error['error']}"
-                results['error_details'].append({
-                    'source': 'trip_updates',
-                    **error
-                })
-            results['errors'].append(error_msg)
-        
-        # Update alerts
-        print(f"[{datetime.now().strftime('%H:%M:%S')}] Downloading alerts...")
-        pb_data, error, response_time, status_code, content_length = download_pb_file(URLS['alerts'])
-        
-        if pb_data:
-            log_health_check('Alerts', URLS['alerts'], 'healthy',
-                           status_code, response_time, content_length, None, False)
-            alerts = parse_alerts(pb_data)
-            results['alerts'] = update_alerts(conn, alerts)
-            print(f"  ✅ Updated {results['alerts']} alerts")
-        else:
-            error_msg = 'Failed to download alerts'
-            log_health_check('Alerts', URLS['alerts'],
-                           'connection_error' if error and error.get('error') == 'Connection Error' else 'error',
-                           status_code, response_time, content_length,
-                           error.get('message') if error else 'Unknown error',
-                           error.get('status_code') == 429 if error else False)
-            if error:
-                error_msg += f": {error['error']}"
-                results['error_details'].append({
-                    'source': 'alerts',
-                    **error
-                })
-            results['errors'].append(error_msg)
+        update_predictions(outcomes)
         
         # Success if at least one source worked
-        results['success'] = results['vehicles'] > 0 or results['trip_updates'] > 0 or results['alerts'] > 0
+        results['success'] = (results['vehicles'] > 0 or results['trip_updates'] > 0 or
+                               results['alerts'] > 0 or bool(results['unchanged']))
         
     except Exception as e:
+        for outcome in outcomes:
+            feed_state.pop(URLS[outcome['source']], None)
         results['errors'].append(str(e))
         results['error_details'].append({
             'source': 'system',
@@ -488,10 +499,9 @@ def update_all_realtime_data():
             'message': str(e)
         })
         print(f"  ❌ Error: {e}")
+    results['write_seconds'] = round(time.time() - started, 3)
     
-    finally:
-        conn.close()
-    
+    print(f"  ⏱️  Fetch {results['fetch_seconds']:.2f}s, write {results['write_seconds']:.2f}s")
     return results
 
 
@@ -4,27 +4,212 @@ Load GTFS data from CSV files into SQLite database
 
 import sqlite3
 import csv
+import hashlib
+import io
+import json
 import os
-from pathlib import Path
+import sys
+import time
+from datetime import datetime
+from itertools import groupby
+from multiprocessing import Pool, cpu_count
+from operator import itemgetter
+
+try:
+    from utils.timetable import COMPILED_FILE, Timetable
+except ImportError:
+    # Run as `python3 utils/load_gtfs.py`: the package lives one level up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utils.timetable import COMPILED_FILE, Timetable
 
 # Database file
 DB_FILE = 'miway.db'
 GTFS_DIR = 'google_transit'
 
+# The new database is built here and swapped into DB_FILE once it validates,
+# so the app never sees a missing or half-loaded database; the generation
+# file is touched after every swap to tell a running app.py
+STAGING_FILE = DB_FILE + '.staging'
+GENERATION_FILE = DB_FILE + '.generation'
+
+# The compiled timetable (see utils/timetable.py) is built from the staging
+# database and moved into place together with it
+COMPILED_STAGING_FILE = COMPILED_FILE + '.staging'
+
+# Validation: these tables must not be empty, and a new feed may not lose
+# more than this fraction of any of them compared to the live database
+REQUIRED_TABLES = ['stops', 'routes', 'trips', 'stop_times']
+MAX_SHRINK = 0.5
+
+# How long to wait for the app's writer to finish before swapping
+SWAP_LOCK_TIMEOUT = 60
+
+# Files bigger than this are parsed in parallel chunks (stop_times.txt in practice)
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+CHUNK_BYTES = 4 * 1024 * 1024
+INSERT_BATCH_ROWS = 50000
+
+# Fast-load profile: the database is rebuilt from scratch, so durability during
+# the load buys nothing. A crash mid-load just means running the loader again.
+FAST_LOAD_PRAGMAS = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA locking_mode = EXCLUSIVE",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -262144",  # 256 MB
+]
+
+def gtfs_seconds(value):
+    """GTFS 'HH:MM:SS' (hours may pass 24) to seconds since midnight"""
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+class SecondsMemo(dict):
+    """gtfs_seconds by lookup: a feed only uses a few thousand distinct times"""
+
+    def __missing__(self, value):
+        self[value] = gtfs_seconds(value)
+        return self[value]
+
+
+# Table -> (source file, [(column, type, default)]) in table column order.
+# Empty CSV values take the default; a default of None means NULL.
+TABLES = {
+    'stops': ('stops.txt', [
+        ('stop_id', str, None),
+        ('stop_code', str, ''),
+        ('stop_name', str, ''),
+        ('stop_lat', float, None),
+        ('stop_lon', float, None),
+        ('location_type', int, 0),
+        ('parent_station', str, ''),
+        ('wheelchair_boarding', int, 0),
+    ]),
+    'routes': ('routes.txt', [
+        ('route_id', str, None),
+        ('agency_id', str, ''),
+        ('route_short_name', str, ''),
+        ('route_long_name', str, ''),
+        ('route_type', int, 3),
+        ('route_color', str, ''),
+        ('route_text_color', str, ''),
+    ]),
+    'trips': ('trips.txt', [
+        ('trip_id', str, None),
+        ('route_id', str, None),
+        ('service_id', str, ''),
+        ('trip_headsign', str, ''),
+        ('direction_id', int, 0),
+        ('block_id', str, ''),
+        ('shape_id', str, ''),
+        ('wheelchair_accessible', int, 0),
+    ]),
+    'calendar_dates': ('calendar_dates.txt', [
+        ('service_id', str, None),
+        ('date', str, None),
+        ('exception_type', int, None),
+    ]),
+    'stop_times': ('stop_times.txt', [
+        ('trip_id', str, None),
+        ('arrival_time', str, ''),
+        ('departure_time', str, ''),
+        ('stop_id', str, None),
+        ('stop_sequence', int, None),
+        ('pickup_type', int, 0),
+        ('drop_off_type', int, 0),
+        ('timepoint', int, 0),
+        ('arrival_secs', gtfs_seconds, None),
+        ('departure_secs', gtfs_seconds, None),
+    ]),
+}
+
+# Columns computed from another CSV column rather than read from their own
+DERIVED_COLUMNS = {
+    'arrival_secs': 'arrival_time',
+    'departure_secs': 'departure_time',
+}
+
+# Load order matters only for readability of the output
+LOAD_ORDER = ['stops', 'routes', 'trips', 'calendar_dates', 'stop_times']
+
+# Incremental loads: each table's rows are grouped by this column and every
+# group gets a digest, so a changed file only rewrites the groups that differ
+# (e.g. the few trip_ids MiWay touched, not all of stop_times)
+TABLE_KEYS = {
+    'stops': 'stop_id',
+    'routes': 'route_id',
+    'trips': 'trip_id',
+    'calendar_dates': 'service_id',
+    'stop_times': 'trip_id',
+}
+
+# Bump when the schema or row conversion changes; older databases then get a
+# full rebuild instead of an incremental one
+LOADER_VERSION = '4'
+
+# feed_info.txt fields copied into feed_meta (app.py builds its HTTP cache
+# validators for static endpoints from feed_version)
+FEED_INFO_FIELDS = ['feed_version', 'feed_start_date', 'feed_end_date']
+
+# Tables owned by the loader; a swap replaces only these and leaves the rest of
+# the live database (realtime, health) alone
+LOADER_TABLES = set(TABLES) | {'feed_meta', 'feed_digests', 'pattern_stops', 'trip_schedules', 'gtfs_ids'}
+
+# Tables stored packed rather than row by row, with the table that holds one
+# row per key. Parsed rows go into a temporary "<table>_rows" table first and
+# are packed from there (see pack_stop_times); the table name itself is a view.
+PACKED_TABLES = {'stop_times': 'trip_schedules'}
+
+# Integer id dictionary: kind -> the SELECT listing that kind's GTFS ids.
+# Numbers are dense and stable while a feed is loaded: an incremental load
+# keeps every number, drops GTFS ids that left the feed and numbers new ones
+# after max(id). The holes that leaves are closed by renumbering the kind in
+# its existing order, on every full load and once holes pass MAX_ID_HOLES of
+# its ids (a board period renaming trip_ids, say). Whatever holds ids in
+# memory (timetable, prediction index) re-resolves them on reload anyway.
+# The SQLite tables and the realtime ingest path still key on GTFS id
+# strings; the dictionary only feeds the in-memory structures.
+ID_KINDS = {
+    'stop': "SELECT stop_id AS gtfs_id FROM stops",
+    'route': "SELECT route_id AS gtfs_id FROM routes",
+    'trip': "SELECT trip_id AS gtfs_id FROM trips",
+    'service': "SELECT service_id AS gtfs_id FROM trips UNION SELECT service_id FROM calendar_dates",
+}
+MAX_ID_HOLES = 0.02
+
+# Indexes on WITHOUT ROWID tables carry the primary key, so these cover the
+# lookups they exist for: the patterns (and positions) serving a stop, and a
+# pattern's trips in start time order
+INDEXES = [
+    "CREATE INDEX idx_pattern_stops_stop ON pattern_stops(stop_id)",
+    "CREATE INDEX idx_trip_schedules_pattern ON trip_schedules(pattern_id, start_secs)",
+    "CREATE INDEX idx_trips_route ON trips(route_id)",
+    "CREATE INDEX idx_trips_service ON trips(service_id)",
+    "CREATE INDEX idx_calendar_dates_date ON calendar_dates(date)",
+    "CREATE INDEX idx_stops_name ON stops(stop_name)",
+]
+
+
 def create_schema(conn):
-    """Create database schema"""
+    """Create database schema (indexes are built after the data is in)"""
     print("Creating database schema...")
-    
+
     cursor = conn.cursor()
-    
+
     # Drop existing tables
-    cursor.execute("DROP TABLE IF EXISTS stop_times")
+    cursor.execute("DROP VIEW IF EXISTS stop_times")
+    cursor.execute("DROP TABLE IF EXISTS trip_schedules")
+    cursor.execute("DROP TABLE IF EXISTS pattern_stops")
     cursor.execute("DROP TABLE IF EXISTS trips")
     cursor.execute("DROP TABLE IF EXISTS routes")
     cursor.execute("DROP TABLE IF EXISTS stops")
     cursor.execute("DROP TABLE IF EXISTS calendar_dates")
     cursor.execute("DROP TABLE IF EXISTS agency")
-    
+    cursor.execute("DROP TABLE IF EXISTS feed_meta")
+    cursor.execute("DROP TABLE IF EXISTS feed_digests")
+    cursor.execute("DROP TABLE IF EXISTS gtfs_ids")
+
     # Stops table
     cursor.execute("""
         CREATE TABLE stops (
@@ -38,7 +223,7 @@ def create_schema(conn):
             wheelchair_boarding INTEGER
         )
     """)
-    
+
     # Routes table
     cursor.execute("""
         CREATE TABLE routes (
@@ -51,7 +236,7 @@ def create_schema(conn):
             route_text_color TEXT
         )
     """)
-    
+
     # Trips table
     cursor.execute("""
         CREATE TABLE trips (
@@ -66,233 +251,831 @@ def create_schema(conn):
             FOREIGN KEY (route_id) REFERENCES routes(route_id)
         )
     """)
-    
-    # Stop Times table
+
+    # Stop Times, packed by trip pattern
+    # Most trips repeat one of a few hundred ordered stop lists, so each list
+    # is stored once (pattern_stops) and a trip is its pattern plus one row of
+    # times: start_secs, then per-stop offsets from it as a JSON array (null
+    # where the feed has no time). Times are integer seconds since midnight,
+    # past 86400 for trips running after midnight.
     cursor.execute("""
-        CREATE TABLE stop_times (
-            trip_id TEXT NOT NULL,
-            arrival_time TEXT,
-            departure_time TEXT,
+        CREATE TABLE pattern_stops (
+            pattern_id INTEGER NOT NULL,
+            stop_index INTEGER NOT NULL,
             stop_id TEXT NOT NULL,
             stop_sequence INTEGER NOT NULL,
             pickup_type INTEGER,
             drop_off_type INTEGER,
             timepoint INTEGER,
-            PRIMARY KEY (trip_id, stop_sequence),
-            FOREIGN KEY (trip_id) REFERENCES trips(trip_id),
+            PRIMARY KEY (pattern_id, stop_index),
             FOREIGN KEY (stop_id) REFERENCES stops(stop_id)
+        ) WITHOUT ROWID
+    """)
+
+    cursor.execute("""
+        CREATE TABLE trip_schedules (
+            trip_id TEXT PRIMARY KEY,
+            pattern_id INTEGER NOT NULL,
+            start_secs INTEGER NOT NULL,
+            arrival_offsets TEXT NOT NULL,
+            departure_offsets TEXT,  -- NULL when every departure equals its arrival
+            FOREIGN KEY (trip_id) REFERENCES trips(trip_id)
+        ) WITHOUT ROWID
+    """)
+
+    # The original row-per-stop table, for queries written against it
+    cursor.execute("""
+        CREATE VIEW stop_times AS
+        SELECT trip_id,
+               CASE WHEN arrival_secs IS NULL THEN '' ELSE
+                   printf('%02d:%02d:%02d', arrival_secs / 3600, arrival_secs / 60 % 60, arrival_secs % 60)
+               END AS arrival_time,
+               CASE WHEN departure_secs IS NULL THEN '' ELSE
+                   printf('%02d:%02d:%02d', departure_secs / 3600, departure_secs / 60 % 60, departure_secs % 60)
+               END AS departure_time,
+               stop_id, stop_sequence, pickup_type, drop_off_type, timepoint,
+               arrival_secs, departure_secs
+        FROM (
+            SELECT s.trip_id, p.stop_id, p.stop_sequence, p.pickup_type, p.drop_off_type, p.timepoint,
+                   s.start_secs + a.value AS arrival_secs,
+                   s.start_secs + CASE WHEN s.departure_offsets IS NULL THEN a.value
+                                       ELSE json_extract(s.departure_offsets, '$[' || a.key || ']') END
+                       AS departure_secs
+            FROM trip_schedules s, json_each(s.arrival_offsets) a
+            JOIN pattern_stops p ON p.pattern_id = s.pattern_id AND p.stop_index = a.key
         )
     """)
-    
-    # Create indexes
-    print("Creating indexes...")
-    cursor.execute("CREATE INDEX idx_stop_times_trip ON stop_times(trip_id)")
-    cursor.execute("CREATE INDEX idx_stop_times_stop ON stop_times(stop_id)")
-    cursor.execute("CREATE INDEX idx_trips_route ON trips(route_id)")
-    cursor.execute("CREATE INDEX idx_stops_name ON stops(stop_name)")
-    
-    conn.commit()
+
+    # Calendar Dates table (MiWay publishes service days only as exceptions)
+    cursor.execute("""
+        CREATE TABLE calendar_dates (
+            service_id TEXT NOT NULL,
+            date TEXT NOT NULL,
+            exception_type INTEGER NOT NULL,
+            PRIMARY KEY (service_id, date)
+        )
+    """)
+
+    # Feed metadata (load marker used by the app to reload its timetable)
+    cursor.execute("""
+        CREATE TABLE feed_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+    # Per-key digests of the source rows, used by incremental loads
+    cursor.execute("""
+        CREATE TABLE feed_digests (
+            table_name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (table_name, key)
+        ) WITHOUT ROWID
+    """)
+
+    # GTFS id -> dense integer per kind (see ID_KINDS)
+    cursor.execute("""
+        CREATE TABLE gtfs_ids (
+            kind TEXT NOT NULL,
+            gtfs_id TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            PRIMARY KEY (kind, gtfs_id)
+        ) WITHOUT ROWID
+    """)
+
     print("✅ Schema created\n")
 
 
-def load_stops(conn):
-    """Load stops.txt"""
-    print("Loading stops.txt...")
+def write_id_dictionary(conn, seed=(), compact=False):
+    """
+    Bring the id dictionary in line with the loaded tables, starting from the
+    (kind, gtfs_id, id) rows of seed: drop GTFS ids gone from the feed,
+    number new ones after the current maximum, and renumber a kind densely
+    when compact is set or its holes pass MAX_ID_HOLES
+    """
+    cursor = conn.cursor()
+    cursor.executemany("INSERT OR IGNORE INTO gtfs_ids (kind, gtfs_id, id) VALUES (?, ?, ?)", seed)
+    summary = []
+    for kind, select in ID_KINDS.items():
+        cursor.execute(f"""
+            DELETE FROM gtfs_ids
+            WHERE kind = ? AND gtfs_id NOT IN (SELECT gtfs_id FROM ({select}) WHERE gtfs_id IS NOT NULL)
+        """, (kind,))
+        removed = cursor.rowcount
+        cursor.execute(f"""
+            INSERT INTO gtfs_ids (kind, gtfs_id, id)
+            SELECT ?, gtfs_id, (SELECT COALESCE(MAX(id), -1) FROM gtfs_ids WHERE kind = ?)
+                               + ROW_NUMBER() OVER (ORDER BY gtfs_id)
+            FROM ({select})
+            WHERE gtfs_id IS NOT NULL
+              AND gtfs_id NOT IN (SELECT gtfs_id FROM gtfs_ids WHERE kind = ?)
+        """, (kind, kind, kind))
+        added = cursor.rowcount
+
+        count, top = cursor.execute(
+            "SELECT COUNT(*), COALESCE(MAX(id), -1) FROM gtfs_ids WHERE kind = ?", (kind,)).fetchone()
+        holes = top + 1 - count
+        note = f"{added:,} new, {removed:,} gone"
+        if holes and (compact or holes > count * MAX_ID_HOLES):
+            # id is not unique on its own, so renumbering in place is safe
+            order = cursor.execute("SELECT gtfs_id FROM gtfs_ids WHERE kind = ? ORDER BY id", (kind,)).fetchall()
+            cursor.executemany("UPDATE gtfs_ids SET id = ? WHERE kind = ? AND gtfs_id = ?",
+                               [(new_id, kind, gtfs_id) for new_id, (gtfs_id,) in enumerate(order)])
+            note += f", {holes:,} holes closed"
+        summary.append(f"{kind}s {note}")
+    print(f"✅ Id dictionary: {'; '.join(summary)}\n")
+
+
+def read_live_ids():
+    """The live database's id dictionary rows (empty before there is one)"""
+    if not os.path.exists(DB_FILE):
+        return []
+    live = sqlite3.connect(DB_FILE, timeout=SWAP_LOCK_TIMEOUT)
+    try:
+        return live.execute("SELECT kind, gtfs_id, id FROM gtfs_ids").fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        live.close()
+
+
+def create_indexes(conn):
+    """Build secondary indexes in one pass over the loaded tables"""
+    print("Creating indexes...")
+    started = time.time()
+
+    cursor = conn.cursor()
+    for statement in INDEXES:
+        cursor.execute(statement)
+    cursor.execute("ANALYZE")
+
+    print(f"✅ Indexes created in {time.time() - started:.1f}s\n")
+
+
+def read_header(path):
+    """Return (header columns, byte offset of the first data row)"""
+    with open(path, 'rb') as f:
+        first_line = f.readline()
+        header = next(csv.reader([first_line.decode('utf-8-sig')]))
+        return [name.strip() for name in header], f.tell()
+
+
+def column_plan(header, columns):
+    """Map each table column to (csv index or None, type, default)"""
+    positions = {name: i for i, name in enumerate(header)}
+    return [(positions.get(DERIVED_COLUMNS.get(name, name)), kind, default) for name, kind, default in columns]
+
+
+def column_converter(index, kind, default, seconds):
+    """Function reading one column of a CSV record, empty values taking the default"""
+    if index is None:
+        return lambda record: default
+    if kind is gtfs_seconds:
+        return lambda record: seconds[record[index]] if record[index].strip() else default
+    if kind is str and default == '':
+        return itemgetter(index)
+    if kind is str:
+        return lambda record: record[index] or default
+    return lambda record: kind(record[index]) if record[index].strip() else default
+
+
+def make_converter(plan):
+    """Build a single function turning a CSV record into a tuple, one closure per column"""
+    seconds = SecondsMemo()
+    columns = tuple(column_converter(index, kind, default, seconds) for index, kind, default in plan)
+
+    def convert(record):
+        return tuple([column(record) for column in columns])
+    return convert
+
+
+def convert_rows(lines, plan):
+    """Parse CSV lines into insert-ready tuples"""
+    return convert_records(csv.reader(lines), plan)
+
+
+def convert_records(records, plan):
+    """Turn parsed CSV records into insert-ready tuples"""
+    convert = make_converter(plan)
+    width = max((index for index, _, _ in plan if index is not None), default=-1) + 1
+    rows = []
+    for record in records:
+        if len(record) < width:
+            if not record:
+                continue
+            record += [''] * (width - len(record))
+        rows.append(convert(record))
+    return rows
+
+
+def parse_chunk(args):
+    """Pool worker: parse the rows between two byte offsets of a CSV file"""
+    path, start, end, plan = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8')
+    return convert_rows(io.StringIO(data, newline=''), plan)
+
+
+def split_chunks(path, start, chunk_bytes=CHUNK_BYTES):
+    """Byte ranges of roughly chunk_bytes that each end on a line boundary"""
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def iter_table_rows(table, pool):
+    """
+    Yield batches of parsed rows for a table
+    Large files are split into chunks parsed by the worker pool; the caller
+    stays the single writer and receives chunks in file order
+    """
+    filename, columns = TABLES[table]
+    path = os.path.join(GTFS_DIR, filename)
+    header, data_start = read_header(path)
+    plan = column_plan(header, columns)
+
+    if pool is not None and os.path.getsize(path) >= PARALLEL_MIN_BYTES:
+        tasks = [(path, start, end, plan) for start, end in split_chunks(path, data_start)]
+        yield from pool.imap(parse_chunk, tasks)
+        return
+
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        f.readline()
+        yield convert_rows(f, plan)
+
+
+def file_checksum(path):
+    """SHA-256 of a file (None if it doesn't exist)"""
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def feed_checksums():
+    """Checksum of every source file, keyed by table"""
+    return {table: file_checksum(os.path.join(GTFS_DIR, filename))
+            for table, (filename, _) in TABLES.items()}
+
+
+def read_key_groups(path, key_column):
+    """
+    Read a CSV file grouped by one column
+    Returns (header, {key: [records joined with \\x1f]}); joined strings are
+    much smaller than lists and split back into the exact original fields
+    """
+    header, _ = read_header(path)
+    key = header.index(key_column)
+    groups = {}
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        f.readline()
+        for record in csv.reader(f):
+            if not record:
+                continue
+            line = '\x1f'.join(record)
+            group = groups.get(record[key])
+            if group is None:
+                groups[record[key]] = [line]
+            else:
+                group.append(line)
+    return header, groups
+
+
+def group_digest(lines):
+    """Order-independent digest of one key's records"""
+    return hashlib.blake2b('\n'.join(sorted(lines)).encode(), digest_size=8).hexdigest()
+
+
+def table_digests(table):
+    """{key: digest} for a table's source file (empty if the file is missing)"""
+    filename, _ = TABLES[table]
+    path = os.path.join(GTFS_DIR, filename)
+    if not os.path.exists(path):
+        return {}
+    _, groups = read_key_groups(path, TABLE_KEYS[table])
+    return {key: group_digest(lines) for key, lines in groups.items()}
+
+
+def write_digests(conn, table, digests):
+    """Replace the stored digests for a table"""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM feed_digests WHERE table_name = ?", (table,))
+    cursor.executemany(
+        "INSERT INTO feed_digests (table_name, key, digest) VALUES (?, ?, ?)",
+        ((table, key, digest) for key, digest in digests.items())
+    )
+
+
+def apply_table_diff(conn, table):
+    """
+    Bring one table in line with its changed source file, touching only the
+    keys whose rows differ. Returns (rows in the file, seconds)
+    """
+    filename, columns = TABLES[table]
+    key_column = TABLE_KEYS[table]
+    path = os.path.join(GTFS_DIR, filename)
+    print(f"Diffing {filename}...")
+    started = time.time()
+
     cursor = conn.cursor()
-    
-    with open(f'{GTFS_DIR}/stops.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        count = 0
-        batch = []
-        
-        for row in reader:
-            batch.append((
-                row['stop_id'],
-                row.get('stop_code', ''),
-                row['stop_name'],
-                float(row['stop_lat']) if row.get('stop_lat') else None,
-                float(row['stop_lon']) if row.get('stop_lon') else None,
-                int(row.get('location_type', 0)),
-                row.get('parent_station', ''),
-                int(row.get('wheelchair_boarding', 0))
-            ))
-            count += 1
-            
-            # Insert in batches of 1000
-            if len(batch) >= 1000:
-                cursor.executemany(
-                    'INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                    batch
-                )
-                batch = []
-        
-        # Insert remaining
-        if batch:
-            cursor.executemany(
-                'INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                batch
-            )
-    
-    conn.commit()
-    print(f"✅ Loaded {count} stops\n")
-
-
-def load_routes(conn):
-    """Load routes.txt"""
-    print("Loading routes.txt...")
+    stored = dict(cursor.execute(
+        "SELECT key, digest FROM feed_digests WHERE table_name = ?", (table,)
+    ))
+
+    if os.path.exists(path):
+        header, groups = read_key_groups(path, key_column)
+    else:
+        header, groups = [], {}
+
+    digests = {key: group_digest(lines) for key, lines in groups.items()}
+    changed = [key for key, digest in digests.items() if stored.get(key) != digest]
+    removed = [key for key in stored if key not in digests]
+
+    cursor.executemany(f"DELETE FROM {PACKED_TABLES.get(table, table)} WHERE {key_column} = ?",
+                       [(key,) for key in changed + removed])
+    cursor.executemany("DELETE FROM feed_digests WHERE table_name = ? AND key = ?",
+                       [(table, key) for key in removed])
+
+    if changed:
+        plan = column_plan(header, columns)
+        rows = convert_records((line.split('\x1f') for key in changed for line in groups[key]), plan)
+        placeholders = ', '.join('?' * len(columns))
+        target = create_rows_table(conn, table) if table in PACKED_TABLES else table
+        for i in range(0, len(rows), INSERT_BATCH_ROWS):
+            cursor.executemany(f"INSERT INTO {target} VALUES ({placeholders})", rows[i:i + INSERT_BATCH_ROWS])
+        if table in PACKED_TABLES:
+            pack_stop_times(conn)
+        cursor.executemany(
+            "INSERT OR REPLACE INTO feed_digests (table_name, key, digest) VALUES (?, ?, ?)",
+            [(table, key, digests[key]) for key in changed]
+        )
+
+    if table in PACKED_TABLES:
+        # Stop lists only the changed or removed trips used
+        cursor.execute("""
+            DELETE FROM pattern_stops
+            WHERE pattern_id NOT IN (SELECT pattern_id FROM trip_schedules)
+        """)
+
+    count = sum(len(lines) for lines in groups.values())
+    elapsed = time.time() - started
+    print(f"✅ {table}: {len(changed):,} {key_column}s changed, {len(removed):,} removed "
+          f"({count:,} rows in file) in {elapsed:.1f}s\n")
+    return count, elapsed
+
+
+def load_table(conn, table, pool):
+    """Load one GTFS file into its table, returning (rows, seconds)"""
+    filename, columns = TABLES[table]
+    print(f"Loading {filename}...")
+
+    path = os.path.join(GTFS_DIR, filename)
+    if not os.path.exists(path):
+        print(f"⚠️  {filename} not found, skipping\n")
+        return 0, 0.0
+
+    started = time.time()
+    placeholders = ', '.join('?' * len(columns))
+    target = create_rows_table(conn, table) if table in PACKED_TABLES else table
+    statement = f"INSERT INTO {target} VALUES ({placeholders})"
+
     cursor = conn.cursor()
-    
-    with open(f'{GTFS_DIR}/routes.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        count = 0
-        
-        for row in reader:
-            cursor.execute(
-                'INSERT INTO routes VALUES (?, ?, ?, ?, ?, ?, ?)',
-                (
-                    row['route_id'],
-                    row.get('agency_id', ''),
-                    row.get('route_short_name', ''),
-                    row.get('route_long_name', ''),
-                    int(row.get('route_type', 3)),
-                    row.get('route_color', ''),
-                    row.get('route_text_color', '')
-                )
-            )
-            count += 1
-    
-    conn.commit()
-    print(f"✅ Loaded {count} routes\n")
-
-
-def load_trips(conn):
-    """Load trips.txt"""
-    print("Loading trips.txt (this may take a moment)...")
+    count = 0
+    for rows in iter_table_rows(table, pool):
+        for i in range(0, len(rows), INSERT_BATCH_ROWS):
+            cursor.executemany(statement, rows[i:i + INSERT_BATCH_ROWS])
+        count += len(rows)
+    if table in PACKED_TABLES:
+        pack_stop_times(conn)
+
+    elapsed = time.time() - started
+    rate = count / elapsed if elapsed > 0 else 0
+    print(f"✅ Loaded {count:,} rows into {table} in {elapsed:.1f}s ({rate:,.0f} rows/sec)\n")
+    return count, elapsed
+
+
+def create_rows_table(conn, table):
+    """Empty temporary table shaped like the source file, for packing; returns its name"""
+    name = f"temp.{table}_rows"
+    columns = ', '.join(column for column, _, _ in TABLES[table][1])
+    conn.execute(f"DROP TABLE IF EXISTS {name}")
+    conn.execute(f"CREATE TABLE {name} ({columns}, PRIMARY KEY (trip_id, stop_sequence)) WITHOUT ROWID")
+    return name
+
+
+def read_patterns(conn):
+    """{stop list: pattern_id} for the patterns already in the database"""
+    stops = {}
+    for pattern_id, *stop in conn.execute("""
+        SELECT pattern_id, stop_id, stop_sequence, pickup_type, drop_off_type, timepoint
+        FROM pattern_stops
+        ORDER BY pattern_id, stop_index
+    """):
+        stops.setdefault(pattern_id, []).append(tuple(stop))
+    return {tuple(pattern): pattern_id for pattern_id, pattern in stops.items()}
+
+
+def encode_offsets(times, start):
+    """JSON array of seconds after start (null for missing times)"""
+    return json.dumps([None if t is None else t - start for t in times], separators=(',', ':'))
+
+
+def pack_stop_times(conn):
+    """
+    Pack the rows staged in temp.stop_times_rows into trip_schedules, adding
+    any stop list not seen before to pattern_stops. Replaces the schedules of
+    the trips it packs.
+    """
     cursor = conn.cursor()
-    
-    with open(f'{GTFS_DIR}/trips.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        count = 0
-        batch = []
-        
-        for row in reader:
-            batch.append((
-                row['trip_id'],
-                row['route_id'],
-                row.get('service_id', ''),
-                row.get('trip_headsign', ''),
-                int(row.get('direction_id', 0)),
-                row.get('block_id', ''),
-                row.get('shape_id', ''),
-                int(row.get('wheelchair_accessible', 0))
-            ))
-            count += 1
-            
-            if len(batch) >= 5000:
-                cursor.executemany(
-                    'INSERT INTO trips VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                    batch
-                )
-                batch = []
-        
-        if batch:
-            cursor.executemany(
-                'INSERT INTO trips VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                batch
-            )
-    
-    conn.commit()
-    print(f"✅ Loaded {count} trips\n")
-
-
-def load_stop_times(conn):
-    """Load stop_times.txt"""
-    print("Loading stop_times.txt (this will take a few moments - 960K+ rows)...")
+    patterns = read_patterns(conn)
+    next_pattern = max(patterns.values(), default=0) + 1
+
+    new_stops = []
+    schedules = []
+    rows = cursor.execute("""
+        SELECT trip_id, stop_id, stop_sequence, pickup_type, drop_off_type, timepoint,
+               arrival_secs, departure_secs
+        FROM temp.stop_times_rows
+        ORDER BY trip_id, stop_sequence
+    """)
+    for trip_id, trip_rows in groupby(rows, key=lambda row: row[0]):
+        trip_rows = list(trip_rows)
+        stop_list = tuple(row[1:6] for row in trip_rows)
+        pattern_id = patterns.get(stop_list)
+        if pattern_id is None:
+            pattern_id = patterns[stop_list] = next_pattern
+            next_pattern += 1
+            new_stops.extend((pattern_id, index) + stop for index, stop in enumerate(stop_list))
+
+        arrivals = [row[6] for row in trip_rows]
+        departures = [row[7] for row in trip_rows]
+        start = min((t for t in arrivals + departures if t is not None), default=0)
+        schedules.append((trip_id, pattern_id, start, encode_offsets(arrivals, start),
+                          None if departures == arrivals else encode_offsets(departures, start)))
+
+    cursor.executemany("INSERT INTO pattern_stops VALUES (?, ?, ?, ?, ?, ?, ?)", new_stops)
+    cursor.executemany("INSERT OR REPLACE INTO trip_schedules VALUES (?, ?, ?, ?, ?)", schedules)
+    cursor.execute("DROP TABLE temp.stop_times_rows")
+    print(f"   Packed {len(schedules):,} trips into {len(patterns):,} stop patterns "
+          f"({len(new_stops):,} new pattern stops)")
+
+
+def copy_loader_tables(conn, source):
+    """
+    Replace the loader's tables, views and indexes in conn's main database
+    with the ones in the attached database `source`. Everything else
+    (realtime, health) is left as it is. The caller runs the transaction.
+    """
+    placeholders = ', '.join('?' * len(LOADER_TABLES))
+
+    def owned(schema):
+        return conn.execute(f"""
+            SELECT type, name, sql FROM {schema}.sqlite_master
+            WHERE tbl_name IN ({placeholders}) AND sql IS NOT NULL
+            ORDER BY type = 'table', rowid
+        """, tuple(LOADER_TABLES)).fetchall()
+
+    # Views first; indexes go with their tables
+    for kind, name, _ in owned('main'):
+        if kind in ('view', 'table'):
+            conn.execute(f'DROP {kind.upper()} IF EXISTS main."{name}"')
+
+    schema = owned(source)
+    for kind, name, sql in schema:
+        if kind == 'table':
+            conn.execute(sql)
+            conn.execute(f'INSERT INTO main."{name}" SELECT * FROM {source}."{name}"')
+    for kind, name, sql in schema:
+        if kind in ('view', 'index'):
+            conn.execute(sql)
+    for kind, name, _ in schema:
+        if kind == 'table':
+            conn.execute(f'ANALYZE main."{name}"')
+
+
+def count_rows(conn, table):
+    """Row count of a table; packed stop_times is counted without expanding its view"""
+    if table in PACKED_TABLES:
+        try:
+            return conn.execute(
+                "SELECT COALESCE(SUM(json_array_length(arrival_offsets)), 0) FROM trip_schedules"
+            ).fetchone()[0]
+        except sqlite3.OperationalError:
+            pass  # Database from before packing
+    return conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def validate(conn, timings):
+    """
+    Check the staging database before it replaces the live one
+    Returns a list of problems (empty when the load is good)
+    """
+    problems = []
+    counts = {table: count_rows(conn, table) for table in TABLES}
+    for table, (loaded, _) in timings.items():
+        if counts[table] != loaded:
+            problems.append(f"{table}: {counts[table]:,} rows in database, {loaded:,} parsed")
+
+    for table in REQUIRED_TABLES:
+        if not counts.get(table):
+            problems.append(f"{table}: no rows loaded")
+
+    if os.path.exists(DB_FILE):
+        live = sqlite3.connect(DB_FILE, timeout=SWAP_LOCK_TIMEOUT)
+        try:
+            for table in REQUIRED_TABLES:
+                try:
+                    previous = count_rows(live, table)
+                except sqlite3.OperationalError:
+                    continue
+                if counts.get(table, 0) < previous * (1 - MAX_SHRINK):
+                    problems.append(f"{table}: {counts.get(table, 0):,} rows, live database has {previous:,}")
+        finally:
+            live.close()
+
+    return problems
+
+
+def swap_into_place():
+    """
+    Publish the staging database's static tables in DB_FILE, in WAL mode
+    A first load links the file into place (refusing to clobber a database
+    created meanwhile). After that the app is using the live database and
+    writing realtime data to it, so only the loader's tables are replaced,
+    in one BEGIN IMMEDIATE transaction on the live file: it waits for the
+    app's writer, realtime rows committed during the load are kept, and
+    readers keep their snapshot until it commits.
+    The compiled timetable is renamed into place next (processes still
+    mapping the old file keep their pages), and GENERATION_FILE is touched
+    last so the app reloads its timetable.
+    """
+    published = False
+    if not os.path.exists(DB_FILE):
+        staging = sqlite3.connect(STAGING_FILE)
+        try:
+            staging.execute("PRAGMA journal_mode = WAL")
+        finally:
+            staging.close()
+        try:
+            os.link(STAGING_FILE, DB_FILE)
+            os.remove(STAGING_FILE)
+            published = True
+        except FileExistsError:
+            pass
+
+    if not published:
+        live = sqlite3.connect(DB_FILE, timeout=SWAP_LOCK_TIMEOUT, isolation_level=None)
+        try:
+            live.execute("PRAGMA journal_mode = WAL")
+            live.execute("ATTACH DATABASE ? AS staging", (STAGING_FILE,))
+            live.execute("BEGIN IMMEDIATE")
+            try:
+                copy_loader_tables(live, 'staging')
+                live.execute("COMMIT")
+            except Exception:
+                live.execute("ROLLBACK")
+                raise
+            live.execute("DETACH DATABASE staging")
+            # Fold the new pages into the file without waiting on readers;
+            # the app's writer truncates the WAL later
+            live.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        finally:
+            live.close()
+        os.remove(STAGING_FILE)
+
+    if os.path.exists(COMPILED_STAGING_FILE):
+        os.replace(COMPILED_STAGING_FILE, COMPILED_FILE)
+
+    touch_generation()
+
+
+def touch_generation():
+    """Tell a running app.py to reload its timetable (it watches GENERATION_FILE)"""
+    with open(GENERATION_FILE, 'w') as f:
+        f.write(f"{time.time()}\n")
+
+
+def compile_timetable(db_file, target):
+    """Build the timetable from db_file and write it in compiled form to target"""
+    print("Compiling timetable...")
+    started = time.time()
+    tt = Timetable.load(db_file)
+    tt.save(target)
+    size_mb = os.path.getsize(target) / (1024 * 1024)
+    print(f"✅ {target}: {len(tt.trip_ids):,} trips, {len(tt.pattern_start) - 1:,} patterns, "
+          f"{size_mb:.1f} MB in {time.time() - started:.1f}s\n")
+
+
+def compiled_is_current(live_meta):
+    """True if COMPILED_FILE was built from the live database"""
+    try:
+        return Timetable.open(COMPILED_FILE).version == live_meta.get('loaded_at')
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def read_live_meta():
+    """feed_meta of the live database ({} if there is none)"""
+    if not os.path.exists(DB_FILE):
+        return {}
+    conn = sqlite3.connect(DB_FILE, timeout=SWAP_LOCK_TIMEOUT)
+    try:
+        return dict(conn.execute("SELECT key, value FROM feed_meta"))
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        conn.close()
+
+
+def changed_tables(live_meta, checksums):
+    """
+    Tables whose source file changed since the live database was loaded
+    Returns None when the live database can't be patched incrementally
+    """
+    if live_meta.get('loader_version') != LOADER_VERSION:
+        return None
+    return [table for table in LOAD_ORDER
+            if live_meta.get(f'sha256:{TABLES[table][0]}') != (checksums[table] or '')]
+
+
+def copy_live_database():
+    """Start the staging database as a consistent copy of the live one's static tables"""
+    conn = sqlite3.connect(STAGING_FILE, isolation_level=None)
+    conn.execute("ATTACH DATABASE ? AS live", (DB_FILE,))
+    conn.execute("BEGIN")
+    copy_loader_tables(conn, 'live')
+    conn.execute("COMMIT")
+    conn.execute("DETACH DATABASE live")
+    return conn
+
+
+def read_feed_info():
+    """FEED_INFO_FIELDS from feed_info.txt ({} if the feed has none)"""
+    path = os.path.join(GTFS_DIR, 'feed_info.txt')
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        row = next(csv.DictReader(f), None) or {}
+    return {field: row[field].strip() for field in FEED_INFO_FIELDS if row.get(field)}
+
+
+def write_feed_meta(conn, checksums):
+    """
+    Record when this load finished (app.py rebuilds its timetable when it
+    changes), the feed_info.txt version and the source checksums the next
+    incremental load compares to
+    """
     cursor = conn.cursor()
-    
-    with open(f'{GTFS_DIR}/stop_times.txt', 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        count = 0
-        batch = []
-        
-        for row in reader:
-            batch.append((
-                row['trip_id'],
-                row.get('arrival_time', ''),
-                row.get('departure_time', ''),
-                row['stop_id'],
-                int(row['stop_sequence']),
-                int(row.get('pickup_type', 0)),
-                int(row.get('drop_off_type', 0)),
-                int(row.get('timepoint', 0))
-            ))
-            count += 1
-            
-            # Insert in batches of 10000 for speed
-            if len(batch) >= 10000:
-                cursor.executemany(
-                    'INSERT INTO stop_times VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                    batch
-                )
-                batch = []
-                if count % 100000 == 0:
-                    print(f"   Processed {count:,} rows...")
-        
-        if batch:
-            cursor.executemany(
-                'INSERT INTO stop_times VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-                batch
-            )
-    
-    conn.commit()
-    print(f"✅ Loaded {count:,} stop times\n")
-
-
-def main():
-    """Main function to load all GTFS data"""
+    meta = {'loaded_at': datetime.now().isoformat(), 'loader_version': LOADER_VERSION}
+    meta.update(read_feed_info())
+    for table, (filename, _) in TABLES.items():
+        meta[f'sha256:{filename}'] = checksums[table] or ''
+    cursor.executemany("INSERT OR REPLACE INTO feed_meta (key, value) VALUES (?, ?)", meta.items())
+
+
+def build_full(conn, pool, checksums):
+    """Load every table from scratch into an empty staging database"""
+    # Digests don't depend on the insert path, so workers compute them meanwhile
+    pending = {}
+    if pool is not None:
+        pending = {table: pool.apply_async(table_digests, (table,)) for table in LOAD_ORDER}
+
+    # Everything happens in a single transaction
+    conn.execute("BEGIN")
+
+    # Create schema
+    create_schema(conn)
+
+    # Load data
+    timings = {}
+    for table in LOAD_ORDER:
+        timings[table] = load_table(conn, table, pool)
+
+    create_indexes(conn)
+    write_id_dictionary(conn, read_live_ids(), compact=True)
+    for table in LOAD_ORDER:
+        write_digests(conn, table, pending[table].get() if pending else table_digests(table))
+    write_feed_meta(conn, checksums)
+    conn.execute("COMMIT")
+    return timings
+
+
+def build_incremental(conn, tables, checksums):
+    """Patch a copy of the live database with the changed tables only"""
+    conn.execute("BEGIN")
+    timings = {}
+    for table in tables:
+        timings[table] = apply_table_diff(conn, table)
+    write_id_dictionary(conn)
+    write_feed_meta(conn, checksums)
+    conn.execute("COMMIT")
+    return timings
+
+
+def main(full=False):
+    """
+    Main function to load all GTFS data, returns a process exit code
+    Only tables whose source file changed are touched unless full=True
+    """
     print("=" * 80)
     print("MiWay GTFS Data Loader")
     print("=" * 80)
     print()
-    
+
     # Check if GTFS directory exists
     if not os.path.exists(GTFS_DIR):
         print(f"❌ Error: {GTFS_DIR} directory not found!")
-        return
-    
-    # Remove old database if exists
-    if os.path.exists(DB_FILE):
-        print(f"Removing old database: {DB_FILE}")
-        os.remove(DB_FILE)
+        return 1
+
+    # Remove staging files left behind by an interrupted run
+    for path in (STAGING_FILE, COMPILED_STAGING_FILE):
+        if os.path.exists(path):
+            print(f"Removing stale staging file: {path}")
+            os.remove(path)
+            print()
+
+    started = time.time()
+
+    # Compare source files against what the live database was built from
+    checksums = feed_checksums()
+    live_meta = read_live_meta()
+    tables = None if full else changed_tables(live_meta, checksums)
+    if tables == []:
+        print("✅ Feed unchanged since the last load, nothing to do")
         print()
-    
-    # Connect to database
-    conn = sqlite3.connect(DB_FILE)
-    
+        if not compiled_is_current(live_meta):
+            # First run since the compiled timetable was introduced
+            compile_timetable(DB_FILE, COMPILED_STAGING_FILE)
+            os.replace(COMPILED_STAGING_FILE, COMPILED_FILE)
+            # A running app picks the new file up like any other reload
+            touch_generation()
+        return 0
+    if tables is None:
+        print("Full load (no compatible live database to patch)\n")
+    else:
+        print(f"Incremental load, changed files: {', '.join(TABLES[t][0] for t in tables)}\n")
+
+    # Parsing workers only pay off with spare cores; one process writes
+    pool = Pool(cpu_count() - 1) if tables is None and cpu_count() > 2 else None
+
+    conn = None
+    swapped = False
     try:
-        # Create schema
-        create_schema(conn)
-        
-        # Load data
-        load_stops(conn)
-        load_routes(conn)
-        load_trips(conn)
-        load_stop_times(conn)
-        
-        # Verify data
+        # Build the staging database; transactions are managed explicitly
+        if tables is None:
+            conn = sqlite3.connect(STAGING_FILE, isolation_level=None)
+        else:
+            conn = copy_live_database()
+        for pragma in FAST_LOAD_PRAGMAS:
+            conn.execute(pragma)
+
+        if tables is None:
+            timings = build_full(conn, pool, checksums)
+        else:
+            timings = build_incremental(conn, tables, checksums)
+
+        # Verify data before it goes live
+        print("Validating staging database...")
+        problems = validate(conn, timings)
+        if problems:
+            print("❌ Validation failed, live database left untouched:")
+            for problem in problems:
+                print(f"   - {problem}")
+            return 1
+        print("✅ Row counts look good\n")
+
         cursor = conn.cursor()
         cursor.execute("SELECT COUNT(*) FROM stops")
         stops_count = cursor.fetchone()[0]
-        
+
         cursor.execute("SELECT COUNT(*) FROM routes")
         routes_count = cursor.fetchone()[0]
-        
+
         cursor.execute("SELECT COUNT(*) FROM trips")
         trips_count = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM stop_times")
-        stop_times_count = cursor.fetchone()[0]
-        
+
+        stop_times_count = count_rows(conn, 'stop_times')
+
+        cursor.execute("SELECT COUNT(DISTINCT date) FROM calendar_dates")
+        service_days_count = cursor.fetchone()[0]
+
+        conn.close()
+        compile_timetable(STAGING_FILE, COMPILED_STAGING_FILE)
+        swap_into_place()
+        swapped = True
+
         print("=" * 80)
         print("✅ DATABASE LOADED SUCCESSFULLY!")
         print("=" * 80)
@@ -301,21 +1084,37 @@ def main():
         print(f"   - Routes:      {routes_count:,}")
         print(f"   - Trips:       {trips_count:,}")
         print(f"   - Stop Times:  {stop_times_count:,}")
+        print(f"   - Service Days: {service_days_count:,}")
+        print()
+        print(f"⏱️  Load time: {time.time() - started:.1f}s")
+        for table, (count, elapsed) in timings.items():
+            rate = count / elapsed if elapsed > 0 else 0
+            print(f"   - {table:<15} {count:>10,} rows  {elapsed:6.1f}s  {rate:>12,.0f} rows/sec")
         print()
-        print(f"💾 Database: {DB_FILE}")
+        print(f"💾 Database: {DB_FILE} (swapped in atomically, a running app picks it up on its own)")
+        print(f"🗓️  Timetable: {COMPILED_FILE} (mapped by the app at startup)")
         print()
         print("🚀 Ready to run the app! Run: python app.py")
         print()
-        
+        return 0
+
     except Exception as e:
         print(f"❌ Error: {e}")
         import traceback
         traceback.print_exc()
-    
+        return 1
+
     finally:
-        conn.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if conn is not None:
+            conn.close()
+        if not swapped:
+            for path in (STAGING_FILE, COMPILED_STAGING_FILE):
+                if os.path.exists(path):
+                    os.remove(path)
 
 
 if __name__ == '__main__':
-    main()
-
+    sys.exit(main(full='--full' in sys.argv[1:]))
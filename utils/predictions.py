@@ -0,0 +1,241 @@
+"""
+Realtime Arrival Predictions
+Latest predicted arrival for every (stop, trip) from the TripUpdates feed,
+kept in memory so an arrivals board or an ETA is a dictionary lookup
+"""
+
+import threading
+import time
+from datetime import datetime
+from utils.timetable import get_timetable
+
+# Arrivals this recent are still shown (the bus is at the stop)
+PAST_GRACE_SECONDS = 60
+
+
+def service_day_start(start_date):
+    """Unix timestamp of local midnight for a GTFS 'YYYYMMDD' date (today if None)"""
+    if start_date:
+        day = datetime.strptime(start_date, '%Y%m%d')
+    else:
+        day = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(day.timestamp())
+
+
+def predict_trip(tt, update):
+    """
+    Predicted arrival per stop for one trip update: [(stop, sequence, arrival, delay)]
+    with stop as the timetable's dense stop id; stops the timetable doesn't
+    know are left out. Stops without their own StopTimeUpdate inherit the
+    delay of the previous one, as GTFS-Realtime specifies; explicit times win
+    over delays
+    """
+    if update['schedule_relationship'] == 'CANCELED':
+        return []
+
+    stus = update['stop_time_updates']
+    trip = tt.trip_index.get(update['trip_id'])
+    if trip is None:
+        # Unknown trip: only stops with an absolute time can be predicted
+        predictions = []
+        for stu in stus:
+            stop = tt.stop_index.get(stu['stop_id'])
+            explicit = stu['arrival_time'] or stu['departure_time']
+            if stop is not None and explicit and stu['schedule_relationship'] != 'SKIPPED':
+                predictions.append((stop, stu['stop_sequence'], explicit, None))
+        return predictions
+
+    day_start = service_day_start(update['start_date'])
+    first, end = tt.trip_start[trip], tt.trip_start[trip + 1]
+    by_sequence = {stu['stop_sequence']: stu for stu in stus if stu['stop_sequence'] is not None}
+    by_stop = {tt.stop_index.get(stu['stop_id']): stu for stu in stus
+               if stu['stop_sequence'] is None and stu['stop_id']}
+
+    predictions = []
+    delay = None
+    started = False
+    for pos in range(first, end):
+        stop = tt.st_stop[pos]
+        stu = by_sequence.get(tt.st_sequence[pos]) or by_stop.get(stop)
+        scheduled = day_start + tt.st_arrival[pos]
+
+        if stu is not None:
+            started = True
+            if stu['schedule_relationship'] == 'SKIPPED':
+                continue
+            if stu['schedule_relationship'] == 'NO_DATA':
+                delay = None
+                continue
+            explicit = stu['arrival_time'] or stu['departure_time']
+            if explicit:
+                delay = explicit - scheduled
+            elif stu['arrival_delay'] is not None:
+                delay = stu['arrival_delay']
+            elif stu['departure_delay'] is not None:
+                delay = stu['departure_delay']
+
+        if started and delay is not None:
+            predictions.append((stop, tt.st_sequence[pos], scheduled + delay, delay))
+    return predictions
+
+
+class PredictionIndex:
+    """
+    stop -> {trip: (arrival, sequence, delay)} for the latest feed, keyed by
+    the timetable's dense ids. Trips missing from the static feed (added
+    trips) are numbered after the timetable's own. The public methods take
+    and return GTFS id strings; everything in between is integers.
+    apply() only rebuilds trips whose update changed since the previous feed
+    and drops trips that left it; version increases whenever anything changed
+    """
+
+    def __init__(self):
+        self.by_stop = {}
+        self.trip_updates = {}  # trip_id -> last applied update
+        self.trip_stops = {}    # trip -> stops it has predictions for
+        self.version = 0
+        self._tt = None
+        self._extra_trips = {}  # trip_id -> id, for trips not in self._tt
+        self._extra_trip_ids = []
+        self._lock = threading.Lock()
+
+    def apply(self, trip_updates, tt=None, keep_seconds=0):
+        """
+        Fold a freshly parsed TripUpdates feed in; trips missing from it are
+        kept while their last update is younger than keep_seconds, matching
+        the carry-over window of the trip_updates table
+        Returns the number of trips changed
+        """
+        if tt is None:
+            tt = get_timetable()
+
+        latest = {}
+        for update in trip_updates:
+            if update['trip_id']:
+                latest[update['trip_id']] = update
+
+        cutoff = time.time() - keep_seconds
+        changed = 0
+        with self._lock:
+            if tt is not self._tt:
+                self._renumber(tt)
+
+            for trip_id, previous in list(self.trip_updates.items()):
+                if trip_id not in latest and (not keep_seconds or (previous['timestamp'] or 0) < cutoff):
+                    self._remove(trip_id)
+                    changed += 1
+
+            for trip_id, update in latest.items():
+                previous = self.trip_updates.get(trip_id)
+                if previous is not None and previous['stop_time_updates'] == update['stop_time_updates'] \
+                        and previous['start_date'] == update['start_date'] \
+                        and previous['schedule_relationship'] == update['schedule_relationship']:
+                    continue
+                self._replace(trip_id, update)
+                changed += 1
+
+            if changed:
+                self.version += 1
+        return changed
+
+    def rebuild(self, tt=None):
+        """Re-resolve every held update against a reloaded timetable"""
+        if tt is None:
+            tt = get_timetable()
+        with self._lock:
+            self._renumber(tt)
+            self.version += 1
+
+    def _renumber(self, tt):
+        """Switch to another timetable's ids, re-resolving every held update (lock held)"""
+        updates = self.trip_updates
+        self.by_stop = {}
+        self.trip_updates = {}
+        self.trip_stops = {}
+        self._tt = tt
+        self._extra_trips = {}
+        self._extra_trip_ids = []
+        for trip_id, update in updates.items():
+            self._replace(trip_id, update)
+
+    def _trip(self, trip_id, add=False):
+        """Dense id of a trip_id, numbering trips the timetable lacks if add"""
+        trip = self._tt.trip_index.get(trip_id)
+        if trip is None:
+            trip = self._extra_trips.get(trip_id)
+        if trip is None and add:
+            trip = self._extra_trips[trip_id] = len(self._tt.trip_ids) + len(self._extra_trip_ids)
+            self._extra_trip_ids.append(trip_id)
+        return trip
+
+    def _trip_id(self, trip):
+        """GTFS trip_id of a dense id from _trip"""
+        n_trips = len(self._tt.trip_ids)
+        return self._tt.trip_ids[trip] if trip < n_trips else self._extra_trip_ids[trip - n_trips]
+
+    def _replace(self, trip_id, update):
+        """Swap in the predictions of one trip (lock held)"""
+        self._remove(trip_id)
+        trip = self._trip(trip_id, add=True)
+        stops = []
+        for stop, sequence, arrival, delay in predict_trip(self._tt, update):
+            at_stop = self.by_stop.setdefault(stop, {})
+            if trip not in at_stop:  # loop trips: first visit wins
+                at_stop[trip] = (arrival, sequence, delay)
+                stops.append(stop)
+        self.trip_updates[trip_id] = update
+        self.trip_stops[trip] = stops
+
+    def _remove(self, trip_id):
+        """Drop every prediction of a trip (lock held)"""
+        trip = self._trip(trip_id)
+        for stop in self.trip_stops.pop(trip, ()):
+            at_stop = self.by_stop.get(stop)
+            if at_stop is not None:
+                at_stop.pop(trip, None)
+                if not at_stop:
+                    del self.by_stop[stop]
+        self.trip_updates.pop(trip_id, None)
+
+    def arrivals(self, stop_id, now=None, limit=10):
+        """Upcoming predicted arrivals at a stop: [(arrival, trip_id, sequence, delay)], soonest first"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self._tt is None:
+                return []
+            at_stop = list(self.by_stop.get(self._tt.stop_index.get(stop_id), {}).items())
+            upcoming = [(arrival, trip, sequence, delay)
+                        for trip, (arrival, sequence, delay) in at_stop
+                        if arrival >= now - PAST_GRACE_SECONDS]
+            upcoming.sort()
+            return [(arrival, self._trip_id(trip), sequence, delay)
+                    for arrival, trip, sequence, delay in upcoming[:limit]]
+
+    def eta(self, trip_id, stop_id):
+        """Predicted arrival timestamp of a trip at a stop, or None"""
+        with self._lock:
+            if self._tt is None:
+                return None
+            at_stop = self.by_stop.get(self._tt.stop_index.get(stop_id))
+            prediction = at_stop.get(self._trip(trip_id)) if at_stop else None
+        return prediction[0] if prediction else None
+
+    def stats(self):
+        """Counts for logging"""
+        with self._lock:
+            return {
+                'version': self.version,
+                'trips': len(self.trip_updates),
+                'stops': len(self.by_stop),
+                'predictions': sum(len(at_stop) for at_stop in self.by_stop.values())
+            }
+
+
+# Shared by the background updater (writer) and request handlers (readers)
+_prediction_index = PredictionIndex()
+
+
+def get_prediction_index():
+    """Return the process-wide prediction index"""
+    return _prediction_index
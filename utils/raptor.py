@@ -0,0 +1,240 @@
+"""
+RAPTOR Journey Planner
+Round-based multi-leg journey search over the in-memory timetable
+"""
+
+from bisect import bisect_left
+from utils.timetable import format_gtfs_time
+
+INFINITY = 2 ** 31 - 1
+
+# Extra time needed to change buses at a stop after riding
+MIN_TRANSFER_SECONDS = 60
+
+
+def plan_journeys(tt, source_stop_id, dest_stop_id, depart_secs, max_transfers=2, walking=True,
+                  service_date=None):
+    """
+    Find Pareto-optimal journeys (earliest arrival vs. number of transfers)
+    Round k of RAPTOR finds the best arrival at every stop using k trips;
+    each round only scans the patterns touched by stops improved in the
+    previous round. With a service_date, patterns and trips not running that
+    day are skipped. Returns a list of journeys, fewest transfers first.
+    """
+    source = tt.stop_index.get(source_stop_id)
+    target = tt.stop_index.get(dest_stop_id)
+    if source is None or target is None:
+        return []
+
+    active = tt.service_day(service_date)
+    trip_active, pattern_active = active if active is not None else (None, None)
+
+    n_stops = len(tt.stop_ids)
+    best = [INFINITY] * n_stops
+    rounds = []
+
+    labels = [INFINITY] * n_stops
+    parents = {}
+    labels[source] = depart_secs
+    best[source] = depart_secs
+    marked = {source}
+    if walking:
+        marked |= _relax_transfers(tt, {source}, labels, best, parents, target)
+    rounds.append((labels, parents))
+
+    for k in range(1, max_transfers + 2):
+        prev_labels = rounds[-1][0]
+        labels = list(prev_labels)
+        parents = {}
+        slack = MIN_TRANSFER_SECONDS if k > 1 else 0
+
+        queue = _collect_patterns(tt, marked, pattern_active)
+        improved = _scan_patterns(tt, queue, prev_labels, labels, best, parents,
+                                  target, slack, trip_active)
+        if walking and improved:
+            improved |= _relax_transfers(tt, improved, labels, best, parents, target)
+
+        rounds.append((labels, parents))
+        if not improved:
+            break
+        marked = improved
+
+    journeys = []
+    best_arrival = INFINITY
+    for k in range(1, len(rounds)):
+        arrival = rounds[k][0][target]
+        if arrival < best_arrival:
+            best_arrival = arrival
+            journeys.append(_build_journey(tt, rounds, k, source, target, depart_secs))
+    return journeys
+
+
+def _collect_patterns(tt, marked, pattern_active=None):
+    """Earliest marked position for every running pattern serving a marked stop"""
+    queue = {}
+    sp_pattern = tt.sp_pattern
+    sp_pos = tt.sp_pos
+    for stop in marked:
+        for i in range(tt.stop_pattern_start[stop], tt.stop_pattern_start[stop + 1]):
+            pattern = sp_pattern[i]
+            if pattern_active is not None and not pattern_active[pattern]:
+                continue
+            pos = sp_pos[i]
+            if pos < queue.get(pattern, INFINITY):
+                queue[pattern] = pos
+    return queue
+
+
+def _scan_patterns(tt, queue, prev_labels, labels, best, parents, target, slack, trip_active=None):
+    """Ride every queued pattern from its earliest marked stop"""
+    pattern_stops = tt.pattern_stops
+    pattern_start = tt.pattern_start
+    pattern_trip_start = tt.pattern_trip_start
+    pattern_time_start = tt.pattern_time_start
+    pt_arrival = tt.pt_arrival
+    pt_departure = tt.pt_departure
+    pattern_trips = tt.pattern_trips
+
+    improved = set()
+    for pattern, first_pos in queue.items():
+        stops_base = pattern_start[pattern]
+        n_positions = pattern_start[pattern + 1] - stops_base
+        n_trips = pattern_trip_start[pattern + 1] - pattern_trip_start[pattern]
+        time_base = pattern_time_start[pattern]
+        trips_base = pattern_trip_start[pattern]
+
+        trip = -1
+        board_pos = -1
+        for pos in range(first_pos, n_positions):
+            stop = pattern_stops[stops_base + pos]
+            column = time_base + pos * n_trips
+
+            if trip >= 0:
+                arrival = pt_arrival[column + trip]
+                if arrival < best[stop] and arrival < best[target]:
+                    labels[stop] = arrival
+                    best[stop] = arrival
+                    parents[stop] = ('ride', pattern, trip, board_pos, pos)
+                    improved.add(stop)
+
+            ready = prev_labels[stop]
+            if ready == INFINITY:
+                continue
+            ready += slack
+            if trip < 0 or ready <= pt_departure[column + trip]:
+                end = column + (trip if trip >= 0 else n_trips)
+                i = bisect_left(pt_departure, ready, column, end)
+                if trip_active is not None:
+                    while i < end and not trip_active[pattern_trips[trips_base + i - column]]:
+                        i += 1
+                if i < end:
+                    trip = i - column
+                    board_pos = pos
+
+    return improved
+
+
+def _relax_transfers(tt, stops, labels, best, parents, target):
+    """
+    Walk from every improved stop to its neighbours
+    Stops reached by bus in this round are not overwritten by a walk, so a
+    journey never chains two walking legs
+    """
+    transfer_start = tt.transfer_start
+    transfer_stop = tt.transfer_stop
+    transfer_seconds = tt.transfer_seconds
+
+    improved = set()
+    for stop in stops:
+        reached = labels[stop]
+        for i in range(transfer_start[stop], transfer_start[stop + 1]):
+            neighbour = transfer_stop[i]
+            if neighbour in stops:
+                continue
+            arrival = reached + transfer_seconds[i]
+            if arrival < best[neighbour] and arrival < best[target]:
+                labels[neighbour] = arrival
+                best[neighbour] = arrival
+                parents[neighbour] = ('walk', stop, i)
+                improved.add(neighbour)
+    return improved
+
+
+def _build_journey(tt, rounds, k, source, target, depart_secs):
+    """Walk the parent pointers back from the target to the source"""
+    legs = []
+    stop = target
+    while stop != source:
+        while k > 0 and stop not in rounds[k][1]:
+            k -= 1
+        parent = rounds[k][1].get(stop)
+        if parent is None:
+            break
+
+        if parent[0] == 'walk':
+            _, from_stop, link = parent
+            legs.append(_describe_walk(tt, from_stop, stop, link))
+            stop = from_stop
+        else:
+            _, pattern, trip, board_pos, alight_pos = parent
+            legs.append(_describe_ride(tt, pattern, trip, board_pos, alight_pos))
+            stop = tt.pattern_stops[tt.pattern_start[pattern] + board_pos]
+            k -= 1
+    legs.reverse()
+
+    # Walking legs start as soon as the previous leg ends
+    clock = depart_secs
+    for leg in legs:
+        if leg['type'] == 'walk':
+            leg['departure_secs'] = clock
+            leg['arrival_secs'] = clock + leg['duration_seconds']
+        clock = leg['arrival_secs']
+
+    rides = [leg for leg in legs if leg['type'] == 'ride']
+    start = legs[0]['departure_secs'] if legs else depart_secs
+    if legs and legs[0]['type'] == 'walk' and rides:
+        # Leave just in time to walk to the first bus
+        legs[0]['arrival_secs'] = rides[0]['departure_secs']
+        legs[0]['departure_secs'] = rides[0]['departure_secs'] - legs[0]['duration_seconds']
+        start = legs[0]['departure_secs']
+    end = legs[-1]['arrival_secs'] if legs else depart_secs
+
+    for leg in legs:
+        leg['departure_time'] = format_gtfs_time(leg.pop('departure_secs'))
+        leg['arrival_time'] = format_gtfs_time(leg.pop('arrival_secs'))
+
+    return {
+        'departure_time': format_gtfs_time(start),
+        'arrival_time': format_gtfs_time(end),
+        'duration_minutes': (end - start) // 60,
+        'transfers': max(len(rides) - 1, 0),
+        'legs': legs
+    }
+
+
+def _describe_ride(tt, pattern, trip, board_pos, alight_pos):
+    """JSON-ready ride leg"""
+    trip_row = tt.pattern_trips[tt.pattern_trip_start[pattern] + trip]
+    first = tt.trip_start[trip_row]
+    leg = tt.describe_leg(trip_row, first + board_pos, first + alight_pos)
+    leg['type'] = 'ride'
+    leg['departure_secs'] = tt.st_departure[first + board_pos]
+    leg['arrival_secs'] = tt.st_arrival[first + alight_pos]
+    leg['source_stop_id'] = tt.stop_ids[tt.st_stop[first + board_pos]]
+    leg['dest_stop_id'] = tt.stop_ids[tt.st_stop[first + alight_pos]]
+    return leg
+
+
+def _describe_walk(tt, from_stop, to_stop, link):
+    """JSON-ready walking leg"""
+    seconds = tt.transfer_seconds[link]
+    return {
+        'type': 'walk',
+        'source_stop': tt.stop_names[from_stop],
+        'source_stop_id': tt.stop_ids[from_stop],
+        'dest_stop': tt.stop_names[to_stop],
+        'dest_stop_id': tt.stop_ids[to_stop],
+        'distance_km': round(tt.transfer_meters[link] / 1000, 2),
+        'duration_seconds': seconds,
+        'duration_minutes': max(1, round(seconds / 60))
+    }
@@ -0,0 +1,113 @@
+"""
+Response Cache
+Pre-serialized, pre-compressed JSON bodies for hot read endpoints
+"""
+
+import gzip
+import hashlib
+import threading
+
+try:
+    import brotli
+except ImportError:  # Optional: gzip only without it
+    brotli = None
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES = 512
+
+# Entries kept across all endpoints and query strings
+MAX_ENTRIES = 256
+
+
+class CachedBody:
+    """One serialized response in every encoding, with a strong ETag per encoding"""
+
+    def __init__(self, body):
+        digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.bodies = {None: body}
+        self.etags = {None: f'"{digest}"'}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.bodies['gzip'] = gzip.compress(body, compresslevel=6, mtime=0)
+            self.etags['gzip'] = f'"{digest}-gz"'
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(body, quality=5)
+                self.etags['br'] = f'"{digest}-br"'
+
+    def select(self, accept_encoding):
+        """(encoding, body, etag) for the best encoding the client accepts"""
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and encoding in accepted:
+                return encoding, self.bodies[encoding], self.etags[encoding]
+        return None, self.bodies[None], self.etags[None]
+
+    def matches(self, if_none_match):
+        """Whether an If-None-Match header names this content in any encoding"""
+        if not if_none_match:
+            return False
+        tags = {tag.strip() for tag in if_none_match.split(',')}
+        if '*' in tags:
+            return True
+        tags |= {tag[2:] for tag in tags if tag.startswith('W/')}
+        return any(etag in tags for etag in self.etags.values())
+
+
+def parse_accept_encoding(header):
+    """Set of content codings an Accept-Encoding header allows"""
+    accepted = set()
+    for part in (header or '').split(','):
+        coding, *params = part.split(';')
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding.strip() and quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class ResponseCache:
+    """
+    (endpoint, query args, generation) -> CachedBody
+    The generation is whatever identifies the data behind the endpoint (the
+    database file for static data, a snapshot version for realtime data);
+    storing a new generation for an endpoint drops that endpoint's older ones
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.entries = {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, args, generation):
+        """Cached body or None"""
+        with self._lock:
+            entry = self.entries.get((endpoint, args, generation))
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, endpoint, args, generation, body):
+        """Serialize-once store; returns the CachedBody"""
+        entry = CachedBody(body)
+        with self._lock:
+            stale = [key for key in self.entries if key[0] == endpoint and key[2] != generation]
+            for key in stale:
+                del self.entries[key]
+            self.entries[(endpoint, args, generation)] = entry
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        return entry
+
+    def stats(self):
+        """Hit/miss counts for status pages"""
+        with self._lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,141 @@
+"""
+Spatial Helpers
+Great-circle distances between stops and user locations
+"""
+
+import math
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Calculate the great circle distance between two points 
+    on the earth (specified in decimal degrees)
+    Returns distance in kilometers
+    """
+    # Convert decimal degrees to radians
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    
+    # Haversine formula
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
+    c = 2 * math.asin(math.sqrt(a))
+    
+    # Radius of earth in kilometers
+    r = 6371
+    
+    return c * r
+
+
+class StopGrid:
+    """
+    Uniform lat/lon grid over stop coordinates
+    Cells are roughly CELL_KM on a side; nearest-stop queries search rings of
+    cells outward from the query point and stop as soon as no unvisited cell
+    can hold anything closer, so only a handful of stops are ever measured.
+    Rings are clipped to the grid, and a query point outside the grid measures
+    every point instead: its rings would be mostly empty cells.
+    """
+
+    CELL_KM = 0.25
+
+    def __init__(self, points):
+        """points: iterable of (key, lat, lon)"""
+        self.points = [(key, lat, lon) for key, lat, lon in points
+                       if lat is not None and lon is not None]
+        self.cells = {}
+
+        if not self.points:
+            self.cell_lat = self.cell_lon = 1.0
+            self.min_row = self.max_row = self.min_col = self.max_col = 0
+            return
+
+        mid_lat = sum(lat for _, lat, _ in self.points) / len(self.points)
+        self.min_lat = min(lat for _, lat, _ in self.points)
+        self.max_lat = max(lat for _, lat, _ in self.points)
+        self.cell_lat = self.CELL_KM / 111.0
+        self.cell_lon = self.CELL_KM / (111.0 * math.cos(math.radians(mid_lat)))
+
+        for i, (_, lat, lon) in enumerate(self.points):
+            self.cells.setdefault(self._cell(lat, lon), []).append(i)
+
+        rows = [row for row, _ in self.cells]
+        cols = [col for _, col in self.cells]
+        self.min_row, self.max_row = min(rows), max(rows)
+        self.min_col, self.max_col = min(cols), max(cols)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_lat)), int(math.floor(lon / self.cell_lon))
+
+    def _ring(self, row, col, r):
+        """Cells of the grid exactly r steps (Chebyshev distance) from (row, col)"""
+        if r == 0:
+            yield row, col
+            return
+        first_col, last_col = max(col - r, self.min_col), min(col + r, self.max_col)
+        for rr in (row - r, row + r):
+            if self.min_row <= rr <= self.max_row:
+                for c in range(first_col, last_col + 1):
+                    yield rr, c
+        first_row, last_row = max(row - r + 1, self.min_row), min(row + r - 1, self.max_row)
+        for c in (col - r, col + r):
+            if self.min_col <= c <= self.max_col:
+                for rr in range(first_row, last_row + 1):
+                    yield rr, c
+
+    def nearest(self, lat, lon, k=10, max_km=None):
+        """
+        The k closest points as (distance_km, key, lat, lon), nearest first
+        Points further than max_km are ignored
+        """
+        if not self.points or k <= 0:
+            return []
+
+        row, col = self._cell(lat, lon)
+        if not (self.min_row <= row <= self.max_row and self.min_col <= col <= self.max_col):
+            return self._scan(lat, lon, k, max_km)
+
+        max_r = max(row - self.min_row, self.max_row - row, col - self.min_col, self.max_col - col)
+        if max_km is not None:
+            max_r = min(max_r, int(max_km / self.CELL_KM) + 1)
+
+        found = []
+        for r in range(max_r + 1):
+            for cell in self._ring(row, col, r):
+                for i in self.cells.get(cell, ()):
+                    key, plat, plon = self.points[i]
+                    km = haversine_distance(lat, lon, plat, plon)
+                    if max_km is None or km <= max_km:
+                        found.append((km, key, plat, plon))
+
+            # Anything outside ring r is at least r cells away
+            if len(found) >= k:
+                found.sort()
+                if found[k - 1][0] <= r * self.CELL_KM:
+                    break
+
+        found.sort()
+        return found[:k]
+
+    def _scan(self, lat, lon, k, max_km):
+        """nearest() for a point outside the grid: measure every point"""
+        # Every point is at least the distance along the meridian to the
+        # grid's latitude band away; skip the scan if that is already too far
+        edge_lat = min(max(lat, self.min_lat), self.max_lat)
+        if max_km is not None and haversine_distance(lat, lon, edge_lat, lon) > max_km:
+            return []
+
+        found = []
+        for key, plat, plon in self.points:
+            km = haversine_distance(lat, lon, plat, plon)
+            if max_km is None or km <= max_km:
+                found.append((km, key, plat, plon))
+        found.sort()
+        return found[:k]
+
+    def within(self, lat, lon, radius_km):
+        """Every point within radius_km as (distance_km, key, lat, lon), nearest first"""
+        return self.nearest(lat, lon, len(self.points), max_km=radius_km)
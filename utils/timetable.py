@@ -0,0 +1,856 @@
+"""
+In-Memory Timetable Engine
+Loads the static schedule once and answers route searches without SQLite
+"""
+
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+from itertools import groupby
+from utils.spatial import StopGrid
+
+DB_FILE = 'miway.db'
+
+# Compiled timetable written by load_gtfs.py next to the database. The app maps
+# it read-only instead of rebuilding from SQLite, and the pages are shared by
+# every process that maps the same file.
+COMPILED_FILE = 'miway.timetable'
+
+# File layout: magic, header length (little-endian uint64), JSON header, then
+# each integer array at an 8-byte aligned offset listed in the header. Bump
+# the magic when the layout or the set of arrays changes.
+COMPILED_MAGIC = b'MWTT0001'
+COMPILED_ALIGN = 8
+
+# Integer arrays stored in the compiled file (everything else goes in the header)
+COMPILED_ARRAYS = [
+    'trip_route', 'trip_service', 'trip_start',
+    'st_stop', 'st_sequence', 'st_arrival', 'st_departure',
+    'stop_start', 'dep_time', 'dep_trip', 'dep_pos',
+    'trip_pattern', 'pattern_start', 'pattern_stops', 'pattern_trip_start', 'pattern_trips',
+    'pattern_time_start', 'pt_arrival', 'pt_departure',
+    'stop_pattern_start', 'sp_pattern', 'sp_pos',
+    'transfer_start', 'transfer_stop', 'transfer_seconds', 'transfer_meters',
+]
+
+# Lists stored in the header; the *_index dicts are rebuilt from the id lists
+COMPILED_LISTS = [
+    'stop_ids', 'stop_names', 'stop_lats', 'stop_lons', 'stop_location_types',
+    'route_ids', 'route_short_names', 'route_long_names', 'route_colors',
+    'trip_ids', 'trip_headsigns', 'service_ids',
+]
+
+# Trips after midnight are listed under the previous service day with times past 24:00
+SECONDS_PER_DAY = 86400
+
+# Walking transfers between nearby stops
+MAX_WALK_KM = 0.4
+WALK_SPEED_KMH = 4.5
+
+
+def parse_gtfs_time(value):
+    """
+    Convert a GTFS 'HH:MM:SS' string to seconds since midnight
+    Hours may exceed 23 for trips running past midnight
+    """
+    if not value:
+        return None
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def format_gtfs_time(seconds):
+    """Convert seconds since midnight back to a GTFS 'HH:MM:SS' string"""
+    if seconds is None:
+        return None
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def get_feed_meta(conn, key):
+    """Return a feed_meta value written by load_gtfs.py (None for old databases)"""
+    try:
+        row = conn.execute("SELECT value FROM feed_meta WHERE key = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def get_feed_version(conn):
+    """Return the load marker written by load_gtfs.py (None for old databases)"""
+    return get_feed_meta(conn, 'loaded_at')
+
+
+def read_ids(conn, kind):
+    """{gtfs_id: dense id} for one kind of load_gtfs.py's id dictionary ({} for old databases)"""
+    try:
+        return dict(conn.execute("SELECT gtfs_id, id FROM gtfs_ids WHERE kind = ?", (kind,)))
+    except sqlite3.OperationalError:
+        return {}
+
+
+def read_in_id_order(conn, kind, query, hole):
+    """
+    Rows of query, whose first column is the GTFS id, placed at their id in
+    load_gtfs.py's id dictionary so that row i is id i. Until the loader
+    closes them, the ids of GTFS ids gone from the feed hold `hole`. Older
+    databases come back in table order.
+    """
+    rows = conn.execute(query).fetchall()
+    ids = read_ids(conn, kind)
+    if not ids:
+        return rows
+    placed = [hole] * (max(ids.values()) + 1)
+    for row in rows:
+        placed[ids[row[0]]] = row
+    return placed
+
+
+def unpack_schedule(stops, start, arrival_offsets, departure_offsets):
+    """
+    Expand a packed trip (see load_gtfs.pack_stop_times) against its pattern's
+    [(stop_id, sequence)] into [(stop_id, sequence, arrival, departure)]
+    """
+    arrivals = [None if offset is None else start + offset for offset in json.loads(arrival_offsets)]
+    departures = arrivals if departure_offsets is None else [
+        None if offset is None else start + offset for offset in json.loads(departure_offsets)]
+    return [(stop_id, sequence, arrival, departure)
+            for (stop_id, sequence), arrival, departure in zip(stops, arrivals, departures)]
+
+
+class Timetable:
+    """
+    Static schedule held in flat arrays
+
+    Stop times are stored once, grouped by trip and ordered by stop_sequence
+    (st_* arrays, sliced with trip_start). A second set of arrays lists every
+    visit to a stop sorted by departure time (dep_* arrays, sliced with
+    stop_start), which the nearby-bus matcher walks.
+
+    For the route search and journey planner, trips with the same ordered stop
+    list are grouped into patterns. Pattern times are stored column-major (one
+    column per stop, one row per trip) so the departures at any stop of a
+    pattern are a contiguous, sorted slice of pt_departure. The sp_* arrays,
+    sliced with stop_pattern_start, list the patterns serving each stop.
+
+    Stops, routes, trips and services are numbered by the gtfs_ids dictionary
+    that load_gtfs.py writes, so every index here is the id the database
+    records for the same GTFS id, stable across reloads; *_ids lists map them
+    back to strings (None for ids no longer in the feed).
+    """
+
+    def __init__(self):
+        self.version = None
+        self.feed_version = None  # feed_info.txt feed_version
+        self.loaded_at = None
+        self.load_seconds = None
+        self.source = None  # 'sqlite' or 'compiled'
+        self._mmap = None
+
+        # Stops
+        self.stop_ids = []
+        self.stop_index = {}
+        self.stop_names = []
+        self.stop_lats = []
+        self.stop_lons = []
+        self.stop_location_types = []
+        self.stop_grid = StopGrid(())
+
+        # Routes
+        self.route_ids = []
+        self.route_index = {}
+        self.route_short_names = []
+        self.route_long_names = []
+        self.route_colors = []
+
+        # Trips
+        self.trip_ids = []
+        self.trip_index = {}
+        self.trip_route = array('i')
+        self.trip_headsigns = []
+        self.trip_service = array('i')
+        self.trip_start = array('i')
+
+        # Service calendar: 'YYYYMMDD' -> bitmask of active service indexes
+        self.service_ids = []
+        self.service_index = {}
+        self.service_days = None
+        self._active_cache = {}
+        self._active_lock = threading.Lock()  # Request threads share the cache
+
+        # Stop times, grouped by trip
+        self.st_stop = array('i')
+        self.st_sequence = array('i')
+        self.st_arrival = array('i')
+        self.st_departure = array('i')
+
+        # Stop visits, grouped by stop and sorted by departure
+        self.stop_start = array('i')
+        self.dep_time = array('i')
+        self.dep_trip = array('i')
+        self.dep_pos = array('i')
+
+        # Patterns (trips sharing an ordered stop list)
+        self.trip_pattern = array('i')
+        self.pattern_start = array('i')
+        self.pattern_stops = array('i')
+        self.pattern_trip_start = array('i')
+        self.pattern_trips = array('i')
+        self.pattern_time_start = array('i')
+        self.pt_arrival = array('i')
+        self.pt_departure = array('i')
+
+        # Patterns serving each stop, with the stop's position in the pattern
+        self.stop_pattern_start = array('i')
+        self.sp_pattern = array('i')
+        self.sp_pos = array('i')
+
+        # Walking transfers between nearby stops
+        self.transfer_start = array('i')
+        self.transfer_stop = array('i')
+        self.transfer_seconds = array('i')
+        self.transfer_meters = array('i')
+
+    @classmethod
+    def load(cls, db_file=DB_FILE):
+        """Build a timetable from the SQLite database"""
+        started = time.time()
+        tt = cls()
+
+        conn = sqlite3.connect(db_file)
+        try:
+            tt.version = get_feed_version(conn)
+            tt.feed_version = get_feed_meta(conn, 'feed_version')
+            tt._load_stops(conn)
+            tt._load_routes(conn)
+            tt._load_trips(conn)
+            tt._load_calendar(conn)
+            tt._load_stop_times(conn)
+        finally:
+            conn.close()
+
+        tt._build_stop_index()
+        tt._build_patterns()
+        tt._build_transfers()
+        tt.source = 'sqlite'
+        tt.loaded_at = time.time()
+        tt.load_seconds = tt.loaded_at - started
+        return tt
+
+    def save(self, path):
+        """Write the timetable in the compiled layout read by open()"""
+        arrays = {}
+        offset = 0
+        for name in COMPILED_ARRAYS:
+            values = getattr(self, name)
+            arrays[name] = [offset, len(values)]
+            offset += -(-len(values) * values.itemsize // COMPILED_ALIGN) * COMPILED_ALIGN
+
+        header = {
+            'version': self.version,
+            'feed_version': self.feed_version,
+            'byteorder': sys.byteorder,
+            'itemsize': array('i').itemsize,
+            'service_days': self.service_days,
+            'lists': {name: getattr(self, name) for name in COMPILED_LISTS},
+            'arrays': arrays,
+        }
+        header = json.dumps(header, separators=(',', ':')).encode()
+        data_start = -(-(len(COMPILED_MAGIC) + 8 + len(header)) // COMPILED_ALIGN) * COMPILED_ALIGN
+
+        with open(path, 'wb') as f:
+            f.write(COMPILED_MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for name in COMPILED_ARRAYS:
+                f.seek(data_start + arrays[name][0])
+                getattr(self, name).tofile(f)
+            f.truncate(data_start + offset)
+
+    @classmethod
+    def open(cls, path=COMPILED_FILE):
+        """
+        Map a timetable written by save()
+        The integer arrays are read-only views of the mapped file, so nothing
+        is copied and processes mapping the same file share its pages; only
+        the header (ids, names, calendar) is decoded. Raises ValueError for a
+        file from another layout or platform.
+        """
+        started = time.time()
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mapped[:len(COMPILED_MAGIC)] != COMPILED_MAGIC:
+            raise ValueError(f"{path}: not a compiled timetable")
+        header_start = len(COMPILED_MAGIC) + 8
+        (header_length,) = struct.unpack('<Q', mapped[len(COMPILED_MAGIC):header_start])
+        header = json.loads(mapped[header_start:header_start + header_length])
+        if header['byteorder'] != sys.byteorder or header['itemsize'] != array('i').itemsize:
+            raise ValueError(f"{path}: compiled on a different platform")
+
+        tt = cls()
+        tt.version = header['version']
+        tt.feed_version = header['feed_version']
+        tt.service_days = header['service_days']
+        for name, values in header['lists'].items():
+            setattr(tt, name, values)
+        tt.stop_index = {stop_id: i for i, stop_id in enumerate(tt.stop_ids) if stop_id is not None}
+        tt.route_index = {route_id: i for i, route_id in enumerate(tt.route_ids) if route_id is not None}
+        tt.trip_index = {trip_id: i for i, trip_id in enumerate(tt.trip_ids) if trip_id is not None}
+        tt.service_index = {service_id: i for i, service_id in enumerate(tt.service_ids) if service_id is not None}
+
+        data_start = -(-(header_start + header_length) // COMPILED_ALIGN) * COMPILED_ALIGN
+        view = memoryview(mapped)
+        itemsize = header['itemsize']
+        for name in COMPILED_ARRAYS:
+            offset, length = header['arrays'][name]
+            start = data_start + offset
+            setattr(tt, name, view[start:start + length * itemsize].cast('i'))
+
+        tt._build_grid()
+        tt._mmap = mapped
+        tt.source = 'compiled'
+        tt.loaded_at = time.time()
+        tt.load_seconds = tt.loaded_at - started
+        return tt
+
+    def _load_stops(self, conn):
+        # Holes get location_type -1, which keeps them out of the grid and transfers
+        cursor = read_in_id_order(conn, 'stop', """
+            SELECT stop_id, stop_name, stop_lat, stop_lon, location_type
+            FROM stops
+        """, (None, None, None, None, -1))
+        for stop_id, stop_name, stop_lat, stop_lon, location_type in cursor:
+            if stop_id is not None:
+                self.stop_index[stop_id] = len(self.stop_ids)
+            self.stop_ids.append(stop_id)
+            self.stop_names.append(stop_name)
+            self.stop_lats.append(stop_lat)
+            self.stop_lons.append(stop_lon)
+            self.stop_location_types.append(location_type or 0)
+        self._build_grid()
+
+    def _build_grid(self):
+        """Spatial index over boarding stops (parent stations excluded)"""
+        self.stop_grid = StopGrid(
+            (stop, lat, lon)
+            for stop, (lat, lon, location_type) in enumerate(
+                zip(self.stop_lats, self.stop_lons, self.stop_location_types))
+            if location_type == 0
+        )
+
+    def _load_routes(self, conn):
+        cursor = read_in_id_order(conn, 'route', """
+            SELECT route_id, route_short_name, route_long_name, route_color
+            FROM routes
+        """, (None, None, None, None))
+        for route_id, short_name, long_name, color in cursor:
+            if route_id is not None:
+                self.route_index[route_id] = len(self.route_ids)
+            self.route_ids.append(route_id)
+            self.route_short_names.append(short_name)
+            self.route_long_names.append(long_name)
+            self.route_colors.append(color)
+
+    def _load_trips(self, conn):
+        services = read_ids(conn, 'service')
+        self.service_ids = [None] * (max(services.values()) + 1 if services else 0)
+        for service_id, service in services.items():
+            self.service_ids[service] = service_id
+            self.service_index[service_id] = service
+
+        # Holes have no route and service -1, and never get stop times
+        cursor = read_in_id_order(conn, 'trip', "SELECT trip_id, route_id, service_id, trip_headsign FROM trips",
+                                  (None, None, None, None))
+        for trip_id, route_id, service_id, headsign in cursor:
+            if trip_id is not None:
+                self.trip_index[trip_id] = len(self.trip_ids)
+            self.trip_ids.append(trip_id)
+            self.trip_route.append(self.route_index.get(route_id, -1))
+            self.trip_service.append(self._service(service_id) if trip_id is not None else -1)
+            self.trip_headsigns.append(headsign)
+
+    def _service(self, service_id):
+        if service_id not in self.service_index:
+            self.service_index[service_id] = len(self.service_ids)
+            self.service_ids.append(service_id)
+        return self.service_index[service_id]
+
+    def _load_calendar(self, conn):
+        """
+        Build the active-service bitmask for every service day
+        Databases loaded before calendar_dates existed leave service_days
+        as None, which disables calendar filtering
+        """
+        try:
+            rows = conn.execute("""
+                SELECT service_id, date, exception_type
+                FROM calendar_dates
+                ORDER BY date
+            """).fetchall()
+        except sqlite3.OperationalError:
+            return
+
+        self.service_days = {}
+        for service_id, date, exception_type in rows:
+            bit = 1 << self._service(service_id)
+            mask = self.service_days.get(date, 0)
+            self.service_days[date] = mask | bit if exception_type == 1 else mask & ~bit
+
+    def _load_stop_times(self, conn):
+        """Load stop times grouped by trip, in trip order"""
+        try:
+            trips = self._read_trip_schedules(conn)
+        except sqlite3.OperationalError:
+            # Databases loaded before stop_times was packed by pattern
+            trips = self._read_stop_time_rows(conn)
+
+        rows_by_trip = [None] * len(self.trip_ids)
+        for trip_id, visits in trips:
+            trip = self.trip_index.get(trip_id)
+            if trip is None:
+                continue
+
+            rows = rows_by_trip[trip] = []
+            for stop_id, sequence, arrival_secs, departure_secs in visits:
+                stop = self.stop_index.get(stop_id)
+                if stop is None:
+                    continue
+                if departure_secs is None:
+                    departure_secs = arrival_secs
+                if arrival_secs is None:
+                    arrival_secs = departure_secs
+                if departure_secs is None:
+                    continue
+                rows.append((stop, sequence, arrival_secs, departure_secs))
+
+        for rows in rows_by_trip:
+            self.trip_start.append(len(self.st_stop))
+            for stop, sequence, arrival_secs, departure_secs in rows or ():
+                self.st_stop.append(stop)
+                self.st_sequence.append(sequence)
+                self.st_arrival.append(arrival_secs)
+                self.st_departure.append(departure_secs)
+        self.trip_start.append(len(self.st_stop))
+
+    def _read_trip_schedules(self, conn):
+        """(trip_id, [(stop_id, sequence, arrival, departure)]) from the packed tables"""
+        patterns = {}
+        for pattern_id, stop_id, sequence in conn.execute("""
+            SELECT pattern_id, stop_id, stop_sequence FROM pattern_stops ORDER BY pattern_id, stop_index
+        """):
+            patterns.setdefault(pattern_id, []).append((stop_id, sequence))
+
+        schedules = conn.execute("""
+            SELECT trip_id, pattern_id, start_secs, arrival_offsets, departure_offsets FROM trip_schedules
+        """).fetchall()
+        return (
+            (trip_id, unpack_schedule(patterns.get(pattern_id, ()), start, arrival_offsets, departure_offsets))
+            for trip_id, pattern_id, start, arrival_offsets, departure_offsets in schedules
+        )
+
+    def _read_stop_time_rows(self, conn):
+        """(trip_id, [(stop_id, sequence, arrival, departure)]) from a stop_times table"""
+        try:
+            rows = conn.execute("""
+                SELECT trip_id, stop_id, stop_sequence, arrival_secs, departure_secs
+                FROM stop_times
+                ORDER BY trip_id, stop_sequence
+            """)
+        except sqlite3.OperationalError:
+            # Databases loaded before the integer time columns
+            rows = (
+                (trip_id, stop_id, sequence, parse_gtfs_time(arrival), parse_gtfs_time(departure))
+                for trip_id, stop_id, sequence, arrival, departure in conn.execute("""
+                    SELECT trip_id, stop_id, stop_sequence, arrival_time, departure_time
+                    FROM stop_times
+                    ORDER BY trip_id, stop_sequence
+                """)
+            )
+        for trip_id, trip_rows in groupby(rows, key=lambda row: row[0]):
+            yield trip_id, [row[1:] for row in trip_rows]
+
+    def _build_stop_index(self):
+        """Bucket every stop visit by stop, sorted by departure time"""
+        buckets = [[] for _ in self.stop_ids]
+        st_stop = self.st_stop
+        st_departure = self.st_departure
+
+        for trip in range(len(self.trip_ids)):
+            for pos in range(self.trip_start[trip], self.trip_start[trip + 1]):
+                buckets[st_stop[pos]].append((st_departure[pos], trip, pos))
+
+        for visits in buckets:
+            self.stop_start.append(len(self.dep_time))
+            visits.sort()
+            for departure_secs, trip, pos in visits:
+                self.dep_time.append(departure_secs)
+                self.dep_trip.append(trip)
+                self.dep_pos.append(pos)
+        self.stop_start.append(len(self.dep_time))
+
+    def _build_patterns(self):
+        """
+        Group trips that visit the same stops in the same order into patterns
+        Trips that would overtake each other are split into separate patterns
+        so that every departure column stays sorted, and each pattern holds a
+        single service_id so a whole pattern can be skipped on days it does
+        not run
+        """
+        trip_start = self.trip_start
+        st_arrival = self.st_arrival
+        st_departure = self.st_departure
+
+        groups = {}
+        for trip in range(len(self.trip_ids)):
+            a, b = trip_start[trip], trip_start[trip + 1]
+            if b - a >= 2:
+                key = (self.trip_service[trip], tuple(self.st_stop[a:b]))
+                groups.setdefault(key, []).append(trip)
+
+        self.trip_pattern = array('i', [-1]) * len(self.trip_ids)
+        for (_, stops), trips in groups.items():
+            trips.sort(key=lambda t: st_departure[trip_start[t]])
+
+            lanes = []
+            for trip in trips:
+                base = trip_start[trip]
+                for lane in lanes:
+                    prev = trip_start[lane[-1]]
+                    if all(st_arrival[prev + i] <= st_arrival[base + i] and
+                           st_departure[prev + i] <= st_departure[base + i]
+                           for i in range(len(stops))):
+                        lane.append(trip)
+                        break
+                else:
+                    lanes.append([trip])
+
+            for lane in lanes:
+                self._add_pattern(stops, lane)
+
+        self.pattern_start.append(len(self.pattern_stops))
+        self.pattern_trip_start.append(len(self.pattern_trips))
+        self.pattern_time_start.append(len(self.pt_departure))
+
+        buckets = [[] for _ in self.stop_ids]
+        for pattern in range(len(self.pattern_start) - 1):
+            a = self.pattern_start[pattern]
+            for pos in range(self.pattern_start[pattern + 1] - a):
+                buckets[self.pattern_stops[a + pos]].append((pattern, pos))
+
+        for entries in buckets:
+            self.stop_pattern_start.append(len(self.sp_pattern))
+            for pattern, pos in entries:
+                self.sp_pattern.append(pattern)
+                self.sp_pos.append(pos)
+        self.stop_pattern_start.append(len(self.sp_pattern))
+
+    def _add_pattern(self, stops, trips):
+        pattern = len(self.pattern_start)
+        self.pattern_start.append(len(self.pattern_stops))
+        self.pattern_stops.extend(stops)
+        self.pattern_trip_start.append(len(self.pattern_trips))
+        self.pattern_trips.extend(trips)
+        self.pattern_time_start.append(len(self.pt_departure))
+
+        for pos in range(len(stops)):
+            for trip in trips:
+                self.pt_arrival.append(self.st_arrival[self.trip_start[trip] + pos])
+                self.pt_departure.append(self.st_departure[self.trip_start[trip] + pos])
+
+        for trip in trips:
+            self.trip_pattern[trip] = pattern
+
+    def _build_transfers(self):
+        """Walking links between every pair of stops within MAX_WALK_KM"""
+        grid = self.stop_grid
+        for stop in range(len(self.stop_ids)):
+            self.transfer_start.append(len(self.transfer_stop))
+            lat, lon = self.stop_lats[stop], self.stop_lons[stop]
+            if lat is None or lon is None or self.stop_location_types[stop] != 0:
+                continue
+            for km, neighbour, _, _ in grid.within(lat, lon, MAX_WALK_KM):
+                if neighbour == stop:
+                    continue
+                self.transfer_stop.append(neighbour)
+                self.transfer_seconds.append(int(km / WALK_SPEED_KMH * 3600))
+                self.transfer_meters.append(int(km * 1000))
+        self.transfer_start.append(len(self.transfer_stop))
+
+    def nearby_stops(self, lat, lon, limit=10, max_km=None):
+        """Closest boarding stops to a location, nearest first"""
+        return [
+            {
+                'id': self.stop_ids[stop],
+                'name': self.stop_names[stop],
+                'lat': stop_lat,
+                'lon': stop_lon,
+                'distance': round(km, 2)  # Distance in km
+            }
+            for km, stop, stop_lat, stop_lon in self.stop_grid.nearest(lat, lon, limit, max_km)
+        ]
+
+    def stats(self):
+        """Summary for logs and the status page"""
+        return {
+            'version': self.version,
+            'source': self.source,
+            'stops': len(self.stop_ids),
+            'routes': len(self.route_ids),
+            'trips': len(self.trip_ids),
+            'stop_times': len(self.st_stop),
+            'patterns': len(self.pattern_start) - 1,
+            'service_days': len(self.service_days) if self.service_days is not None else None,
+            'transfers': len(self.transfer_stop),
+            'load_seconds': round(self.load_seconds or 0, 2)
+        }
+
+    def service_day(self, service_date):
+        """
+        Active trip and pattern bitsets for a service day (datetime.date)
+        Returns (trip_active, pattern_active) bytearrays, or None when the
+        database has no calendar and every trip should be considered
+        """
+        if self.service_days is None or service_date is None:
+            return None
+
+        key = service_date.strftime('%Y%m%d')
+        with self._active_lock:
+            cached = self._active_cache.get(key)
+        if cached is not None:
+            return cached
+
+        mask = self.service_days.get(key, 0)
+        service_active = bytes((mask >> service) & 1 for service in range(len(self.service_ids)))
+        trip_active = bytearray(service_active[service] if service >= 0 else 0 for service in self.trip_service)
+
+        pattern_active = bytearray(len(self.pattern_start) - 1)
+        for trip, active in enumerate(trip_active):
+            if active and self.trip_pattern[trip] >= 0:
+                pattern_active[self.trip_pattern[trip]] = 1
+
+        # Only a couple of days are ever queried at once (today and yesterday).
+        # Built outside the lock: two threads may both build a day, and the
+        # bitsets are never written after this, so either copy will do
+        active = (trip_active, pattern_active)
+        with self._active_lock:
+            if len(self._active_cache) > 4:
+                self._active_cache.clear()
+            self._active_cache[key] = active
+        return active
+
+    def find_direct_trips(self, source_stop_id, dest_stop_id, after_secs=None, limit=10, service_date=None):
+        """
+        Find trips that serve source_stop_id and later dest_stop_id
+        Returns the next `limit` departures from the source, in the same
+        shape as app.find_routes. With a service_date only trips running that
+        day are considered, plus the previous day's trips still running
+        after midnight.
+        """
+        source = self.stop_index.get(source_stop_id)
+        dest = self.stop_index.get(dest_stop_id)
+        if source is None or dest is None:
+            return []
+
+        today = self.service_day(service_date)
+        routes = self._direct_trips(source, dest, after_secs, limit, today and today[1], 0)
+
+        if today is not None and after_secs is not None:
+            yesterday = self.service_day(service_date - timedelta(days=1))
+            routes += self._direct_trips(source, dest, after_secs + SECONDS_PER_DAY, limit,
+                                         yesterday[1], SECONDS_PER_DAY)
+            routes.sort(key=lambda route: route['departure_time'])
+
+        return routes[:limit]
+
+    def _direct_trips(self, source, dest, after_secs, limit, pattern_active, day_offset):
+        """
+        Direct trips between two stop indexes, skipping patterns not in pattern_active
+        The patterns serving both stops, source first, come from intersecting
+        their stop -> pattern entries; each pattern's departures from the
+        source are a sorted column, so the next ones are a binary search away
+        """
+        dest_positions = {}
+        for i in range(self.stop_pattern_start[dest], self.stop_pattern_start[dest + 1]):
+            dest_positions.setdefault(self.sp_pattern[i], []).append(self.sp_pos[i])
+
+        departures = []
+        for i in range(self.stop_pattern_start[source], self.stop_pattern_start[source + 1]):
+            pattern = self.sp_pattern[i]
+            positions = dest_positions.get(pattern)
+            if positions is None or (pattern_active is not None and not pattern_active[pattern]):
+                continue
+            source_pos = self.sp_pos[i]
+            dest_pos = min((pos for pos in positions if pos > source_pos), default=None)
+            if dest_pos is None:
+                continue
+
+            first_trip = self.pattern_trip_start[pattern]
+            trip_count = self.pattern_trip_start[pattern + 1] - first_trip
+            column = self.pattern_time_start[pattern] + source_pos * trip_count
+            lo, hi = column, column + trip_count
+            if after_secs is not None:
+                lo = bisect_left(self.pt_departure, after_secs, lo, hi)
+            for t in range(lo, min(lo + limit, hi)):
+                trip = self.pattern_trips[first_trip + t - column]
+                departures.append((self.pt_departure[t], trip, source_pos, dest_pos))
+
+        departures.sort()
+        return [
+            self.describe_leg(trip, self.trip_start[trip] + source_pos, self.trip_start[trip] + dest_pos, day_offset)
+            for _, trip, source_pos, dest_pos in departures[:limit]
+        ]
+
+    def describe_leg(self, trip, source_pos, dest_pos, day_offset=0):
+        """
+        JSON-ready description of riding `trip` between two positions
+        day_offset shifts times of a previous service day back onto today's clock
+        """
+        route = self.trip_route[trip]
+        departure_secs = self.st_departure[source_pos] - day_offset
+        arrival_secs = self.st_arrival[dest_pos] - day_offset
+        return {
+            'trip_id': self.trip_ids[trip],
+            'route_number': self.route_short_names[route] if route >= 0 else None,
+            'route_name': self.route_long_names[route] if route >= 0 else None,
+            'route_color': self.route_colors[route] if route >= 0 else None,
+            'source_stop': self.stop_names[self.st_stop[source_pos]],
+            'dest_stop': self.stop_names[self.st_stop[dest_pos]],
+            'departure_time': format_gtfs_time(departure_secs),
+            'arrival_time': format_gtfs_time(arrival_secs),
+            'duration_minutes': (arrival_secs - departure_secs) // 60,
+            'trip_headsign': self.trip_headsigns[trip],
+            'stops_count': self.st_sequence[dest_pos] - self.st_sequence[source_pos] + 1
+        }
+
+    def trip_info(self, trip_id):
+        """Route and headsign of a trip for API responses (None if unknown)"""
+        trip = self.trip_index.get(trip_id)
+        if trip is None:
+            return None
+        route = self.trip_route[trip]
+        return {
+            'route_id': self.route_ids[route] if route >= 0 else None,
+            'route_number': self.route_short_names[route] if route >= 0 else None,
+            'route_name': self.route_long_names[route] if route >= 0 else None,
+            'route_color': self.route_colors[route] if route >= 0 else None,
+            'headsign': self.trip_headsigns[trip]
+        }
+
+    def visits_by_trip(self, stop_ids):
+        """
+        Map trip (dense id) -> [(index in trip, stop_id)] for every visit to stop_ids
+        Cost is proportional to the number of trips serving those stops
+        """
+        visits = {}
+        for stop_id in stop_ids:
+            stop = self.stop_index.get(stop_id)
+            if stop is None:
+                continue
+            for i in range(self.stop_start[stop], self.stop_start[stop + 1]):
+                trip = self.dep_trip[i]
+                index = self.dep_pos[i] - self.trip_start[trip]
+                visits.setdefault(trip, []).append((index, stop_id))
+        return visits
+
+    def trip_index_at(self, trip_id, sequence):
+        """Index within the trip of the first stop whose stop_sequence >= sequence"""
+        trip = self.trip_index.get(trip_id)
+        if trip is None:
+            return None
+        a, b = self.trip_start[trip], self.trip_start[trip + 1]
+        return bisect_left(self.st_sequence, sequence, a, b) - a
+
+    def trip_stops(self, trip_id, start_sequence, end_sequence):
+        """Stops of a trip between two stop_sequence values (inclusive)"""
+        trip = self.trip_index.get(trip_id)
+        if trip is None:
+            return []
+
+        stops = []
+        for pos in range(self.trip_start[trip], self.trip_start[trip + 1]):
+            sequence = self.st_sequence[pos]
+            if start_sequence <= sequence <= end_sequence:
+                stops.append({
+                    'sequence': sequence,
+                    'name': self.stop_names[self.st_stop[pos]],
+                    'arrival': format_gtfs_time(self.st_arrival[pos]),
+                    'departure': format_gtfs_time(self.st_departure[pos])
+                })
+        return stops
+
+
+# Shared instance used by the Flask app
+_timetable = None
+_timetable_lock = threading.Lock()
+
+
+def compiled_file(db_file):
+    """Path of the compiled timetable that belongs to db_file"""
+    return os.path.join(os.path.dirname(db_file), COMPILED_FILE)
+
+
+def load_timetable(db_file=DB_FILE):
+    """
+    Map the compiled timetable if it was built from the feed in db_file,
+    otherwise build the timetable from SQLite
+    """
+    conn = sqlite3.connect(db_file)
+    try:
+        version = get_feed_version(conn)
+    finally:
+        conn.close()
+
+    try:
+        tt = Timetable.open(compiled_file(db_file))
+    except (OSError, ValueError, KeyError):
+        tt = None  # Missing, or from an older loader or another platform
+    if tt is not None and version is not None and tt.version == version:
+        return tt
+    return Timetable.load(db_file)
+
+
+def get_timetable(db_file=DB_FILE):
+    """Return the loaded timetable, building it on first use"""
+    global _timetable
+    if _timetable is None:
+        with _timetable_lock:
+            if _timetable is None:
+                _timetable = load_timetable(db_file)
+    return _timetable
+
+
+def reload_timetable(db_file=DB_FILE):
+    """Rebuild the timetable and swap it in once it is complete"""
+    global _timetable
+    with _timetable_lock:
+        _timetable = load_timetable(db_file)
+    return _timetable
+
+
+def reload_if_changed(db_file=DB_FILE):
+    """
+    Reload hook: rebuild the timetable if load_gtfs.py has refreshed the database
+    Returns True if a reload happened
+    """
+    if _timetable is None:
+        return False
+
+    conn = sqlite3.connect(db_file)
+    try:
+        version = get_feed_version(conn)
+    finally:
+        conn.close()
+
+    if version == _timetable.version:
+        return False
+
+    reload_timetable(db_file)
+    return True
@@ -0,0 +1,121 @@
+"""
+Versioned Vehicle Positions
+Keeps the fleet as last sent to clients, plus the recent changes to it, so
+clients can ask for only what changed since the version they already have
+"""
+
+import threading
+import time
+from utils.spatial import haversine_distance
+
+# Smaller moves are not worth a marker update
+MOVE_THRESHOLD_METERS = 25
+
+# Versions kept for deltas (30 s cycles, so about 10 minutes)
+HISTORY_VERSIONS = 20
+
+# Fields that change a vehicle's marker or popup other than its position
+DETAIL_FIELDS = ('trip_id', 'route_id', 'route_number', 'route_name', 'headsign',
+                 'current_stop', 'occupancy')
+
+
+class VehicleLog:
+    """
+    vehicle_id -> vehicle as last published, with a version number
+    update() records a delta whenever vehicles appear, disappear, move more
+    than MOVE_THRESHOLD_METERS or change details; slower drift accumulates
+    against the stored position until it crosses the threshold
+    """
+
+    def __init__(self):
+        self.vehicles = {}
+        self.source = None  # Identity of the data last folded in
+        # Versions start at the process start time, so a version handed out
+        # by a previous process is never mistaken for one of ours
+        self.first_version = int(time.time())
+        self.version = self.first_version
+        self.history = []   # [(version, {vehicle_id: (vehicle or None, previous route_id)})]
+        self._lock = threading.Lock()
+
+    def update(self, vehicles, source=None):
+        """Fold in a fresh list of vehicles; returns the number of vehicles changed"""
+        changes = {}
+        seen = set()
+        with self._lock:
+            for vehicle in vehicles:
+                vehicle_id = vehicle['vehicle_id']
+                if vehicle_id is None or vehicle_id in seen:
+                    continue
+                seen.add(vehicle_id)
+                previous = self.vehicles.get(vehicle_id)
+                if previous is None or _changed(previous, vehicle):
+                    changes[vehicle_id] = (vehicle, previous['route_id'] if previous else None)
+
+            for vehicle_id, previous in self.vehicles.items():
+                if vehicle_id not in seen:
+                    changes[vehicle_id] = (None, previous['route_id'])
+
+            if changes:
+                for vehicle_id, (vehicle, _) in changes.items():
+                    if vehicle is None:
+                        del self.vehicles[vehicle_id]
+                    else:
+                        self.vehicles[vehicle_id] = vehicle
+                self.version += 1
+                self.history.append((self.version, changes))
+                del self.history[:-HISTORY_VERSIONS]
+            self.source = source
+        return len(changes)
+
+    def snapshot(self, route_id=None):
+        """Full response: every vehicle (on route_id, if given)"""
+        with self._lock:
+            vehicles = [v for v in self.vehicles.values() if route_id is None or v['route_id'] == route_id]
+            version = self.version
+        vehicles.sort(key=lambda v: (v['route_id'] or '', v['vehicle_id']))
+        return {'vehicles': vehicles, 'count': len(vehicles), 'version': version, 'full': True}
+
+    def delta(self, since, route_id=None):
+        """
+        Changes since a version: vehicles added or changed, and ids removed
+        (or moved off route_id); a full snapshot when since is unknown
+        """
+        with self._lock:
+            version = self.version
+            oldest = self.history[0][0] - 1 if self.history else version
+            if since is None or not oldest <= since <= version:
+                known = False
+            else:
+                known = True
+                merged = {}
+                for v, changes in self.history:
+                    if v <= since:
+                        continue
+                    for vehicle_id, (vehicle, previous_route) in changes.items():
+                        first = merged.get(vehicle_id)
+                        merged[vehicle_id] = (vehicle, first[1] if first else previous_route)
+                count = sum(1 for v in self.vehicles.values() if route_id is None or v['route_id'] == route_id)
+        if not known:
+            return self.snapshot(route_id)
+
+        changed = []
+        removed = []
+        for vehicle_id, (vehicle, previous_route) in merged.items():
+            if vehicle is not None and (route_id is None or vehicle['route_id'] == route_id):
+                changed.append(vehicle)
+            elif route_id is None or previous_route == route_id:
+                removed.append(vehicle_id)
+        return {'vehicles': changed, 'removed': removed, 'count': count,
+                'since': since, 'version': version, 'full': False}
+
+
+def _changed(previous, vehicle):
+    """Whether a vehicle differs enough from what clients already have"""
+    for field in DETAIL_FIELDS:
+        if previous.get(field) != vehicle.get(field):
+            return True
+    if previous['latitude'] is None or vehicle['latitude'] is None:
+        return previous['latitude'] != vehicle['latitude']
+    meters = haversine_distance(previous['latitude'], previous['longitude'],
+                                vehicle['latitude'], vehicle['longitude']) * 1000
+    return meters > MOVE_THRESHOLD_METERS